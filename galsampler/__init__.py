@@ -4,3 +4,8 @@
 from ._version import __version__
 from .crossmatch import *
 from .galmatch import *
+from .hdf5_io import *
+from .distributed import *
+from .profiling import *
+from .lightcone import *
+from .transfer import *
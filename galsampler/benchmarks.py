@@ -0,0 +1,343 @@
+"""Module implementing scaling benchmarks of crossmatch, compute_richness and galsample
+on synthetic halo and galaxy catalogs.
+
+Run from the command line with ``python -m galsampler.benchmarks --help``.
+"""
+import argparse
+from collections import namedtuple
+import json
+import sys
+import numpy as np
+from scipy.special import erf
+from .crossmatch import crossmatch, compute_richness
+from .galmatch import galsample, calculate_halo_correspondence, SourceHaloIndex
+from .profiling import StageProfiler
+
+__all__ = (
+    "make_synthetic_catalogs",
+    "run_benchmarks",
+    "scaling_exponents",
+    "BenchmarkResult",
+    "BENCHMARKS",
+)
+
+BenchmarkResult = namedtuple(
+    "BenchmarkResult",
+    ["name", "n_halos", "n_items", "wall_time", "peak_bytes", "throughput"],
+)
+
+DEFAULT_SIZES = (10**4, 10**5, 10**6)
+
+#  Halo occupation parameters of the synthetic catalogs, in units of Msun/h
+LOGM_MIN, LOGM_MAX = 11.0, 15.0
+LOGM_CEN, SIGMA_LOGM_CEN = 12.0, 0.25
+LOGM_SAT, ALPHA_SAT = 13.0, 1.0
+
+
+def make_synthetic_catalogs(n_source_halos, n_target_halos=None, seed=None):
+    """Synthetic source and target catalogs with a realistic occupation distribution
+
+    Halo masses are drawn from a power-law mass function dn/dM ~ M^-1.9.
+    Each halo hosts a central galaxy with a probability rising smoothly
+    with mass, and a Poisson number of satellites with mean proportional to mass.
+
+    Parameters
+    ----------
+    n_source_halos : int
+
+    n_target_halos : int, optional
+        Default is n_source_halos
+
+    seed : int, optional
+        Seed of the random number generator. Default is None.
+
+    Returns
+    -------
+    catalogs : dict
+        Keys are the arguments of galsample: source_galaxies_host_halo_id,
+        source_halo_ids, target_halo_ids, source_halo_props and target_halo_props.
+        The halo IDs are sparse integers in random order.
+        The keys source_galaxies_host_halo_rank and source_halo_ranks
+        store the same catalog with dense IDs in the range [0, n_source_halos).
+
+    """
+    rng = np.random.default_rng(seed)
+    n_target_halos = n_source_halos if n_target_halos is None else n_target_halos
+
+    source_halo_props = _random_halo_props(rng, n_source_halos)
+    target_halo_props = _random_halo_props(rng, n_target_halos)
+    logm = source_halo_props[0]
+
+    prob_cen = 0.5 * (1 + erf((logm - LOGM_CEN) / SIGMA_LOGM_CEN))
+    n_cen = (rng.uniform(size=n_source_halos) < prob_cen).astype("i8")
+    n_sat = rng.poisson(10 ** (ALPHA_SAT * (logm - LOGM_SAT)))
+    richness = n_cen + n_sat
+
+    source_halo_ranks = rng.permutation(n_source_halos)
+    source_galaxies_host_halo_rank = rng.permutation(
+        np.repeat(source_halo_ranks, richness)
+    )
+    #  Sparse IDs with random gaps, as in halo catalogs of simulations
+    sparse_ids = np.cumsum(rng.integers(1, 1000, n_source_halos))
+    target_halo_ids = np.cumsum(rng.integers(1, 1000, n_target_halos))
+
+    return dict(
+        source_galaxies_host_halo_id=sparse_ids[source_galaxies_host_halo_rank],
+        source_halo_ids=sparse_ids[source_halo_ranks],
+        target_halo_ids=rng.permutation(target_halo_ids),
+        source_halo_props=source_halo_props,
+        target_halo_props=target_halo_props,
+        source_galaxies_host_halo_rank=source_galaxies_host_halo_rank,
+        source_halo_ranks=source_halo_ranks,
+    )
+
+
+def _random_halo_props(rng, n_halos):
+    """Log mass drawn from dn/dM ~ M^-1.9, and log concentration with scatter"""
+    slope = -0.9
+    u = rng.uniform(size=n_halos)
+    mlo, mhi = 10 ** (slope * LOGM_MIN), 10 ** (slope * LOGM_MAX)
+    logm = np.log10(mlo + u * (mhi - mlo)) / slope
+    logc = 1.0 - 0.1 * (logm - 12) + rng.normal(0, 0.15, n_halos)
+    return (logm, logc)
+
+
+def _crossmatch(method, dense=False):
+    def benchmark(catalogs):
+        if dense:
+            x = catalogs["source_galaxies_host_halo_rank"]
+            y = catalogs["source_halo_ranks"]
+        else:
+            x = catalogs["source_galaxies_host_halo_id"]
+            y = catalogs["source_halo_ids"]
+        crossmatch(x, y, method=method)
+        return x.size
+
+    return benchmark
+
+
+def _compute_richness(method, dense=False):
+    def benchmark(catalogs):
+        if dense:
+            x = catalogs["source_galaxies_host_halo_rank"]
+            y = catalogs["source_halo_ranks"]
+        else:
+            x = catalogs["source_galaxies_host_halo_id"]
+            y = catalogs["source_halo_ids"]
+        compute_richness(y, x, method=method)
+        return x.size
+
+    return benchmark
+
+
+def _halo_correspondence(method, n_props):
+    def benchmark(catalogs):
+        source_halo_props = catalogs["source_halo_props"][:n_props]
+        target_halo_props = catalogs["target_halo_props"][:n_props]
+        calculate_halo_correspondence(
+            source_halo_props, target_halo_props, method=method
+        )
+        return target_halo_props[0].size
+
+    return benchmark
+
+
+def _source_halo_index(catalogs):
+    SourceHaloIndex(
+        catalogs["source_galaxies_host_halo_id"],
+        catalogs["source_halo_ids"],
+        catalogs["source_halo_props"],
+    )
+    return catalogs["source_galaxies_host_halo_id"].size
+
+
+def _galsample(catalogs):
+    res = galsample(
+        catalogs["source_galaxies_host_halo_id"],
+        catalogs["source_halo_ids"],
+        catalogs["target_halo_ids"],
+        catalogs["source_halo_props"],
+        catalogs["target_halo_props"],
+    )
+    return res.target_gals_selection_indx.size
+
+
+#  Each benchmark takes the output of make_synthetic_catalogs,
+#  and returns the number of items processed, used to compute the throughput
+BENCHMARKS = dict(
+    crossmatch_sort=_crossmatch("sort"),
+    crossmatch_hash=_crossmatch("hash"),
+    crossmatch_dense=_crossmatch("dense", dense=True),
+    compute_richness_sort=_compute_richness("sort"),
+    compute_richness_dense=_compute_richness("dense", dense=True),
+    halo_correspondence_kdtree=_halo_correspondence("kdtree", 2),
+    halo_correspondence_searchsorted=_halo_correspondence("searchsorted", 1),
+    halo_correspondence_grid=_halo_correspondence("grid", 2),
+    source_halo_index=_source_halo_index,
+    galsample=_galsample,
+)
+
+
+def run_benchmarks(
+    sizes=DEFAULT_SIZES, names=None, repeat=1, trace_memory=False, seed=43, jsonl=None
+):
+    """Time each benchmark on synthetic catalogs of increasing size
+
+    Parameters
+    ----------
+    sizes : sequence of ints, optional
+        Number of source and target halos of each catalog. Default is DEFAULT_SIZES.
+
+    names : sequence of strings, optional
+        Keys of BENCHMARKS to run. Default is all benchmarks.
+
+    repeat : int, optional
+        Number of calls of each benchmark. The fastest call is reported.
+        Default is 1. Every benchmark is called once before timing,
+        so that the compilation of Numba kernels is excluded.
+
+    trace_memory : bool, optional
+        If True, record the peak memory of each call with tracemalloc,
+        which slows down the calls. Default is False.
+
+    seed : int, optional
+        Seed of the synthetic catalogs. Default is 43.
+
+    jsonl : string or file-like object, optional
+        If not None, every call is also written as a line of JSON.
+        See :class:`~galsampler.profiling.StageProfiler`.
+
+    Returns
+    -------
+    results : list of BenchmarkResult
+        Throughput is in items per second, where items are galaxies
+        for the benchmarks of crossmatch, compute_richness and galsample,
+        and target halos for the benchmarks of the halo correspondence
+
+    """
+    names = list(BENCHMARKS.keys()) if names is None else list(names)
+    for name in names:
+        if name not in BENCHMARKS:
+            msg = "Benchmark `{0}` must be one of {1}"
+            raise ValueError(msg.format(name, tuple(BENCHMARKS.keys())))
+
+    warmup = make_synthetic_catalogs(100, seed=seed)
+    for name in names:
+        BENCHMARKS[name](warmup)
+
+    results = []
+    for n_halos in sizes:
+        catalogs = make_synthetic_catalogs(int(n_halos), seed=seed)
+        for name in names:
+            profiler = StageProfiler(trace_memory=trace_memory, jsonl=jsonl)
+            for __ in range(repeat):
+                with profiler.stage(name, n_items=n_halos):
+                    n_items = BENCHMARKS[name](catalogs)
+            best = min(profiler.records, key=lambda record: record.wall_time)
+            throughput = n_items / best.wall_time if best.wall_time > 0 else np.inf
+            results.append(
+                BenchmarkResult(
+                    name,
+                    int(n_halos),
+                    n_items,
+                    best.wall_time,
+                    best.peak_bytes,
+                    throughput,
+                )
+            )
+    return results
+
+
+def scaling_exponents(results):
+    """Power-law index of the wall time of each benchmark as a function of size
+
+    Parameters
+    ----------
+    results : list of BenchmarkResult
+
+    Returns
+    -------
+    exponents : dict
+        Keys are benchmark names, values are the slope of a least-squares fit
+        of log(wall_time) against log(n_items), e.g., 1 for linear scaling.
+        Benchmarks run at fewer than two sizes are omitted.
+
+    """
+    exponents = dict()
+    for name in dict.fromkeys(result.name for result in results):
+        n_items = [r.n_items for r in results if r.name == name]
+        wall_time = [r.wall_time for r in results if r.name == name]
+        if len(set(n_items)) < 2:
+            continue
+        slope = np.polyfit(np.log(n_items), np.log(wall_time), 1)[0]
+        exponents[name] = float(slope)
+    return exponents
+
+
+def _format_report(results, exponents):
+    header = "{0:<34}{1:>12}{2:>14}{3:>12}{4:>14}{5:>16}".format(
+        "benchmark", "n_halos", "n_items", "time [s]", "peak [MB]", "items / s"
+    )
+    lines = [header, "-" * len(header)]
+    for r in results:
+        peak = "" if r.peak_bytes is None else "{0:.1f}".format(r.peak_bytes / 2**20)
+        lines.append(
+            "{0:<34}{1:>12}{2:>14}{3:>12.4f}{4:>14}{5:>16.4g}".format(
+                r.name, r.n_halos, r.n_items, r.wall_time, peak, r.throughput
+            )
+        )
+    if exponents:
+        lines.extend(["", "{0:<34}{1:>12}".format("benchmark", "exponent")])
+        for name, exponent in exponents.items():
+            lines.append("{0:<34}{1:>12.2f}".format(name, exponent))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m galsampler.benchmarks",
+        description="Scaling benchmarks of galsampler on synthetic catalogs",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=float,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="Number of source and target halos, e.g., --sizes 1e4 1e5 1e6",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        default=None,
+        choices=list(BENCHMARKS.keys()),
+        help="Benchmarks to run. Default is all benchmarks.",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--memory", action="store_true", help="Record peak memory with tracemalloc"
+    )
+    parser.add_argument("--seed", type=int, default=43)
+    parser.add_argument(
+        "--json", action="store_true", help="Print the results as JSON lines"
+    )
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        sizes=[int(n) for n in args.sizes],
+        names=args.benchmarks,
+        repeat=args.repeat,
+        trace_memory=args.memory,
+        seed=args.seed,
+    )
+    exponents = scaling_exponents(results)
+    if args.json:
+        for result in results:
+            record = result._asdict()
+            record["scaling_exponent"] = exponents.get(result.name)
+            sys.stdout.write(json.dumps(record) + "\n")
+    else:
+        print(_format_report(results, exponents))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,270 @@
 """
 """
+from collections import namedtuple
+from contextlib import contextmanager
+import numba
 import numpy as np
+from numba import njit, prange
+from .profiling import _get_profiler
 
 
-__all__ = ("crossmatch", "compute_richness")
+__all__ = ("crossmatch", "compute_richness", "compute_group_boundaries")
 
+GroupBoundaries = namedtuple(
+    "GroupBoundaries", ["unique_ids", "first_indices", "counts"]
+)
 
-def crossmatch(x, y, skip_bounds_checking=False):
+CROSSMATCH_METHODS = ("sort", "hash", "dense", "auto")
+VALIDATION_MODES = ("full", "fast", "none")
+RICHNESS_METHODS = ("sort", "dense", "auto")
+
+#  With method="auto", crossmatch uses the hash table when x has at least this many
+#  entries, since for small arrays the cost of sorting is negligible
+AUTO_HASH_MIN_SIZE = 2**20
+
+#  With method="auto", a lookup table indexed by ID is used whenever the span of IDs
+#  is no larger than this factor times the combined length of the input arrays
+DENSE_SPAN_FACTOR = 2
+
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+@njit
+def _hash_slot(key, shift):
+    """Fibonacci hashing of a 64-bit integer key into a table of size 2**(64-shift)"""
+    return np.int64((np.uint64(key) * _HASH_MULTIPLIER) >> np.uint64(shift))
+
+
+@njit
+def _build_hash_table(y, table_keys, table_indices, shift):
+    """Insert each entry of y into an open-addressing hash table with linear probing.
+    Empty slots are marked by -1 in table_indices.
+    Returns True if y has repeated entries, in which case only the first is inserted.
+    """
+    mask = table_keys.shape[0] - 1
+    has_repeats = False
+    for iy in range(y.shape[0]):
+        key = y[iy]
+        slot = _hash_slot(key, shift)
+        is_repeat = False
+        while table_indices[slot] != -1:
+            if table_keys[slot] == key:
+                is_repeat = True
+                break
+            slot = (slot + 1) & mask
+        if is_repeat:
+            has_repeats = True
+        else:
+            table_keys[slot] = key
+            table_indices[slot] = iy
+    return has_repeats
+
+
+def _probe_hash_table(x, table_keys, table_indices, shift, result):
+    """For each entry of x, store the index of the matching entry of y,
+    or -1 when there is no match
+    """
+    mask = table_keys.shape[0] - 1
+    for ix in prange(x.shape[0]):
+        key = x[ix]
+        slot = _hash_slot(key, shift)
+        result[ix] = -1
+        while table_indices[slot] != -1:
+            if table_keys[slot] == key:
+                result[ix] = table_indices[slot]
+                break
+            slot = (slot + 1) & mask
+
+
+probe_hash_table_kernel = njit(nogil=True)(_probe_hash_table)
+probe_hash_table_kernel_parallel = njit(parallel=True)(_probe_hash_table)
+
+
+@contextmanager
+def _numba_threads(n_threads):
+    """Temporarily set the number of threads used by parallel Numba kernels.
+    Values of n_threads less than 1 leave the Numba default of all cores unchanged.
+    """
+    if n_threads < 1:
+        yield
+    else:
+        n_threads_orig = numba.get_num_threads()
+        numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+        try:
+            yield
+        finally:
+            numba.set_num_threads(n_threads_orig)
+
+
+def _crossmatch_hash(x, y, check_unique=False, n_threads=-1):
+    """Hash-table implementation of crossmatch. Runs in linear time and does not
+    sort or copy either input array beyond casting to int64.
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+
+    #  Table has at least twice as many slots as y has entries
+    log2_table_size = max(int(np.ceil(np.log2(max(2 * y.size, 2)))), 1)
+    shift = 64 - log2_table_size
+    table_keys = np.zeros(2**log2_table_size, dtype=np.int64)
+    table_indices = np.zeros(2**log2_table_size, dtype=np.int64) - 1
+    y_has_repeats = _build_hash_table(y, table_keys, table_indices, shift)
+    if check_unique and y_has_repeats:
+        raise ValueError(_Y_MSG)
+
+    match_indices = np.empty(x.size, dtype=np.int64)
+    args = (x, table_keys, table_indices, shift, match_indices)
+    #  The serial kernel never starts the Numba threading layer
+    if n_threads == 1:
+        probe_hash_table_kernel(*args)
+    else:
+        with _numba_threads(n_threads):
+            probe_hash_table_kernel_parallel(*args)
+
+    idx_x = np.flatnonzero(match_indices >= 0)
+    return idx_x, match_indices[idx_x]
+
+
+_Y_MSG = "Input array y must be a 1d sequence of unique integers"
+_X_MSG = "Input array x must be a 1d sequence of integers"
+
+
+def _is_integer_sequence(arr):
+    """Vectorized check that arr is one-dimensional and stores integer values"""
+    if arr.ndim != 1:
+        return False
+    if arr.dtype.kind in "iu":
+        return True
+    try:
+        return bool(np.all(np.array(arr, dtype=np.int64) == arr))
+    except (ValueError, TypeError):
+        return False
+
+
+def _check_unique_ids(ids, msg):
+    """Raise a ValueError with msg if ids stores repeated values"""
+    sorted_ids = np.sort(ids)
+    if np.any(sorted_ids[1:] == sorted_ids[:-1]):
+        raise ValueError(msg)
+
+
+def _is_dense(ids, n_total):
+    """Check whether the span of values in ids is small enough for a lookup table"""
+    if ids.size == 0:
+        return False
+    span = int(ids.max()) - int(ids.min()) + 1
+    return span <= DENSE_SPAN_FACTOR * n_total
+
+
+def _crossmatch_dense(x, y, check_unique=False):
+    """Lookup-table implementation of crossmatch for y spanning a compact range.
+    Memory usage scales with max(y) - min(y).
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    if y.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    ymin = y.min()
+    span = y.max() - ymin + 1
+    lookup_table = np.zeros(span, dtype=np.int64) - 1
+    lookup_table[y - ymin] = np.arange(y.size)
+    if check_unique and np.any(lookup_table[y - ymin] != np.arange(y.size)):
+        raise ValueError(_Y_MSG)
+
+    x_offset = x - ymin
+    idx_x = np.flatnonzero((x_offset >= 0) & (x_offset < span))
+    match_indices = lookup_table[x_offset[idx_x]]
+    has_match = match_indices >= 0
+    return idx_x[has_match], match_indices[has_match]
+
+
+@njit
+def _count_groups(sorted_ids):
+    """Number of runs of equal values in a sorted array"""
+    n = sorted_ids.shape[0]
+    n_groups = 1 if n > 0 else 0
+    for i in range(1, n):
+        if sorted_ids[i] != sorted_ids[i - 1]:
+            n_groups += 1
+    return n_groups
+
+
+@njit
+def _run_length_encode(sorted_ids, unique_ids, first_indices, counts):
+    """Fill in the unique value, first index and length of each run
+    of equal values in a sorted array, in a single pass
+    """
+    n = sorted_ids.shape[0]
+    igroup = -1
+    for i in range(n):
+        if i == 0 or sorted_ids[i] != sorted_ids[i - 1]:
+            igroup += 1
+            unique_ids[igroup] = sorted_ids[i]
+            first_indices[igroup] = i
+            counts[igroup] = 0
+        counts[igroup] += 1
+
+
+def compute_group_boundaries(sorted_ids):
+    """Calculate the run-length structure of a sorted array of IDs in a linear scan
+
+    Parameters
+    ----------
+    sorted_ids : ndarray
+        Numpy integer array of shape (n, ) sorted in ascending order,
+        e.g., the host halo ID of each galaxy in a catalog sorted by host
+
+    Returns
+    -------
+    group_boundaries : GroupBoundaries
+        namedtuple with the following fields:
+
+        unique_ids : ndarray of shape (n_groups, )
+            Same as np.unique(sorted_ids)
+
+        first_indices : ndarray of shape (n_groups, )
+            Index of the first appearance of each unique ID in sorted_ids
+
+        counts : ndarray of shape (n_groups, )
+            Number of appearances of each unique ID in sorted_ids
+
+    Examples
+    --------
+    >>> sorted_ids = np.array([1, 1, 1, 4, 5, 5])
+    >>> group_boundaries = compute_group_boundaries(sorted_ids)
+    >>> group_boundaries.counts
+    array([3, 1, 2])
+
+    Notes
+    -----
+    Unlike np.unique, the input is never sorted again. A first pass counts the groups
+    without writing anything, so that the outputs are allocated with their exact size,
+    and a second pass fills in all three outputs.
+
+    """
+    #  Numba kernels only accept arrays in native byte order,
+    #  whereas FITS and some HDF5 catalogs store big-endian IDs
+    sorted_ids = _native_byteorder(np.atleast_1d(sorted_ids))
+    n_groups = _count_groups(sorted_ids)
+    unique_ids = np.empty(n_groups, dtype=sorted_ids.dtype)
+    first_indices = np.empty(n_groups, dtype=np.int64)
+    counts = np.empty(n_groups, dtype=np.int64)
+    _run_length_encode(sorted_ids, unique_ids, first_indices, counts)
+    return GroupBoundaries(unique_ids, first_indices, counts)
+
+
+def crossmatch(
+    x,
+    y,
+    skip_bounds_checking=False,
+    method="sort",
+    validate="fast",
+    assume_x_sorted=False,
+    assume_y_sorted=False,
+    profile=None,
+    n_threads=-1,
+):
     """
     Finds where the elements of ``x`` appear in the array ``y``, including repeats.
 
@@ -30,7 +288,48 @@ def crossmatch(x, y, skip_bounds_checking=False):
         and that all values in ``y`` are unique).
         If ``skip_bounds_checking`` is set to True,
         this testing is bypassed and the function evaluates faster.
-        Default is False.
+        Equivalent to ``validate="none"``. Default is False.
+
+    method : string, optional
+        Algorithm used to find the matches. Options are:
+
+        * "sort": argsort both arrays and match with a binary search
+        * "hash": build an open-addressing hash table on ``y`` and probe it
+          in parallel with each entry of ``x``. Runs in linear time.
+        * "dense": build a lookup table indexed by ``y - y.min()``.
+          Fastest option when ``y`` spans a compact range of integers.
+        * "auto": use "dense" when ``y`` spans a compact range,
+          otherwise "hash" when ``x`` is large, otherwise "sort"
+
+        All methods return the same pairs of matching indices, but possibly
+        in a different order. With "hash" and "dense",
+        idx_x is returned in ascending order. Default is "sort".
+
+    validate : string, optional
+        Level of testing of the input arrays. Options are:
+
+        * "full": test uniqueness of ``y`` by building a Python set
+        * "fast": vectorized testing, with the uniqueness of ``y`` tested as a
+          by-product of the sort, hash table or lookup table built by ``method``
+        * "none": no testing, same as ``skip_bounds_checking=True``
+
+        "full" and "fast" raise the same exceptions. Default is "fast".
+
+    assume_x_sorted : bool, optional
+        If True, ``x`` is assumed to be sorted in ascending order,
+        and method="sort" skips the argsort of ``x``. Default is False.
+
+    assume_y_sorted : bool, optional
+        If True, ``y`` is assumed to be sorted in ascending order,
+        and method="sort" skips the argsort of ``y``. Default is False.
+
+    profile : StageProfiler, optional
+        If not None, the validation and matching stages are recorded in profile.
+        See :class:`~galsampler.profiling.StageProfiler`. Default is None.
+
+    n_threads : int, optional
+        Number of threads used by method="hash". Default is -1 for all cores.
+        With n_threads=1, no parallel Numba kernel is started.
 
     Returns
     -------
@@ -46,34 +345,83 @@ def crossmatch(x, y, skip_bounds_checking=False):
     # Ensure inputs are Numpy arrays
     x = np.atleast_1d(x)
     y = np.atleast_1d(y)
+    profile = _get_profiler(profile)
 
-    # Require that the inputs meet the assumptions of the algorithm
+    if validate not in VALIDATION_MODES:
+        msg = "Input validate = `{0}` must be one of {1}"
+        raise ValueError(msg.format(validate, VALIDATION_MODES))
     if skip_bounds_checking is True:
-        pass
-    else:
+        validate = "none"
+
+    with profile.stage("crossmatch.validate", n_items=x.size + y.size):
+        _validate_crossmatch_inputs(x, y, validate)
+    check_unique = validate == "fast"
+
+    if method not in CROSSMATCH_METHODS:
+        msg = "Input method = `{0}` must be one of {1}"
+        raise ValueError(msg.format(method, CROSSMATCH_METHODS))
+    if method == "auto":
+        if _is_dense(y, x.size + y.size):
+            method = "dense"
+        elif x.size >= AUTO_HASH_MIN_SIZE:
+            method = "hash"
+        else:
+            method = "sort"
+
+    with profile.stage("crossmatch." + method, n_items=x.size + y.size):
+        if method == "hash":
+            return _crossmatch_hash(x, y, check_unique, n_threads)
+        elif method == "dense":
+            return _crossmatch_dense(x, y, check_unique)
+        return _crossmatch_sort(x, y, check_unique, assume_x_sorted, assume_y_sorted)
+
+
+def _validate_crossmatch_inputs(x, y, validate):
+    """Require that the inputs meet the assumptions of the crossmatch algorithm"""
+    if validate == "full":
         try:
             assert len(set(y)) == len(y)
             assert np.all(np.array(y, dtype=np.int64) == y)
             assert np.shape(y) == (len(y),)
         except (AssertionError, ValueError, TypeError):
-            msg = "Input array y must be a 1d sequence of unique integers"
-            raise ValueError(msg)
+            raise ValueError(_Y_MSG)
         try:
             assert np.all(np.array(x, dtype=np.int64) == x)
             assert np.shape(x) == (len(x),)
         except (AssertionError, ValueError, TypeError):
-            msg = "Input array x must be a 1d sequence of integers"
-            raise ValueError(msg)
+            raise ValueError(_X_MSG)
+    elif validate == "fast":
+        #  Uniqueness of y is tested below by the algorithm selected by method
+        if not _is_integer_sequence(y):
+            raise ValueError(_Y_MSG)
+        if not _is_integer_sequence(x):
+            raise ValueError(_X_MSG)
+
 
+def _crossmatch_sort(
+    x, y, check_unique=False, assume_x_sorted=False, assume_y_sorted=False
+):
+    """Sort-based implementation of crossmatch"""
     # Internally, we will work with sorted arrays, and then undo the sorting at the end
-    idx_x_sorted = np.argsort(x)
-    idx_y_sorted = np.argsort(y)
-    x_sorted = np.copy(x[idx_x_sorted])
-    y_sorted = np.copy(y[idx_y_sorted])
+    if assume_x_sorted:
+        idx_x_sorted = np.arange(x.size)
+        x_sorted = x
+    else:
+        idx_x_sorted = np.argsort(x)
+        x_sorted = np.copy(x[idx_x_sorted])
+    if assume_y_sorted:
+        idx_y_sorted = np.arange(y.size)
+        y_sorted = y
+    else:
+        idx_y_sorted = np.argsort(y)
+        y_sorted = np.copy(y[idx_y_sorted])
+    if check_unique and np.any(y_sorted[1:] == y_sorted[:-1]):
+        raise ValueError(_Y_MSG)
 
     # x may have repeated entries
     # Address by finding the unique values as well as their multiplicity
-    unique_xvals, counts = np.unique(x_sorted, return_counts=True)
+    # x_sorted is already sorted, so a linear scan replaces np.unique
+    unique_xvals, __, counts = compute_group_boundaries(x_sorted)
 
     # Determine which of the unique x values has a match in y
     unique_xval_has_match = np.in1d(unique_xvals, y_sorted, assume_unique=True)
@@ -93,7 +441,51 @@ def crossmatch(x, y, skip_bounds_checking=False):
     return idx_x_sorted[idx_x], idx_y_sorted[idx_y]
 
 
-def compute_richness(unique_halo_ids, halo_id_of_galaxies):
+def _native_byteorder(arr):
+    """Return arr in native byte order, copying only if it is not already"""
+    return arr.astype(arr.dtype.newbyteorder("="), copy=False)
+
+
+def _as_integer_array(arr):
+    """Cast arr to int only if it is not already an integer array,
+    so that integer inputs are never copied
+    """
+    arr = np.atleast_1d(arr)
+    if arr.dtype.kind not in "iu":
+        arr = arr.astype(int)
+    return arr
+
+
+def _as_common_integer_arrays(x, y):
+    """Cast x and y to a common integer dtype, copying only arrays whose dtype differs.
+    Mixed signed and unsigned 64-bit IDs, which numpy would promote to float64,
+    are cast to int64.
+    """
+    x, y = _as_integer_array(x), _as_integer_array(y)
+    dtype = _common_integer_dtype(x.dtype, y.dtype)
+    return x.astype(dtype, copy=False), y.astype(dtype, copy=False)
+
+
+def _common_integer_dtype(*dtypes):
+    """Common dtype of the input dtypes, as np.result_type, except that integer
+    dtypes always give an integer dtype: mixed signed and unsigned 64-bit integers,
+    which numpy would promote to float64, give int64.
+    """
+    dtype = np.result_type(*dtypes)
+    if dtype.kind not in "iu" and all(np.dtype(dt).kind in "iu" for dt in dtypes):
+        dtype = np.dtype("i8")
+    return dtype
+
+
+def compute_richness(
+    unique_halo_ids,
+    halo_id_of_galaxies,
+    method="auto",
+    assume_sorted=False,
+    group_boundaries=None,
+    dtype="i8",
+    n_threads=-1,
+):
     r"""For every ID in unique_halo_ids,
     calculate the number of times the ID appears in halo_id_of_galaxies.
 
@@ -105,6 +497,32 @@ def compute_richness(unique_halo_ids, halo_id_of_galaxies):
     halo_id_of_galaxies : ndarray
         Numpy integer array of shape (num_galaxies, ) storing the host ID of each galaxy
 
+    method : string, optional
+        Algorithm used to count the galaxies. Options are:
+
+        * "sort": sort followed by compute_group_boundaries and crossmatch
+        * "dense": a single np.bincount pass over ``halo_id_of_galaxies``.
+          Fastest option when ``unique_halo_ids`` spans a compact range of integers.
+        * "auto": use "dense" when ``unique_halo_ids`` spans a compact range
+
+        All methods return identical results. Default is "auto".
+
+    assume_sorted : bool, optional
+        If True, ``halo_id_of_galaxies`` is assumed to be sorted in ascending order,
+        and the galaxies are counted in a linear scan rather than with a sort.
+        Default is False.
+
+    group_boundaries : GroupBoundaries, optional
+        Output of compute_group_boundaries(halo_id_of_galaxies),
+        for callers that have already computed it. Default is None.
+
+    dtype : string or numpy dtype, optional
+        Integer dtype of the returned richness, e.g., "i4" for catalogs
+        with fewer than 2**31 galaxies. Default is "i8".
+
+    n_threads : int, optional
+        Number of threads of the underlying crossmatch. Default is -1 for all cores.
+
     Returns
     -------
     richness : ndarray
@@ -118,11 +536,55 @@ def compute_richness(unique_halo_ids, halo_id_of_galaxies):
     >>> halo_id_of_galaxies = np.random.randint(0, 5000, num_sats)
     >>> richness = compute_richness(unique_halo_ids, halo_id_of_galaxies)
     """
-    unique_halo_ids = np.atleast_1d(unique_halo_ids).astype(int)
-    halo_id_of_galaxies = np.atleast_1d(halo_id_of_galaxies).astype(int)
-    richness_result = np.zeros_like(unique_halo_ids).astype(int)
+    unique_halo_ids, halo_id_of_galaxies = _as_common_integer_arrays(
+        unique_halo_ids, halo_id_of_galaxies
+    )
+    #  The IDs are matched without validation below, so check uniqueness once here
+    _check_unique_ids(unique_halo_ids, "Input unique_halo_ids must store unique IDs")
+    richness_result = np.zeros(unique_halo_ids.size, dtype=dtype)
+
+    if method not in RICHNESS_METHODS:
+        msg = "Input method = `{0}` must be one of {1}"
+        raise ValueError(msg.format(method, RICHNESS_METHODS))
+    if method == "auto":
+        n_total = unique_halo_ids.size + halo_id_of_galaxies.size
+        method = "dense" if _is_dense(unique_halo_ids, n_total) else "sort"
+
+    if group_boundaries is None and assume_sorted:
+        group_boundaries = compute_group_boundaries(halo_id_of_galaxies)
 
-    vals, counts = np.unique(halo_id_of_galaxies, return_counts=True)
-    idxA, idxB = crossmatch(vals, unique_halo_ids)
-    richness_result[idxB] = counts[idxA]
+    if group_boundaries is not None:
+        #  The counts are already known, so all that remains is to match the IDs
+        idxA, idxB = crossmatch(
+            unique_halo_ids,
+            group_boundaries.unique_ids,
+            method="auto",
+            validate="none",
+            assume_y_sorted=True,
+            n_threads=n_threads,
+        )
+        richness_result[idxA] = group_boundaries.counts[idxB]
+        return richness_result
+
+    if method == "dense":
+        if unique_halo_ids.size == 0:
+            return richness_result
+        idmin = unique_halo_ids.min()
+        span = unique_halo_ids.max() - idmin + 1
+        gal_offset = halo_id_of_galaxies - idmin
+        gal_offset = gal_offset[(gal_offset >= 0) & (gal_offset < span)]
+        counts = np.bincount(gal_offset, minlength=span)
+        richness_result[:] = counts[unique_halo_ids - idmin]
+        return richness_result
+
+    #  vals is unique by construction, so there is no need to validate the inputs
+    vals, __, counts = compute_group_boundaries(np.sort(halo_id_of_galaxies))
+    idxA, idxB = crossmatch(
+        unique_halo_ids,
+        vals,
+        validate="none",
+        assume_y_sorted=True,
+        n_threads=n_threads,
+    )
+    richness_result[idxA] = counts[idxB]
     return richness_result
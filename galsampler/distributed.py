@@ -0,0 +1,375 @@
+"""Module implementing drivers that distribute the target halos of galsample
+across worker processes on a single node, or across MPI ranks.
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from scipy.spatial import cKDTree
+from .crossmatch import _native_byteorder
+from .galmatch import GalsamplerCorrespondence, SourceHaloIndex
+from .galmatch import _get_data_block, _query_source_tree
+
+__all__ = (
+    "galsample_multiprocessing",
+    "galsample_mpi",
+    "shared_memory_halo_correspondence",
+)
+
+#  State of each worker process, set by the pool initializer
+_WORKER_STATE = dict()
+
+
+class _SharedArrays:
+    """Collection of ndarrays allocated in shared memory.
+
+    The spec attribute is a small picklable dictionary that worker processes
+    pass to _attach_shared_arrays to map the same buffers without copying them.
+    """
+
+    def __init__(self):
+        self._shms = []
+        self.spec = dict()
+        self.arrays = dict()
+
+    def empty(self, key, shape, dtype):
+        dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self._shms.append(shm)
+        self.spec[key] = (shm.name, shape, dtype.str)
+        self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return self.arrays[key]
+
+    def copy(self, key, arr):
+        arr = np.asarray(arr)
+        out = self.empty(key, arr.shape, arr.dtype)
+        out[...] = arr
+        return out
+
+    def data_block(self, key, props):
+        """Stack a sequence of 1d arrays into a C-contiguous array
+        of shape (n, n_props), written column by column directly into shared memory
+        """
+        out = self.empty(key, (len(props[0]), len(props)), "f8")
+        return _get_data_block(*props, out=out)
+
+    def release(self):
+        #  Views into the buffers must be released before the buffers are closed
+        self.arrays.clear()
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+
+def _attach_shared_arrays(spec):
+    shms, arrays = [], dict()
+    for key, (name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=name)
+        shms.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return shms, arrays
+
+
+def _partition_bounds(n, n_parts):
+    """Boundaries of n_parts contiguous slices of nearly equal size covering range(n)"""
+    return np.linspace(0, n, n_parts + 1).astype("i8")
+
+
+def _spawn_seeds(seed, n_parts):
+    """Independent random generators for each partition of the target halos"""
+    return list(np.random.default_rng(seed).integers(2**63, size=n_parts))
+
+
+def _pool(n_procs, initializer, initargs):
+    """Process pool using the spawn start method, which unlike fork is safe to use
+    after Numba or the KD-tree have started their own threads
+    """
+    ctx = multiprocessing.get_context("spawn")
+    return ctx.Pool(n_procs, initializer=initializer, initargs=initargs)
+
+
+def _init_galsample_worker(spec, metadata, match_kwargs):
+    shms, arrays = _attach_shared_arrays(spec)
+    _WORKER_STATE.update(
+        shms=shms,
+        arrays=arrays,
+        source_index=SourceHaloIndex._from_state(arrays, metadata),
+        match_kwargs=match_kwargs,
+    )
+
+
+def _match_partition(args):
+    istart, iend, seed = args
+    arrays = _WORKER_STATE["arrays"]
+    X_target = arrays["target_halo_data_block"][istart:iend]
+    target_halo_props = tuple(X_target.T)
+    source_index = _WORKER_STATE["source_index"]
+    match_kwargs = dict(_WORKER_STATE["match_kwargs"], seed=seed)
+    __, indices = source_index.match_target_halos(
+        target_halo_props, n_threads=1, **match_kwargs
+    )
+    arrays["source_halo_selection_indices"][istart:iend] = indices
+
+
+def _fill_partition(args):
+    istart, iend, first_target_gal, out_spec = args
+    arrays = _WORKER_STATE["arrays"]
+    shms, out_arrays = _attach_shared_arrays(out_spec)
+    correspondence = GalsamplerCorrespondence(
+        *(out_arrays[key] for key in GalsamplerCorrespondence._fields)
+    )
+    _WORKER_STATE["source_index"]._fill_correspondence(
+        arrays["target_halo_ids"][istart:iend],
+        arrays["source_halo_selection_indices"][istart:iend],
+        correspondence,
+        first_target_gal,
+        n_threads=1,
+    )
+    correspondence = out_arrays = None
+    for shm in shms:
+        shm.close()
+
+
+def _init_query_worker(spec, query_kwargs):
+    shms, arrays = _attach_shared_arrays(spec)
+    _WORKER_STATE.update(
+        shms=shms,
+        arrays=arrays,
+        source_tree=cKDTree(arrays["source_halo_data_block"]),
+        query_kwargs=query_kwargs,
+    )
+
+
+def _query_partition(args):
+    istart, iend, seed = args
+    arrays = _WORKER_STATE["arrays"]
+    X_target = arrays["target_halo_data_block"][istart:iend]
+    query_kwargs = dict(_WORKER_STATE["query_kwargs"], seed=seed)
+    dd_match, indx_match = _query_source_tree(
+        _WORKER_STATE["source_tree"], X_target, 1, **query_kwargs
+    )
+    arrays["dd_match"][istart:iend] = dd_match
+    arrays["indx_match"][istart:iend] = indx_match
+
+
+def shared_memory_halo_correspondence(
+    source_halo_props, target_halo_props, n_procs=None, **query_kwargs
+):
+    """Process-pool version of calculate_halo_correspondence
+
+    Parameters
+    ----------
+    source_halo_props : sequence of n_props ndarrays
+        Each ndarray should have shape (n_source_halos, )
+
+    target_halo_props : sequence of n_props ndarrays
+        Each ndarray should have shape (n_target_halos, )
+
+    n_procs : int, optional
+        Number of worker processes. Default is os.cpu_count()
+
+    **query_kwargs : optional
+        match_mode, eps, distance_upper_bound, k, weighting and seed.
+        See :func:`~galsampler.galmatch.calculate_halo_correspondence`.
+        Each worker draws its random numbers from an independent generator
+        spawned from seed.
+
+    Returns
+    -------
+    dd_match : ndarray of shape (n_target_halos, )
+        Euclidean distance to the source halo matched to each target halo
+
+    indx_match : ndarray of shape (n_target_halos, )
+        Index of the source halo matched to each target halo
+
+    Notes
+    -----
+    The properties are stacked once into C-contiguous blocks in shared memory.
+    Each worker builds the KD-tree once from the shared source block,
+    and queries slices of the shared target block, writing its results
+    directly into shared output arrays. No property array is ever pickled.
+
+    """
+    assert len(source_halo_props) == len(target_halo_props)
+    n_procs = multiprocessing.cpu_count() if n_procs is None else n_procs
+    n_target_halos = len(target_halo_props[0])
+    bounds = _partition_bounds(n_target_halos, n_procs)
+    seeds = _spawn_seeds(query_kwargs.pop("seed", None), n_procs)
+    partitions = list(zip(bounds[:-1], bounds[1:], seeds))
+
+    shared = _SharedArrays()
+    try:
+        shared.data_block("source_halo_data_block", source_halo_props)
+        shared.data_block("target_halo_data_block", target_halo_props)
+        shared.empty("dd_match", n_target_halos, "f8")
+        shared.empty("indx_match", n_target_halos, "i8")
+
+        initargs = (dict(shared.spec), query_kwargs)
+        with _pool(n_procs, _init_query_worker, initargs) as pool:
+            pool.map(_query_partition, partitions)
+
+        dd_match = np.copy(shared.arrays["dd_match"])
+        indx_match = np.copy(shared.arrays["indx_match"])
+    finally:
+        shared.release()
+
+    return dd_match, indx_match
+
+
+def galsample_multiprocessing(
+    source_index, target_halo_ids, target_halo_props, n_procs=None, **match_kwargs
+):
+    """Multi-process version of galsample distributing the target halos
+    across worker processes on a single node
+
+    Parameters
+    ----------
+    source_index : SourceHaloIndex
+
+    target_halo_ids : ndarray of shape (n_target_halos, )
+
+    target_halo_props : sequence of n_props ndarrays
+        Sequence of n_props of ndarrays, each with shape (n_target_halos, )
+
+    n_procs : int, optional
+        Number of worker processes. Default is os.cpu_count()
+
+    **match_kwargs : optional
+        Keyword arguments passed to :meth:`SourceHaloIndex.match_target_halos`.
+        Each worker draws its random numbers from an independent generator
+        spawned from seed.
+
+    Returns
+    -------
+    correspondence : GalsamplerCorrespondence
+        Identical to source_index.galsample(target_halo_ids, target_halo_props)
+        unless match_kwargs draws random neighbors
+
+    Notes
+    -----
+    The source index and the target halos are copied once into shared memory,
+    from which every worker maps them without pickling.
+    The target halos are split into n_procs contiguous slices, so catalogs
+    sorted by spatial position are partitioned spatially.
+    Each worker first matches its slice of target halos to source halos.
+    The offset of each slice in the output arrays is then given by the
+    cumulative sum of the number of galaxies in each slice,
+    and each worker writes the galaxies of its slice
+    directly into output arrays allocated in shared memory.
+
+    Workers are started with the spawn method, so scripts calling this function
+    must protect their entry point with ``if __name__ == "__main__":``.
+
+    """
+    n_procs = multiprocessing.cpu_count() if n_procs is None else n_procs
+    target_halo_ids = _native_byteorder(np.atleast_1d(target_halo_ids))
+    n_target_halos = target_halo_ids.size
+    bounds = _partition_bounds(n_target_halos, n_procs)
+    partitions = list(zip(bounds[:-1], bounds[1:]))
+    seeds = _spawn_seeds(match_kwargs.pop("seed", None), n_procs)
+
+    shared = _SharedArrays()
+    try:
+        source_arrays, metadata = source_index._get_state()
+        for key, arr in source_arrays.items():
+            shared.copy(key, arr)
+        shared.copy("target_halo_ids", target_halo_ids)
+        shared.data_block("target_halo_data_block", target_halo_props)
+        source_halo_selection_indices = shared.empty(
+            "source_halo_selection_indices", n_target_halos, "i8"
+        )
+
+        initargs = (dict(shared.spec), metadata, match_kwargs)
+        with _pool(n_procs, _init_galsample_worker, initargs) as pool:
+            match_tasks = [
+                (istart, iend, seed) for (istart, iend), seed in zip(partitions, seeds)
+            ]
+            pool.map(_match_partition, match_tasks)
+
+            #  Prefix sum over the number of galaxies in each partition
+            target_halo_richness = source_index.target_halo_richness(
+                source_halo_selection_indices
+            )
+            cumulative_richness = np.zeros(n_target_halos + 1, dtype="i8")
+            np.cumsum(target_halo_richness, out=cumulative_richness[1:])
+            first_target_gals = cumulative_richness[bounds]
+            num_target_gals = int(first_target_gals[-1])
+
+            dtypes = (
+                source_index.idx_sorted_source_galaxies.dtype,
+                target_halo_ids.dtype,
+                source_index.source_halo_ids.dtype,
+            )
+            for key, dtype in zip(GalsamplerCorrespondence._fields, dtypes):
+                shared.empty(key, num_target_gals, dtype)
+            fields = GalsamplerCorrespondence._fields
+            out_spec = {key: shared.spec[key] for key in fields}
+
+            tasks = [
+                (istart, iend, first_target_gals[ipart], out_spec)
+                for ipart, (istart, iend) in enumerate(partitions)
+            ]
+            pool.map(_fill_partition, tasks)
+
+        result = GalsamplerCorrespondence(
+            *(np.copy(shared.arrays[key]) for key in GalsamplerCorrespondence._fields)
+        )
+    finally:
+        source_halo_selection_indices = None
+        shared.release()
+
+    return result
+
+
+def galsample_mpi(
+    comm, source_index, target_halo_ids, target_halo_props, n_threads=-1, **match_kwargs
+):
+    """MPI version of galsample in which each rank processes its own target halos
+
+    Parameters
+    ----------
+    comm : mpi4py.MPI.Comm
+        Communicator, e.g., MPI.COMM_WORLD
+
+    source_index : SourceHaloIndex
+        Source index available on every rank. Large source catalogs are best shared
+        by writing the index once with SourceHaloIndex.save, and calling
+        SourceHaloIndex.load on every rank to memory-map the same files.
+
+    target_halo_ids : ndarray of shape (n_target_halos_rank, )
+        Target halos of this rank, e.g., the halos in the spatial subvolume of the rank
+
+    target_halo_props : sequence of n_props ndarrays
+        Sequence of n_props of ndarrays, each with shape (n_target_halos_rank, )
+
+    n_threads : int, optional
+        Number of threads used by each rank. Default is -1 for all cores.
+
+    **match_kwargs : optional
+        Keyword arguments passed to :meth:`SourceHaloIndex.match_target_halos`
+
+    Returns
+    -------
+    correspondence : GalsamplerCorrespondence
+        Correspondence for the target halos of this rank
+
+    first_target_gal : int
+        Index of the first galaxy of this rank in the global target galaxy catalog
+        formed by concatenating the galaxies of all ranks in rank order
+
+    num_target_gals_total : int
+        Number of target galaxies summed over all ranks
+
+    """
+    correspondence = source_index.galsample(
+        target_halo_ids, target_halo_props, n_threads, **match_kwargs
+    )
+    num_target_gals = correspondence.target_gals_selection_indx.size
+
+    #  Exclusive prefix sum over ranks. exscan returns None on rank 0
+    first_target_gal = comm.exscan(num_target_gals)
+    first_target_gal = 0 if first_target_gal is None else first_target_gal
+    num_target_gals_total = comm.allreduce(num_target_gals)
+
+    return correspondence, first_target_gal, num_target_gals_total
@@ -1,11 +1,24 @@
 """Module implementing the galsample function
 used for galsampling
 """
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy.spatial import cKDTree
-from numba import njit
+from numba import njit, prange
 from collections import namedtuple
-from .crossmatch import crossmatch, compute_richness
+from .crossmatch import crossmatch, compute_group_boundaries
+from .crossmatch import _native_byteorder, _numba_threads, _as_common_integer_arrays
+from .crossmatch import _check_unique_ids
+from .crossmatch import GroupBoundaries
+from .profiling import _get_profiler
+
+MatchDistanceStats = namedtuple(
+    "MatchDistanceStats",
+    ["n_matched", "n_unmatched", "mean", "median", "max"],
+)
 
 GalsamplerCorrespondence = namedtuple(
     "GalsamplerCorrespondence",
@@ -16,7 +29,44 @@ GalsamplerCorrespondence = namedtuple(
     ],
 )
 
-__all__ = ("galsample", "calculate_halo_correspondence")
+__all__ = (
+    "galsample",
+    "galsample_chunks",
+    "iter_target_halo_chunks",
+    "calculate_halo_correspondence",
+    "SourceHaloIndex",
+    "CorrespondenceBuffer",
+    "CompactCorrespondence",
+    "PropertyTransform",
+    "match_distance_stats",
+)
+
+MATCH_MODES = ("exact", "approximate")
+
+#  Default tolerance of match_mode="approximate": the matched source halo is at most
+#  a factor of (1 + eps) further away than the true nearest neighbor
+DEFAULT_APPROXIMATE_EPS = 0.5
+
+MATCH_METHODS = ("kdtree", "searchsorted", "grid", "auto")
+
+#  Integer dtype of index arrays selected by index_dtype="auto"
+INDEX_DTYPE_AUTO = "auto"
+
+#  Average number of source halos per cell of the grid used by method="grid"
+GRID_HALOS_PER_CELL = 4
+
+#  method="grid" falls back to the KD-tree when ties in the halo properties
+#  leave fewer than 1 / GRID_MAX_CELL_LOSS of the intended number of grid cells
+GRID_MAX_CELL_LOSS = 16
+
+NEIGHBOR_WEIGHTINGS = ("uniform", "distance")
+
+TRANSFORM_KINDS = ("standardize", "whiten")
+
+#  Number of rows of a data block transformed at a time by PropertyTransform.apply
+TRANSFORM_BLOCK_SIZE = 2**16
+
+SOURCE_INDEX_MANIFEST = "source_halo_index.json"
 
 
 @njit
@@ -48,11 +98,780 @@ def galaxy_selection_kernel(first_source_gal_indices, richness, n_target_halo, r
                 cur += 1
 
 
-def _get_data_block(*halo_properties):
-    return np.vstack(halo_properties).T
+def _expand_correspondence(
+    source_halo_selection_indices,
+    source_halos_richness,
+    source_halo_first_gal_indices,
+    source_halo_ids,
+    idx_sorted_source_galaxies,
+    target_halo_ids,
+    target_halo_gal_offsets,
+    target_gals_selection_indx,
+    target_gals_target_halo_ids,
+    target_gals_source_halo_ids,
+):
+    """Fill in all three arrays of GalsamplerCorrespondence in a single pass
+
+    Parameters
+    ----------
+    source_halo_selection_indices : ndarray of shape (n_target_halos, )
+        Index of the source halo matched to each target halo,
+        or -1 for unmatched target halos, which receive no galaxies
+
+    source_halos_richness : ndarray of shape (n_source_halos, )
+
+    source_halo_first_gal_indices : ndarray of shape (n_source_halos, )
+        Index of the first resident galaxy of each source halo
+        in the sorted source galaxy catalog
+
+    source_halo_ids : ndarray of shape (n_source_halos, )
+
+    idx_sorted_source_galaxies : ndarray of shape (n_source_gals, )
+        Permutation that sorts the source galaxies by host halo ID
+
+    target_halo_ids : ndarray of shape (n_target_halos, )
+
+    target_halo_gal_offsets : ndarray of shape (n_target_halos, )
+        Index of the first galaxy of each target halo in the output arrays,
+        i.e., the exclusive cumulative sum of the target halo richness
+
+    target_gals_selection_indx : ndarray of shape (n_target_gals, )
+        Output array
+
+    target_gals_target_halo_ids : ndarray of shape (n_target_gals, )
+        Output array
+
+    target_gals_source_halo_ids : ndarray of shape (n_target_gals, )
+        Output array
+
+    """
+    n_target_halos = source_halo_selection_indices.shape[0]
+    for i in prange(n_target_halos):
+        isource = source_halo_selection_indices[i]
+        if isource < 0:
+            continue
+        n = source_halos_richness[isource]
+        ifirst = source_halo_first_gal_indices[isource]
+        cur = target_halo_gal_offsets[i]
+        target_halo_id = target_halo_ids[i]
+        source_halo_id = source_halo_ids[isource]
+        for j in range(n):
+            target_gals_selection_indx[cur + j] = idx_sorted_source_galaxies[ifirst + j]
+            target_gals_target_halo_ids[cur + j] = target_halo_id
+            target_gals_source_halo_ids[cur + j] = source_halo_id
+
+
+#  The serial kernel releases the GIL, so that independent calls can run
+#  concurrently in a thread pool, e.g., one per snapshot of a lightcone
+galsample_expansion_kernel = njit(nogil=True)(_expand_correspondence)
+galsample_expansion_kernel_parallel = njit(parallel=True)(_expand_correspondence)
+
+
+@njit(nogil=True)
+def _uniform_hash(seed, i, j):
+    """Uniform random number in [0, 1) determined by the counters (seed, i, j),
+    computed with the SplitMix64 finalizer so that no generator state is shared
+    between threads
+    """
+    z = np.uint64(seed)
+    z += np.uint64(i) * np.uint64(0x9E3779B97F4A7C15)
+    z += np.uint64(j) * np.uint64(0xD1B54A32D192ED03)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)) * 2.0**-53
+
+
+def _count_kept_galaxies(
+    source_halo_selection_indices,
+    source_halos_richness,
+    source_halo_first_gal_indices,
+    idx_sorted_source_galaxies,
+    keep_probability,
+    target_halo_counters,
+    seed,
+    target_halo_richness,
+):
+    """First pass of the thinned expansion: number of galaxies of each target halo
+    that survive the keep probability of their source galaxy
+
+    Parameters
+    ----------
+    keep_probability : ndarray of shape (n_source_gals, )
+        Probability of keeping each source galaxy, in the original catalog order
+
+    target_halo_counters : ndarray of shape (n_target_halos, )
+        Counter of each target halo, combined with seed and the rank of the galaxy
+        within its halo to draw the random number of each target galaxy
+
+    seed : int
+
+    target_halo_richness : ndarray of shape (n_target_halos, )
+        Output array
+
+    See _expand_correspondence for the other arguments.
+
+    """
+    n_target_halos = source_halo_selection_indices.shape[0]
+    for i in prange(n_target_halos):
+        isource = source_halo_selection_indices[i]
+        n_kept = 0
+        if isource >= 0:
+            ifirst = source_halo_first_gal_indices[isource]
+            for j in range(source_halos_richness[isource]):
+                igal = idx_sorted_source_galaxies[ifirst + j]
+                u = _uniform_hash(seed, target_halo_counters[i], j)
+                if u < keep_probability[igal]:
+                    n_kept += 1
+        target_halo_richness[i] = n_kept
+
+
+def _expand_thinned_correspondence(
+    source_halo_selection_indices,
+    source_halos_richness,
+    source_halo_first_gal_indices,
+    source_halo_ids,
+    idx_sorted_source_galaxies,
+    target_halo_ids,
+    target_halo_gal_offsets,
+    keep_probability,
+    target_halo_counters,
+    seed,
+    target_gals_selection_indx,
+    target_gals_target_halo_ids,
+    target_gals_source_halo_ids,
+):
+    """Second pass of the thinned expansion: fill in the galaxies kept by
+    _count_kept_galaxies, drawing the same random numbers
+
+    See _expand_correspondence and _count_kept_galaxies for the arguments.
+
+    """
+    n_target_halos = source_halo_selection_indices.shape[0]
+    for i in prange(n_target_halos):
+        isource = source_halo_selection_indices[i]
+        if isource < 0:
+            continue
+        ifirst = source_halo_first_gal_indices[isource]
+        cur = target_halo_gal_offsets[i]
+        target_halo_id = target_halo_ids[i]
+        source_halo_id = source_halo_ids[isource]
+        for j in range(source_halos_richness[isource]):
+            igal = idx_sorted_source_galaxies[ifirst + j]
+            u = _uniform_hash(seed, target_halo_counters[i], j)
+            if u < keep_probability[igal]:
+                target_gals_selection_indx[cur] = igal
+                target_gals_target_halo_ids[cur] = target_halo_id
+                target_gals_source_halo_ids[cur] = source_halo_id
+                cur += 1
+
+
+count_kept_galaxies_kernel = njit(nogil=True)(_count_kept_galaxies)
+count_kept_galaxies_kernel_parallel = njit(parallel=True)(_count_kept_galaxies)
+thinned_expansion_kernel = njit(nogil=True)(_expand_thinned_correspondence)
+thinned_expansion_kernel_parallel = njit(parallel=True)(
+    _expand_thinned_correspondence
+)
+
+
+@njit(nogil=True)
+def _target_halo_uniforms(seed, target_rows, out):
+    """Random number of each target halo, determined by its row
+    in the full target catalog so that chunks draw the same numbers
+    """
+    for i in range(out.shape[0]):
+        out[i] = _uniform_hash(seed, target_rows[i], 0)
+
+
+def _target_halo_subsample(
+    n_target_halos, target_halo_mask, target_fraction, seed, first_target_row=0
+):
+    """Boolean mask of the target halos kept by the subsampling options,
+    or None if all target halos are kept
+    """
+    keep = None
+    if target_halo_mask is not None:
+        keep = np.asarray(target_halo_mask, dtype=bool)
+        if keep.shape != (n_target_halos,):
+            msg = "Input target_halo_mask has shape {0} but there are {1} target halos"
+            raise ValueError(msg.format(keep.shape, n_target_halos))
+    if target_fraction is not None:
+        if not 0 < target_fraction <= 1:
+            msg = "Input target_fraction = {0} must be in the range (0, 1]"
+            raise ValueError(msg.format(target_fraction))
+        uniforms = np.empty(n_target_halos)
+        target_rows = np.arange(first_target_row, first_target_row + n_target_halos)
+        _target_halo_uniforms(seed, target_rows, uniforms)
+        in_fraction = uniforms < target_fraction
+        keep = in_fraction if keep is None else keep & in_fraction
+    return keep
+
+
+def _get_keep_probability(keep_probability, n_source_gals):
+    """Per-galaxy keep probability broadcast to shape (n_source_gals, )"""
+    keep_probability = np.asarray(keep_probability, dtype="f8")
+    if keep_probability.ndim > 1 or keep_probability.size not in (1, n_source_gals):
+        msg = (
+            "Input keep_probability must be a scalar or have shape ({0}, ), "
+            "one value per source galaxy"
+        )
+        raise ValueError(msg.format(n_source_gals))
+    return np.broadcast_to(keep_probability, (n_source_gals,))
+
+
+def _get_data_block(*halo_properties, out=None):
+    """Stack the input properties into a C-contiguous array of shape (n, n_props),
+    written column by column so that cKDTree can use the array without copying it
+    """
+    n_props = len(halo_properties)
+    if out is None:
+        out = np.empty((len(halo_properties[0]), n_props), dtype=np.float64)
+    for iprop, prop in enumerate(halo_properties):
+        out[:, iprop] = prop
+    return out
+
+
+class PropertyTransform:
+    """Affine transformation of halo properties fitted on the source halos,
+    so that every property contributes comparably to the matching distance
+
+    Parameters
+    ----------
+    kind : string, optional
+        Either "standardize", which subtracts the mean and divides by the standard
+        deviation of each property, or "whiten", which also removes the
+        correlations between properties using the Cholesky factor of their
+        covariance matrix. Default is "standardize".
+
+    Attributes
+    ----------
+    mean : ndarray of shape (n_props, )
+
+    matrix : ndarray of shape (n_props, n_props)
+        Transformed properties are given by (X - mean) @ matrix.T
+
+    Examples
+    --------
+    >>> X_source = np.random.normal((10, 0.1), (1, 0.01), size=(100, 2))
+    >>> transform = PropertyTransform("whiten").fit(X_source)
+    >>> X_target = np.random.normal((10, 0.1), (1, 0.01), size=(500, 2))
+    >>> X_target = transform.apply(X_target)
+
+    Notes
+    -----
+    As with a zero standard deviation in "standardize", the "whiten" transform
+    leaves unscaled the directions of zero variance of constant or collinear
+    properties, whose covariance matrix has no Cholesky factor. The remaining
+    directions are whitened using the eigendecomposition of the covariance matrix.
+
+    """
+
+    def __init__(self, kind="standardize"):
+        if kind not in TRANSFORM_KINDS:
+            msg = "Input transform = `{0}` must be one of {1}"
+            raise ValueError(msg.format(kind, TRANSFORM_KINDS))
+        self.kind = kind
+        self.mean = None
+        self.matrix = None
+
+    def fit(self, X):
+        """Fit the transformation to the data block X of shape (n, n_props)"""
+        self.mean = np.mean(X, axis=0)
+        if self.kind == "standardize":
+            std = np.std(X, axis=0)
+            std[std == 0] = 1.0
+            self.matrix = np.diag(1.0 / std)
+        else:
+            cov = np.atleast_2d(np.cov(X, rowvar=False))
+            self.matrix = _whitening_matrix(cov)
+        return self
+
+    def apply(self, X, block_size=TRANSFORM_BLOCK_SIZE):
+        """Transform the data block X of shape (n, n_props) in place
+
+        The rows of X are processed in blocks, so that the temporary memory
+        does not grow with the size of X.
+
+        Returns
+        -------
+        X : ndarray of shape (n, n_props)
+            The input array, overwritten with the transformed properties
+
+        """
+        if self.mean is None:
+            raise ValueError("PropertyTransform must be fitted before it is applied")
+        is_diagonal = self.kind == "standardize"
+        scale = np.diag(self.matrix)
+        for istart in range(0, X.shape[0], block_size):
+            block = X[istart:][:block_size]
+            block -= self.mean
+            if is_diagonal:
+                block *= scale
+            else:
+                block[:] = block @ self.matrix.T
+        return X
+
+    def _get_state(self):
+        arrays = dict(transform_mean=self.mean, transform_matrix=self.matrix)
+        return arrays, self.kind
+
+    @classmethod
+    def _from_state(cls, arrays, kind):
+        transform = cls(kind)
+        transform.mean = np.asarray(arrays["transform_mean"])
+        transform.matrix = np.asarray(arrays["transform_matrix"])
+        return transform
+
+
+def _whitening_matrix(cov):
+    """Matrix W such that W @ cov @ W.T is the identity, except for zeros
+    along the null directions of a singular covariance matrix
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(cov)
+    tol = max(eigenvalues.max(), 0.0) * cov.shape[0] * np.finfo(cov.dtype).eps
+    is_null = eigenvalues <= tol
+    if not np.any(is_null):
+        return np.linalg.inv(np.linalg.cholesky(cov))
+    eigenvalues[is_null] = 1.0
+    return (eigenvectors / np.sqrt(eigenvalues)).T
+
+
+def _get_transform(transform, X_source):
+    """Fit a transform to X_source, unless transform is None or already fitted"""
+    if transform is None:
+        return None
+    if not isinstance(transform, PropertyTransform):
+        transform = PropertyTransform(transform)
+    if transform.mean is None:
+        transform.fit(X_source)
+    return transform
+
+
+def _query_source_tree(
+    source_tree,
+    X_target,
+    n_threads=-1,
+    match_mode="exact",
+    eps=None,
+    distance_upper_bound=np.inf,
+    k=1,
+    weighting="uniform",
+    seed=None,
+    target_rows=None,
+):
+    """Nearest-neighbor query of the source tree, with -1 marking target halos
+    with no source halo within distance_upper_bound.
+    For k > 1, one of the k nearest neighbors is drawn at random for each target,
+    see _draw_neighbor for target_rows.
+    """
+    eps = _match_eps(match_mode, eps)
+    if weighting not in NEIGHBOR_WEIGHTINGS:
+        msg = "Input weighting = `{0}` must be one of {1}"
+        raise ValueError(msg.format(weighting, NEIGHBOR_WEIGHTINGS))
+    if k < 1:
+        raise ValueError("Number of neighbors k = {0} must be positive".format(k))
+    k = min(k, source_tree.n)
+
+    dd_match, indx_match = source_tree.query(
+        X_target,
+        k=k,
+        eps=eps,
+        distance_upper_bound=distance_upper_bound,
+        workers=n_threads,
+    )
+    if k > 1:
+        dd_match, indx_match = _draw_neighbor(
+            dd_match, indx_match, weighting, seed, target_rows
+        )
+    if np.isfinite(distance_upper_bound):
+        indx_match[indx_match == source_tree.n] = -1
+    return dd_match, indx_match
+
+
+def _draw_neighbor(
+    dd_neighbors, indx_neighbors, weighting="uniform", seed=None, target_rows=None
+):
+    """Draw one of the k neighbors of each target at random
+
+    Parameters
+    ----------
+    dd_neighbors, indx_neighbors : ndarrays of shape (n_target, k)
+        Output of cKDTree.query, with np.inf distances for missing neighbors
+
+    weighting : string, optional
+        "uniform" draws each neighbor with equal probability, and "distance"
+        with probability proportional to the inverse distance, in which case
+        neighbors at zero distance are drawn with equal probability among them
+
+    seed : int or numpy.random.Generator, optional
+
+    target_rows : ndarray of shape (n_target, ), optional
+        Row of each target in the full target catalog. The random number of each
+        target only depends on seed and its row, so that chunks of the target
+        catalog draw the same numbers as the full catalog.
+        Default is None for np.arange(n_target).
+
+    Returns
+    -------
+    dd_match, indx_match : ndarrays of shape (n_target, )
+
+    """
+    valid = np.isfinite(dd_neighbors)
+    if weighting == "distance":
+        with np.errstate(divide="ignore"):
+            weights = np.where(valid, 1.0 / dd_neighbors, 0.0)
+        has_exact_match = dd_neighbors[:, 0] == 0
+        weights[has_exact_match] = dd_neighbors[has_exact_match] == 0
+    else:
+        weights = valid.astype("f8")
+
+    cumulative_weights = np.cumsum(weights, axis=1)
+    n_target = dd_neighbors.shape[0]
+    if target_rows is None:
+        target_rows = np.arange(n_target)
+    u = np.empty(n_target)
+    _target_halo_uniforms(np.random.default_rng(seed).integers(2**63), target_rows, u)
+    u *= cumulative_weights[:, -1]
+    choice = np.count_nonzero(cumulative_weights <= u[:, np.newaxis], axis=1)
+    choice = np.minimum(choice, dd_neighbors.shape[1] - 1)
+
+    irow = np.arange(dd_neighbors.shape[0])
+    return dd_neighbors[irow, choice], indx_neighbors[irow, choice]
+
+
+def _match_eps(match_mode, eps):
+    """Validate match_mode and return the tolerance of the nearest-neighbor search"""
+    if match_mode not in MATCH_MODES:
+        msg = "Input match_mode = `{0}` must be one of {1}"
+        raise ValueError(msg.format(match_mode, MATCH_MODES))
+    if eps is None:
+        eps = DEFAULT_APPROXIMATE_EPS if match_mode == "approximate" else 0.0
+    elif match_mode == "exact" and eps != 0:
+        raise ValueError("Nonzero eps requires match_mode='approximate'")
+    return eps
+
+
+def _searchsorted_correspondence(
+    x_source, x_target, distance_upper_bound=np.inf, random_ties=False, seed=None
+):
+    """Exact nearest-value search of a single halo property
+    by binary search of the sorted source values
+
+    When random_ties is True, the matched source halo is drawn with equal probability
+    from all source halos equally close to the target halo.
+    Otherwise, the first of them in the source catalog is selected.
+    """
+    idx_sorted = np.argsort(x_source, kind="stable")
+    x_source_sorted = x_source[idx_sorted]
+    n_source = x_source_sorted.size
+
+    ipos = np.searchsorted(x_source_sorted, x_target)
+    ileft = np.maximum(ipos - 1, 0)
+    iright = np.minimum(ipos, n_source - 1)
+    dd_left = np.abs(x_target - x_source_sorted[ileft])
+    dd_right = np.abs(x_source_sorted[iright] - x_target)
+    dd_match = np.minimum(dd_left, dd_right)
+
+    #  Equally close source halos form the contiguous range [lo, hi) of sorted values
+    left_run = np.searchsorted(x_source_sorted, x_source_sorted[ileft], "left")
+    right_run = np.searchsorted(x_source_sorted, x_source_sorted[iright], "right")
+    lo = np.where(dd_left <= dd_right, left_run, iright)
+    hi = np.where(dd_right <= dd_left, right_run, ileft + 1)
+
+    if random_ties:
+        rng = np.random.default_rng(seed)
+        choice = lo + (rng.random(lo.size) * (hi - lo)).astype(lo.dtype)
+        choice = np.minimum(choice, hi - 1)
+    else:
+        choice = lo
+    indx_match = idx_sorted[choice]
+
+    unmatched = dd_match >= distance_upper_bound
+    dd_match[unmatched] = np.inf
+    indx_match[unmatched] = -1
+    return dd_match, indx_match
+
+
+@njit
+def _scan_grid_cell(icell, cell_offsets, X_source_sorted, x, y, best_d2, best):
+    for j in range(cell_offsets[icell], cell_offsets[icell + 1]):
+        dx = X_source_sorted[j, 0] - x
+        dy = X_source_sorted[j, 1] - y
+        d2 = dx * dx + dy * dy
+        if d2 < best_d2:
+            best_d2 = d2
+            best = j
+    return best_d2, best
+
+
+def _query_quantile_grid(
+    X_source_sorted,
+    cell_offsets,
+    xedges,
+    yedges,
+    X_target,
+    ix_target,
+    iy_target,
+    eps,
+    distance_upper_bound,
+    dd_match,
+    indx_match,
+):
+    """Nearest-neighbor search of two halo properties on a grid of quantile bins
+
+    Parameters
+    ----------
+    X_source_sorted : ndarray of shape (n_source_halos, 2)
+        Source halo properties sorted by grid cell
+
+    cell_offsets : ndarray of shape (nx * ny + 1, )
+        Source halos of cell ix * ny + iy are stored in the range
+        [cell_offsets[icell], cell_offsets[icell + 1]) of X_source_sorted
+
+    xedges, yedges : ndarrays of shape (nx + 1, ) and (ny + 1, )
+        Quantile bin edges of the source halo properties
+
+    X_target : ndarray of shape (n_target_halos, 2)
+
+    ix_target, iy_target : ndarrays of shape (n_target_halos, )
+        Grid cell of each target halo, clipped to the grid
+
+    eps : float
+        Search is stopped once no unvisited cell can be closer
+        by more than a factor of (1 + eps)
+
+    distance_upper_bound : float
+
+    dd_match : ndarray of shape (n_target_halos, )
+        Output array
+
+    indx_match : ndarray of shape (n_target_halos, )
+        Output array storing the row of X_source_sorted, or -1 if unmatched
+
+    Notes
+    -----
+    Cells are visited in square rings of increasing size around the cell of each
+    target halo. After each ring, the distance to the boundary of the visited cells
+    bounds the distance to every unvisited source halo from below.
+
+    """
+    nx = xedges.size - 1
+    ny = yedges.size - 1
+    tolerance = (1.0 + eps) * (1.0 + eps)
+    for i in prange(X_target.shape[0]):
+        x = X_target[i, 0]
+        y = X_target[i, 1]
+        ix = ix_target[i]
+        iy = iy_target[i]
+        best_d2 = distance_upper_bound * distance_upper_bound
+        best = -1
+        r = 0
+        while True:
+            for jx in range(max(ix - r, 0), min(ix + r, nx - 1) + 1):
+                if abs(jx - ix) == r:
+                    for jy in range(max(iy - r, 0), min(iy + r, ny - 1) + 1):
+                        best_d2, best = _scan_grid_cell(
+                            jx * ny + jy,
+                            cell_offsets,
+                            X_source_sorted,
+                            x,
+                            y,
+                            best_d2,
+                            best,
+                        )
+                else:
+                    if iy - r >= 0:
+                        best_d2, best = _scan_grid_cell(
+                            jx * ny + iy - r,
+                            cell_offsets,
+                            X_source_sorted,
+                            x,
+                            y,
+                            best_d2,
+                            best,
+                        )
+                    if iy + r < ny:
+                        best_d2, best = _scan_grid_cell(
+                            jx * ny + iy + r,
+                            cell_offsets,
+                            X_source_sorted,
+                            x,
+                            y,
+                            best_d2,
+                            best,
+                        )
+
+            #  Lower bound on the distance to any cell outside the visited rings
+            lower_bound = np.inf
+            if ix - r > 0:
+                lower_bound = min(lower_bound, x - xedges[ix - r])
+            if ix + r < nx - 1:
+                lower_bound = min(lower_bound, xedges[ix + r + 1] - x)
+            if iy - r > 0:
+                lower_bound = min(lower_bound, y - yedges[iy - r])
+            if iy + r < ny - 1:
+                lower_bound = min(lower_bound, yedges[iy + r + 1] - y)
+            if lower_bound == np.inf:
+                break
+            lower_bound = max(lower_bound, 0.0)
+            if best_d2 <= tolerance * lower_bound * lower_bound:
+                break
+            r += 1
+
+        if best >= 0:
+            dd_match[i] = np.sqrt(best_d2)
+        else:
+            dd_match[i] = np.inf
+        indx_match[i] = best
+
+
+grid_query_kernel = njit(_query_quantile_grid)
+grid_query_kernel_parallel = njit(parallel=True)(_query_quantile_grid)
+
+
+def _quantile_edges(x, n_bins):
+    """Distinct quantile bin edges of x, with at least one bin"""
+    edges = np.unique(np.quantile(x, np.linspace(0, 1, n_bins + 1)))
+    if edges.size == 1:
+        edges = np.repeat(edges, 2)
+    return edges
+
+
+def _grid_correspondence(
+    X_source, X_target, n_threads=-1, eps=0.0, distance_upper_bound=np.inf
+):
+    """Nearest-neighbor search of two halo properties
+    on a grid of quantile bins of the source halo properties
+    """
+    n_source = X_source.shape[0]
+    n_cells = max(1, n_source // GRID_HALOS_PER_CELL)
+    n_bins = max(1, int(np.sqrt(n_cells)))
+    xedges = _quantile_edges(X_source[:, 0], n_bins)
+    yedges = _quantile_edges(X_source[:, 1], n_bins)
+
+    #  Quantile edges of a discrete property collapse onto its distinct values,
+    #  so spend the cells that are lost to ties on the other property
+    if yedges.size - 1 < n_bins:
+        xedges = _quantile_edges(X_source[:, 0], n_cells // (yedges.size - 1))
+    elif xedges.size - 1 < n_bins:
+        yedges = _quantile_edges(X_source[:, 1], n_cells // (xedges.size - 1))
+    nx, ny = xedges.size - 1, yedges.size - 1
+
+    #  When both properties are heavily tied, most cells would hold many halos
+    #  and the ring search would scan most of the catalog for each target halo
+    if nx * ny * GRID_MAX_CELL_LOSS < n_cells:
+        return _query_source_tree(
+            cKDTree(X_source),
+            X_target,
+            n_threads,
+            match_mode="approximate",
+            eps=eps,
+            distance_upper_bound=distance_upper_bound,
+        )
+
+    def _cells(X):
+        ix = np.searchsorted(xedges, X[:, 0], "right") - 1
+        iy = np.searchsorted(yedges, X[:, 1], "right") - 1
+        return np.clip(ix, 0, nx - 1), np.clip(iy, 0, ny - 1)
+
+    ix_source, iy_source = _cells(X_source)
+    source_cells = ix_source * ny + iy_source
+    idx_sorted = np.argsort(source_cells, kind="stable")
+    cell_offsets = np.zeros(nx * ny + 1, dtype="i8")
+    np.cumsum(np.bincount(source_cells, minlength=nx * ny), out=cell_offsets[1:])
+    X_source_sorted = np.ascontiguousarray(X_source[idx_sorted])
+
+    ix_target, iy_target = _cells(X_target)
+    dd_match = np.empty(X_target.shape[0])
+    indx_sorted = np.empty(X_target.shape[0], dtype="i8")
+    args = (
+        X_source_sorted,
+        cell_offsets,
+        xedges,
+        yedges,
+        X_target,
+        ix_target,
+        iy_target,
+        float(eps),
+        float(distance_upper_bound),
+        dd_match,
+        indx_sorted,
+    )
+    if n_threads == 1:
+        grid_query_kernel(*args)
+    else:
+        with _numba_threads(n_threads):
+            grid_query_kernel_parallel(*args)
+
+    indx_match = np.where(indx_sorted >= 0, idx_sorted[indx_sorted], -1)
+    return dd_match, indx_match
+
 
+def _resolve_match_method(method, n_props, n_procs=None, k=1):
+    """Validate method and select the engine of method="auto" """
+    if method not in MATCH_METHODS:
+        msg = "Input method = `{0}` must be one of {1}"
+        raise ValueError(msg.format(method, MATCH_METHODS))
+    if method == "auto":
+        if n_procs is not None or n_props > 2 or k > 1:
+            return "kdtree"
+        return "searchsorted" if n_props == 1 else "grid"
+    if method == "searchsorted" and n_props != 1:
+        raise ValueError("method='searchsorted' requires a single halo property")
+    if method == "grid" and n_props != 2:
+        raise ValueError("method='grid' requires exactly two halo properties")
+    if method != "kdtree" and n_procs is not None:
+        raise ValueError("n_procs requires method='kdtree'")
+    if method != "kdtree" and k > 1:
+        raise ValueError("k > 1 requires method='kdtree'")
+    return method
 
-def calculate_halo_correspondence(source_halo_props, target_halo_props, n_threads=-1):
+
+def match_distance_stats(dd_match):
+    """Summary statistics of the distances between matched source and target halos
+
+    Parameters
+    ----------
+    dd_match : ndarray of shape (n_target_halos, )
+        Distances returned by calculate_halo_correspondence,
+        with np.inf for unmatched target halos
+
+    Returns
+    -------
+    stats : MatchDistanceStats
+        namedtuple storing the number of matched and unmatched target halos,
+        and the mean, median and maximum distance of the matched target halos
+
+    """
+    dd_match = np.asarray(dd_match)
+    dd_matched = dd_match[np.isfinite(dd_match)]
+    n_matched = dd_matched.size
+    if n_matched == 0:
+        return MatchDistanceStats(0, dd_match.size, np.nan, np.nan, np.nan)
+    return MatchDistanceStats(
+        n_matched,
+        dd_match.size - n_matched,
+        float(np.mean(dd_matched)),
+        float(np.median(dd_matched)),
+        float(np.max(dd_matched)),
+    )
+
+
+def calculate_halo_correspondence(
+    source_halo_props,
+    target_halo_props,
+    n_threads=-1,
+    n_procs=None,
+    match_mode="exact",
+    eps=None,
+    distance_upper_bound=np.inf,
+    method="kdtree",
+    random_ties=False,
+    seed=None,
+    k=1,
+    weighting="uniform",
+    transform=None,
+):
     """Calculating indexing array defined by a statistical correspondence between
     source and target halos.
 
@@ -64,21 +883,132 @@ def calculate_halo_correspondence(source_halo_props, target_halo_props, n_thread
     target_halo_props : sequence of n_props ndarrays
         Each ndarray should have shape (n_target_halos, )
 
+    n_threads : int, optional
+        Number of threads used in the search. Default is -1 for all cores.
+
+    n_procs : int, optional
+        If not None, the query is distributed across n_procs worker processes
+        sharing the property arrays through shared memory.
+        See :func:`~galsampler.distributed.shared_memory_halo_correspondence`.
+        Default is None.
+
+    match_mode : string, optional
+        Either "exact" for an exact nearest-neighbor search, or "approximate",
+        in which case the matched source halo may be up to a factor of (1 + eps)
+        further away than the nearest one, in exchange for a faster search.
+        Default is "exact".
+
+    eps : float, optional
+        Tolerance of match_mode="approximate". Default is DEFAULT_APPROXIMATE_EPS.
+
+    distance_upper_bound : float, optional
+        Target halos with no source halo within this distance are left unmatched,
+        which also speeds up the search. Default is np.inf.
+
+    method : string, optional
+        Search engine. Options are:
+
+        - "kdtree": KD-tree query, valid for any number of halo properties
+        - "searchsorted": binary search of the sorted source values,
+          for a single halo property
+        - "grid": ring search on a grid of quantile bins of the source halos,
+          for two halo properties
+        - "auto": "searchsorted" for one property, "grid" for two,
+          and "kdtree" otherwise or when n_procs is set
+
+        Default is "kdtree".
+
+    random_ties : bool, optional
+        Only used by method="searchsorted". If True, each target halo is matched
+        with equal probability to any of the equally close source halos,
+        e.g., source halos with identical values of a discrete property.
+        Otherwise, the first of them in the source catalog is selected.
+        Default is False.
+
+    seed : int or numpy.random.Generator, optional
+        Seed of the random tie-breaking and of the draw among k neighbors.
+        Default is None.
+
+    k : int, optional
+        If k > 1, each target halo is matched to a source halo drawn at random
+        from its k nearest neighbors, so that a dense region of target halos is not
+        matched over and over to the same few source halos. Requires method="kdtree".
+        Default is 1 for the nearest neighbor.
+
+    weighting : string, optional
+        Probability of drawing each of the k neighbors. Either "uniform",
+        or "distance" for a probability proportional to the inverse distance.
+        Default is "uniform".
+
+    transform : string or PropertyTransform, optional
+        If "standardize" or "whiten", the halo properties are transformed
+        by a :class:`PropertyTransform` fitted to the source halos before matching,
+        and dd_match is measured in the transformed space. Default is None.
+
     Returns
     -------
     dd_match : ndarray of shape (n_target_halos, )
-        Euclidean distance to the source halo matched to each target halo
+        Euclidean distance to the source halo matched to each target halo,
+        or np.inf for unmatched target halos
 
     indx_match : ndarray of shape (n_target_halos, )
-        Index of the source halo matched to each target halo
+        Index of the source halo matched to each target halo,
+        or -1 for unmatched target halos
+
+    Notes
+    -----
+    Use :func:`match_distance_stats` to summarize the accuracy of the matches.
+
+    All methods find the exact nearest neighbor when match_mode="exact",
+    and differ only in the choice among equally close source halos.
 
     """
     assert len(source_halo_props) == len(target_halo_props)
-    X_source = _get_data_block(*source_halo_props)
-    X_target = _get_data_block(*target_halo_props)
+    method = _resolve_match_method(method, len(source_halo_props), n_procs, k)
+    query_kwargs = dict(
+        match_mode=match_mode,
+        eps=eps,
+        distance_upper_bound=distance_upper_bound,
+        k=k,
+        weighting=weighting,
+        seed=seed,
+    )
+    X_source = X_target = None
+    if transform is not None:
+        X_source = _get_data_block(*source_halo_props)
+        X_target = _get_data_block(*target_halo_props)
+        transform = _get_transform(transform, X_source)
+        transform.apply(X_source)
+        transform.apply(X_target)
+        source_halo_props, target_halo_props = tuple(X_source.T), tuple(X_target.T)
+
+    if n_procs is not None:
+        from .distributed import shared_memory_halo_correspondence
+
+        return shared_memory_halo_correspondence(
+            source_halo_props, target_halo_props, n_procs, **query_kwargs
+        )
+
+    if method == "searchsorted":
+        _match_eps(match_mode, eps)
+        return _searchsorted_correspondence(
+            np.asarray(source_halo_props[0], dtype="f8"),
+            np.asarray(target_halo_props[0], dtype="f8"),
+            distance_upper_bound,
+            random_ties=random_ties,
+            seed=seed,
+        )
+
+    if X_source is None:
+        X_source = _get_data_block(*source_halo_props)
+        X_target = _get_data_block(*target_halo_props)
+    if method == "grid":
+        eps = _match_eps(match_mode, eps)
+        return _grid_correspondence(
+            X_source, X_target, n_threads, eps, distance_upper_bound
+        )
     source_tree = cKDTree(X_source)
-    dd_match, indx_match = source_tree.query(X_target, workers=n_threads)
-    return dd_match, indx_match
+    return _query_source_tree(source_tree, X_target, n_threads, **query_kwargs)
 
 
 def galsample(
@@ -87,6 +1017,13 @@ def galsample(
     target_halo_ids,
     source_halo_props,
     target_halo_props,
+    n_threads=-1,
+    presorted=False,
+    return_match_stats=False,
+    index_dtype="i8",
+    profile=None,
+    transform=None,
+    **match_kwargs,
 ):
     """Calculate the indexing array that transfers source galaxies to target halos
 
@@ -111,6 +1048,44 @@ def galsample(
         Sequence of n_props of ndarrays, each with shape (n_target_halos, )
         These properties determine the correspondence between source and target halos
 
+    n_threads : int, optional
+        Number of threads used to build the source index, in the KD-tree query
+        and in the galaxy selection. Default is -1 for all cores.
+        The result does not depend on n_threads.
+
+    presorted : bool, optional
+        If True, source_galaxies_host_halo_id must already be sorted in ascending order,
+        e.g., for catalogs written grouped by host halo.
+        The argsort of the source galaxies is then skipped. Default is False.
+
+    return_match_stats : bool, optional
+        If True, also return the MatchDistanceStats of the halo correspondence.
+        Default is False.
+
+    index_dtype : string or numpy dtype, optional
+        Integer dtype of target_gals_selection_indx and of the source-side index
+        arrays. Use "i4" or "auto" to halve their memory. Default is "i8".
+        See :class:`SourceHaloIndex`.
+
+    profile : StageProfiler, optional
+        If not None, the wall time, peak memory and array size of each stage
+        are recorded in profile, e.g., the argsort of the source galaxies,
+        the KD-tree build and query, and the galaxy selection kernel.
+        See :class:`~galsampler.profiling.StageProfiler`. Default is None.
+
+    transform : string or PropertyTransform, optional
+        Transform of the halo properties, e.g., "standardize" so that properties
+        with different scales contribute comparably to the matching distance.
+        See :class:`SourceHaloIndex`. Default is None.
+
+    **match_kwargs : optional
+        Keyword arguments controlling the halo correspondence, passed to
+        :meth:`SourceHaloIndex.match_target_halos`, e.g., match_mode="approximate"
+        or distance_upper_bound. Unmatched target halos receive no galaxies.
+        Also accepts the subsampling options of :meth:`SourceHaloIndex.galsample`
+        for quick preview catalogs: target_halo_mask, target_fraction,
+        keep_probability and subsample_seed.
+
     Returns
     -------
     target_gals_selection_indx : ndarray of shape (n_target_gals, )
@@ -122,78 +1097,1164 @@ def galsample(
     target_galaxy_source_halo_ids : ndarray of shape (n_target_gals, )
         Integer array storing values appearing in source_halo_ids
 
-    """
-    #  Sort the source galaxies so that members of a common halo are grouped together
-    idx_sorted_source_galaxies = np.argsort(source_galaxies_host_halo_id)
-    sorted_source_galaxies_host_halo_id = source_galaxies_host_halo_id[
-        idx_sorted_source_galaxies
-    ]
+    match_stats : MatchDistanceStats
+        Only returned if return_match_stats is True
 
-    #  Calculate the index correspondence array that will undo the sorting at the end
-    num_source_gals = len(source_galaxies_host_halo_id)
-    idx_unsorted_galaxy_indices = np.arange(num_source_gals).astype("i8")[
-        idx_sorted_source_galaxies
-    ]
+    Notes
+    -----
+    When the same source catalog is used with many different target catalogs,
+    build a :class:`SourceHaloIndex` once and call its ``galsample`` method instead,
+    so that the source-side bookkeeping and the KD-tree are only computed once.
 
-    #  For each source halo, calculate the number of resident galaxies
-    source_halos_richness = compute_richness(
-        source_halo_ids, sorted_source_galaxies_host_halo_id
+    """
+    source_index = SourceHaloIndex(
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        source_halo_props,
+        presorted,
+        index_dtype,
+        profile,
+        transform,
+        n_threads,
     )
-
-    #  For each source halo, calculate the index of its first resident galaxy
-    source_halo_sorted_source_galaxies_indices = _galaxy_table_indices(
-        source_halo_ids, sorted_source_galaxies_host_halo_id
+    return source_index.galsample(
+        target_halo_ids,
+        target_halo_props,
+        n_threads,
+        return_match_stats=return_match_stats,
+        profile=profile,
+        **match_kwargs,
     )
 
-    #  For each target halo, calculate the index of the associated source halo
-    __, source_halo_selection_indices = calculate_halo_correspondence(
-        source_halo_props, target_halo_props
-    )
 
-    #  For each target halo, calculate the number of galaxies
-    target_halo_richness = source_halos_richness[source_halo_selection_indices]
-    num_target_gals = np.sum(target_halo_richness)
+def galsample_chunks(
+    source_galaxies_host_halo_id,
+    source_halo_ids,
+    source_halo_props,
+    target_halo_chunks,
+    n_threads=-1,
+    presorted=False,
+    index_dtype="i8",
+    transform=None,
+    **match_kwargs,
+):
+    """Generator version of galsample that processes the target halos in chunks
 
-    #  For each target halo, calculate the halo ID of the associated source halo
-    target_halo_source_halo_ids = source_halo_ids[source_halo_selection_indices]
+    Parameters
+    ----------
+    source_galaxies_host_halo_id : ndarray of shape (n_source_gals, )
 
-    #  For each target halo, calculate the index of its first resident galaxy
-    target_halo_first_sorted_source_gal_indices = (
-        source_halo_sorted_source_galaxies_indices[source_halo_selection_indices]
-    )
+    source_halo_ids : ndarray of shape (n_source_halos, )
 
-    #  For every target halo, we know the index of the first and last galaxy to select
-    #  Calculate an array of shape (num_target_gals, )
-    # with the index of each selected galaxy
-    n_target_halos = target_halo_ids.size
-    sorted_source_galaxy_selection_indices = np.zeros(num_target_gals).astype(int)
-    galaxy_selection_kernel(
-        target_halo_first_sorted_source_gal_indices.astype("i8"),
-        target_halo_richness.astype("i4"),
-        n_target_halos,
-        sorted_source_galaxy_selection_indices,
-    )
+    source_halo_props : sequence of n_props ndarrays
+        Sequence of n_props of ndarrays, each with shape (n_source_halos, )
 
-    #  For each target galaxy, calculate the halo ID of its source and target halo
-    target_gals_target_halo_ids = np.repeat(target_halo_ids, target_halo_richness)
-    target_gals_source_halo_ids = np.repeat(
-        target_halo_source_halo_ids, target_halo_richness
-    )
+    target_halo_chunks : iterable
+        Each element is a two-element tuple (target_halo_ids, target_halo_props)
+        storing a chunk of the target halo catalog.
+        See :func:`iter_target_halo_chunks` for chunking in-memory arrays.
+
+    n_threads : int, optional
+        Number of threads. Default is -1 for all cores.
+
+    presorted : bool, optional
+        If True, source_galaxies_host_halo_id must already be sorted in ascending order.
+        Default is False.
+
+    index_dtype : string or numpy dtype, optional
+        See :class:`SourceHaloIndex`. Default is "i8".
+
+    transform : string or PropertyTransform, optional
+        See :class:`SourceHaloIndex`. Default is None.
+
+    **match_kwargs : optional
+        Keyword arguments passed to :meth:`SourceHaloIndex.galsample_chunks`,
+        e.g., the options of :meth:`SourceHaloIndex.match_target_halos`
+        or the subsampling options of :meth:`SourceHaloIndex.galsample`
+
+    Yields
+    ------
+    correspondence : GalsamplerCorrespondence
+        Correspondence for the target halos in the chunk.
+        The target_gals_selection_indx always index the full source galaxy catalog,
+        so that concatenating the yielded chunks gives the same result as
+        calling :func:`galsample` on the concatenated target halos. With k > 1
+        or subsampling, this requires passing integers as seed and subsample_seed.
+        Seeds left to None or passed as a numpy.random.Generator are drawn once
+        and shared by all chunks.
 
-    #  For each index in the sorted galaxy catalog,
-    #  calculate the index of the catalog in its original order
-    target_gals_selection_indx = idx_unsorted_galaxy_indices[
-        sorted_source_galaxy_selection_indices
-    ]
+    Notes
+    -----
+    Peak memory is set by the size of the source catalog and the chunk size,
+    rather than by the size of the target catalog.
 
-    return GalsamplerCorrespondence(
-        target_gals_selection_indx,
-        target_gals_target_halo_ids,
-        target_gals_source_halo_ids,
+    """
+    source_index = SourceHaloIndex(
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        source_halo_props,
+        presorted,
+        index_dtype,
+        transform=transform,
+        n_threads=n_threads,
+    )
+    yield from source_index.galsample_chunks(
+        target_halo_chunks, n_threads, **match_kwargs
     )
 
 
-def _galaxy_table_indices(source_halo_id, galaxy_host_halo_id):
+def iter_target_halo_chunks(target_halo_ids, target_halo_props, chunk_size):
+    """Iterate over chunks of a target halo catalog
+
+    Parameters
+    ----------
+    target_halo_ids : ndarray of shape (n_target_halos, )
+
+    target_halo_props : sequence of n_props ndarrays
+        Sequence of n_props of ndarrays, each with shape (n_target_halos, )
+
+    chunk_size : int
+        Maximum number of target halos in each chunk
+
+    Yields
+    ------
+    chunk : tuple
+        Two-element tuple (target_halo_ids, target_halo_props) storing
+        views into the input arrays. Arrays such as h5py datasets or np.memmap
+        are only read one chunk at a time.
+
+    """
+    n_target_halos = len(target_halo_ids)
+    for istart in range(0, n_target_halos, chunk_size):
+        iend = min(istart + chunk_size, n_target_halos)
+        chunk_ids = target_halo_ids[istart:iend]
+        chunk_props = tuple(prop[istart:iend] for prop in target_halo_props)
+        yield chunk_ids, chunk_props
+
+
+class SourceHaloIndex:
+    """Source-side data structures used by galsample, computed once and reused
+
+    Parameters
+    ----------
+    source_galaxies_host_halo_id : ndarray of shape (n_source_gals, )
+        Integer array storing the value of the halo ID
+        of the source halo of each source galaxy
+        Each entry in source_galaxies_host_halo_id must appear in source_halo_ids
+
+    source_halo_ids : ndarray of shape (n_source_halos, )
+
+    source_halo_props : sequence of n_props ndarrays
+        Sequence of n_props of ndarrays, each with shape (n_source_halos, )
+        These properties determine the correspondence between source and target halos
+
+    presorted : bool, optional
+        If True, source_galaxies_host_halo_id must already be sorted in ascending order,
+        and the argsort of the source galaxies is skipped. Default is False.
+
+    index_dtype : string or numpy dtype, optional
+        Signed integer dtype of the galaxy-length index arrays, including the
+        target_gals_selection_indx returned by galsample. Use "i4" to halve their
+        memory for catalogs with fewer than 2**31 source galaxies, or "auto"
+        to select "i4" whenever the size of the source catalog allows it.
+        Default is "i8".
+
+    profile : StageProfiler, optional
+        If not None, each stage of the construction of the index is recorded
+        in profile. See :class:`~galsampler.profiling.StageProfiler`.
+        Default is None.
+
+    transform : string or PropertyTransform, optional
+        If "standardize" or "whiten", a :class:`PropertyTransform` is fitted
+        to the source halo properties, applied to them before building the KD-tree,
+        and cached to be applied in place to every block of target halo properties.
+        A fitted PropertyTransform is used as is.
+        Default is None for matching on the raw properties.
+
+    n_threads : int, optional
+        Number of threads used to build the index. Default is -1 for all cores.
+        With n_threads=1, no parallel Numba kernel is started.
+
+    Attributes
+    ----------
+    idx_sorted_source_galaxies : ndarray of shape (n_source_gals, )
+        Permutation that groups together source galaxies sharing a common host
+
+    source_halos_richness : ndarray of shape (n_source_halos, )
+        Number of source galaxies residing in each source halo
+
+    source_halo_first_gal_indices : ndarray of shape (n_source_halos, )
+        Index of the first resident galaxy of each source halo
+        in the sorted source galaxy catalog, or -1 for empty source halos
+
+    source_tree : scipy.spatial.cKDTree
+        KD-tree built from source_halo_props, after the transform if any
+
+    transform : PropertyTransform or None
+
+    checksum : str
+        Hash of source_galaxies_host_halo_id and source_halo_ids,
+        used to detect a stale on-disk cache written by :meth:`save`.
+        Computed in a background thread while the source galaxies are sorted.
+
+    Examples
+    --------
+    >>> n_source_halos, n_target_halos = 100, 500
+    >>> source_halo_ids = np.arange(n_source_halos)
+    >>> source_galaxies_host_halo_id = np.repeat(source_halo_ids, 3)
+    >>> source_halo_props = (np.random.uniform(10, 15, n_source_halos), )
+    >>> source_index = SourceHaloIndex(
+    ...     source_galaxies_host_halo_id, source_halo_ids, source_halo_props)
+    >>> target_halo_ids = np.arange(n_target_halos)
+    >>> target_halo_props = (np.random.uniform(10, 15, n_target_halos), )
+    >>> res = source_index.galsample(target_halo_ids, target_halo_props)
+    """
+
+    def __init__(
+        self,
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        source_halo_props,
+        presorted=False,
+        index_dtype="i8",
+        profile=None,
+        transform=None,
+        n_threads=-1,
+    ):
+        source_galaxies_host_halo_id = np.atleast_1d(source_galaxies_host_halo_id)
+        #  The Numba kernels require IDs in native byte order,
+        #  whereas FITS and some HDF5 catalogs store big-endian IDs
+        self.source_halo_ids = _native_byteorder(np.atleast_1d(source_halo_ids))
+        msg = "Input source_halo_ids must store unique IDs"
+        _check_unique_ids(self.source_halo_ids, msg)
+        self.n_props = len(source_halo_props)
+        n_source_gals = source_galaxies_host_halo_id.size
+        n_source_halos = self.source_halo_ids.size
+        index_dtype = _get_index_dtype(index_dtype, n_source_gals)
+        profile = _get_profiler(profile)
+
+        #  Hashing and sorting both release the GIL, so that the checksum
+        #  is computed in a background thread while the galaxies are sorted
+        executor = ThreadPoolExecutor(max_workers=1)
+        checksum = executor.submit(
+            _ids_checksum, source_galaxies_host_halo_id, self.source_halo_ids
+        )
+        executor.shutdown(wait=False)
+
+        #  Sort the source galaxies so that members of a common halo are grouped together
+        #  Since the permutation indexes np.arange(n_source_gals), it also serves as
+        #  the correspondence array that undoes the sorting at the end
+        with profile.stage("source_index.argsort", n_items=n_source_gals):
+            if presorted:
+                host_id = source_galaxies_host_halo_id
+                if np.any(host_id[1:] < host_id[:-1]):
+                    msg = "presorted=True requires sorted source_galaxies_host_halo_id"
+                    raise ValueError(msg)
+                self.idx_sorted_source_galaxies = np.arange(
+                    n_source_gals, dtype=index_dtype
+                )
+                sorted_source_galaxies_host_halo_id = source_galaxies_host_halo_id
+            else:
+                self.idx_sorted_source_galaxies = np.argsort(
+                    source_galaxies_host_halo_id
+                ).astype(index_dtype, copy=False)
+                sorted_source_galaxies_host_halo_id = source_galaxies_host_halo_id[
+                    self.idx_sorted_source_galaxies
+                ]
+
+        #  Find the boundaries of each group of galaxies sharing a common host
+        #  in a single linear scan, reused by all the bookkeeping below
+        with profile.stage("source_index.group_boundaries", n_items=n_source_gals):
+            group_boundaries = compute_group_boundaries(
+                sorted_source_galaxies_host_halo_id
+            )
+
+        #  For each source halo, calculate the number of resident galaxies
+        #  and the index of the first one, from a single crossmatch
+        with profile.stage("source_index.compute_richness", n_items=n_source_halos):
+            (
+                self.source_halos_richness,
+                self.source_halo_first_gal_indices,
+            ) = _match_source_halo_groups(
+                self.source_halo_ids, group_boundaries, index_dtype, n_threads
+            )
+
+        with profile.stage("source_index.tree_build", n_items=n_source_halos):
+            X_source = _get_data_block(*source_halo_props)
+            self.transform = _get_transform(transform, X_source)
+            if self.transform is not None:
+                self.transform.apply(X_source)
+            self.source_tree = cKDTree(X_source)
+
+        self.checksum = checksum.result()
+
+    def save(self, dirname):
+        """Write the source index to a directory of .npy files plus a JSON manifest
+
+        Parameters
+        ----------
+        dirname : string
+            Directory in which to store the index. Created if it does not exist.
+            Existing files written by a previous call to save will be overwritten.
+
+        """
+        os.makedirs(dirname, exist_ok=True)
+        arrays, metadata = self._get_state()
+        for name, arr in arrays.items():
+            np.save(os.path.join(dirname, name + ".npy"), arr)
+
+        manifest = dict(
+            n_source_gals=int(self.n_source_gals),
+            n_source_halos=int(self.n_source_halos),
+            arrays=sorted(arrays.keys()),
+            checksum=self.checksum,
+            **metadata,
+        )
+        with open(os.path.join(dirname, SOURCE_INDEX_MANIFEST), "w") as fout:
+            json.dump(manifest, fout, indent=2)
+
+    @classmethod
+    def load(
+        cls,
+        dirname,
+        source_galaxies_host_halo_id=None,
+        source_halo_ids=None,
+        mmap_mode="r",
+    ):
+        """Load a source index previously written by :meth:`save`
+
+        Parameters
+        ----------
+        dirname : string
+            Directory passed to :meth:`save`
+
+        source_galaxies_host_halo_id : ndarray of shape (n_source_gals, ), optional
+            When passed together with source_halo_ids, the arrays are checksummed
+            and compared against the manifest to verify the cache is not stale
+
+        source_halo_ids : ndarray of shape (n_source_halos, ), optional
+
+        mmap_mode : string, optional
+            Passed to np.load. Default is "r", so that the galaxy-length arrays
+            are memory-mapped rather than read into memory.
+            Use None to load the arrays into memory.
+
+        Returns
+        -------
+        source_index : SourceHaloIndex
+
+        """
+        with open(os.path.join(dirname, SOURCE_INDEX_MANIFEST), "r") as fin:
+            manifest = json.load(fin)
+
+        if source_galaxies_host_halo_id is not None and source_halo_ids is not None:
+            checksum = _ids_checksum(source_galaxies_host_halo_id, source_halo_ids)
+            if checksum != manifest["checksum"]:
+                msg = "Source index stored in `{0}` is stale: input ID arrays differ"
+                raise ValueError(msg.format(dirname))
+
+        arrays = dict()
+        for name in manifest["arrays"]:
+            fn = os.path.join(dirname, name + ".npy")
+            arrays[name] = np.load(fn, mmap_mode=mmap_mode)
+
+        return cls._from_state(arrays, manifest)
+
+    def _get_state(self):
+        """Arrays and JSON-serializable metadata that fully determine the index"""
+        arrays = dict(
+            idx_sorted_source_galaxies=self.idx_sorted_source_galaxies,
+            source_halo_ids=self.source_halo_ids,
+            source_halos_richness=self.source_halos_richness,
+            source_halo_first_gal_indices=self.source_halo_first_gal_indices,
+            source_halo_data_block=self.source_tree.data,
+        )
+        metadata = dict(n_props=self.n_props, transform=None)
+        if self.transform is not None:
+            transform_arrays, metadata["transform"] = self.transform._get_state()
+            arrays.update(transform_arrays)
+        return arrays, metadata
+
+    @classmethod
+    def _from_state(cls, arrays, metadata):
+        """Inverse of _get_state. The KD-tree is rebuilt from the source data block."""
+        source_index = cls.__new__(cls)
+        source_index.n_props = metadata["n_props"]
+        source_index.checksum = metadata.get("checksum")
+        source_index.idx_sorted_source_galaxies = arrays["idx_sorted_source_galaxies"]
+        source_index.source_halo_ids = arrays["source_halo_ids"]
+        source_index.source_halos_richness = arrays["source_halos_richness"]
+        source_index.source_halo_first_gal_indices = arrays[
+            "source_halo_first_gal_indices"
+        ]
+        source_index.source_tree = cKDTree(arrays["source_halo_data_block"])
+        source_index.transform = None
+        if metadata.get("transform") is not None:
+            source_index.transform = PropertyTransform._from_state(
+                arrays, metadata["transform"]
+            )
+        return source_index
+
+    @property
+    def n_source_gals(self):
+        return self.idx_sorted_source_galaxies.size
+
+    @property
+    def n_source_halos(self):
+        return self.source_halo_ids.size
+
+    def galsample(
+        self,
+        target_halo_ids,
+        target_halo_props,
+        n_threads=-1,
+        return_match_stats=False,
+        profile=None,
+        target_halo_mask=None,
+        target_fraction=None,
+        keep_probability=None,
+        subsample_seed=None,
+        first_target_row=0,
+        **match_kwargs,
+    ):
+        """Calculate the indexing array that transfers source galaxies to target halos
+
+        Parameters
+        ----------
+        target_halo_ids : ndarray of shape (n_target_halos, )
+
+        target_halo_props : sequence of n_props ndarrays
+            Sequence of n_props of ndarrays, each with shape (n_target_halos, )
+
+        n_threads : int, optional
+            Number of threads used in the KD-tree query and in the galaxy selection.
+            Default is -1 for all cores. The result does not depend on n_threads.
+
+        return_match_stats : bool, optional
+            If True, also return the MatchDistanceStats of the halo correspondence.
+            Default is False.
+
+        profile : StageProfiler, optional
+            If not None, the matching and expansion stages are recorded in profile.
+            Default is None.
+
+        target_halo_mask : ndarray of shape (n_target_halos, ), optional
+            Boolean array, e.g., a mass cut. Target halos where the mask is False
+            are dropped before the matching, and receive no galaxies.
+            Default is None for all target halos.
+
+        target_fraction : float, optional
+            If not None, keep a random fraction of the target halos,
+            in addition to target_halo_mask. Default is None.
+
+        keep_probability : float or ndarray of shape (n_source_gals, ), optional
+            Probability of keeping each copy of a source galaxy in the target catalog,
+            in the original order of the source galaxies. Galaxies are thinned
+            inside the selection kernel, so that the output arrays are
+            only ever allocated for the kept galaxies. Default is None.
+
+        subsample_seed : int, optional
+            Seed of the random numbers of target_fraction and keep_probability.
+            The random number of each target galaxy only depends on subsample_seed,
+            its target halo and its rank in that halo, so that the result
+            does not depend on n_threads. Default is None.
+
+        first_target_row : int, optional
+            Row of the first input target halo in the full target catalog,
+            when the target halos are processed in chunks. Target halos are
+            identified by their row in the random numbers of target_fraction,
+            keep_probability and of the draw among k neighbors, so that the chunks
+            draw the same numbers as a single call on the full catalog.
+            Default is 0.
+
+        **match_kwargs : optional
+            Keyword arguments passed to :meth:`match_target_halos`
+
+        Returns
+        -------
+        correspondence : GalsamplerCorrespondence
+            See :func:`galsample` for a description of each field
+
+        match_stats : MatchDistanceStats
+            Only returned if return_match_stats is True.
+            Halos dropped by target_halo_mask or target_fraction are not counted.
+
+        """
+        target_halo_ids = _native_byteorder(np.atleast_1d(target_halo_ids))
+        profile = _get_profiler(profile)
+
+        #  Drop the target halos excluded by the subsampling options before the query
+        rng = np.random.default_rng(subsample_seed)
+        fraction_seed, thinning_seed = rng.integers(2**63, size=2)
+        keep = _target_halo_subsample(
+            target_halo_ids.size,
+            target_halo_mask,
+            target_fraction,
+            fraction_seed,
+            first_target_row,
+        )
+        target_halo_counters = np.arange(target_halo_ids.size)
+        if keep is not None:
+            target_halo_counters = np.flatnonzero(keep)
+            target_halo_ids = target_halo_ids[keep]
+            target_halo_props = [np.asarray(prop)[keep] for prop in target_halo_props]
+        target_halo_counters += first_target_row
+
+        #  For each target halo, calculate the index of the associated source halo
+        with profile.stage("galsample.tree_query", n_items=target_halo_ids.size):
+            dd_match, source_halo_selection_indices = self.match_target_halos(
+                target_halo_props,
+                n_threads,
+                target_rows=target_halo_counters,
+                **match_kwargs,
+            )
+
+        #  For each target halo, calculate the number of galaxies
+        if keep_probability is None:
+            target_halo_richness = self.target_halo_richness(
+                source_halo_selection_indices
+            )
+        else:
+            keep_probability = _get_keep_probability(
+                keep_probability, self.n_source_gals
+            )
+            thinning = (keep_probability, target_halo_counters, thinning_seed)
+            with profile.stage("galsample.thinning", n_items=target_halo_ids.size):
+                target_halo_richness = self._thinned_richness(
+                    source_halo_selection_indices, *thinning, n_threads
+                )
+        num_target_gals = int(np.sum(target_halo_richness))
+
+        with profile.stage("galsample.selection_kernel", n_items=num_target_gals):
+            correspondence = self._empty_correspondence(
+                num_target_gals, target_halo_ids.dtype
+            )
+            if keep_probability is None:
+                self._fill_correspondence(
+                    target_halo_ids,
+                    source_halo_selection_indices,
+                    correspondence,
+                    0,
+                    n_threads,
+                )
+            else:
+                self._fill_thinned_correspondence(
+                    target_halo_ids,
+                    source_halo_selection_indices,
+                    target_halo_richness,
+                    thinning,
+                    correspondence,
+                    n_threads,
+                )
+        if return_match_stats:
+            return correspondence, match_distance_stats(dd_match)
+        return correspondence
+
+    def galsample_compact(
+        self, target_halo_ids, target_halo_props, n_threads=-1, **match_kwargs
+    ):
+        """Run-length encoded version of :meth:`galsample`
+
+        Parameters
+        ----------
+        target_halo_ids : ndarray of shape (n_target_halos, )
+
+        target_halo_props : sequence of n_props ndarrays
+            Sequence of n_props of ndarrays, each with shape (n_target_halos, )
+
+        n_threads : int, optional
+            Number of threads used in the KD-tree query. Default is -1 for all cores.
+
+        **match_kwargs : optional
+            Keyword arguments passed to :meth:`match_target_halos`
+
+        Returns
+        -------
+        compact_correspondence : CompactCorrespondence
+            Per-halo representation of the result of :meth:`galsample`
+
+        """
+        target_halo_ids = _native_byteorder(np.atleast_1d(target_halo_ids))
+        __, source_halo_selection_indices = self.match_target_halos(
+            target_halo_props, n_threads, **match_kwargs
+        )
+        matched = source_halo_selection_indices >= 0
+        indices = np.where(matched, source_halo_selection_indices, 0)
+        return CompactCorrespondence(
+            self.idx_sorted_source_galaxies,
+            self.source_halo_first_gal_indices[indices],
+            np.where(matched, self.source_halos_richness[indices], 0),
+            self.source_halo_ids[indices],
+            target_halo_ids,
+        )
+
+    def match_target_halos(
+        self,
+        target_halo_props,
+        n_threads=-1,
+        match_mode="exact",
+        eps=None,
+        distance_upper_bound=np.inf,
+        k=1,
+        weighting="uniform",
+        seed=None,
+        target_rows=None,
+    ):
+        """For each target halo, calculate the index of the associated source halo
+
+        Parameters
+        ----------
+        target_halo_props : sequence of n_props ndarrays
+            Sequence of n_props of ndarrays, each with shape (n_target_halos, )
+
+        n_threads : int, optional
+            Number of workers used in the KD-tree query. Default is -1 for all cores.
+
+        match_mode, eps, distance_upper_bound, k, weighting, seed : optional
+            See :func:`calculate_halo_correspondence`.
+            Distances are measured after the transform of the index, if any.
+
+        target_rows : ndarray of shape (n_target_halos, ), optional
+            Row of each target halo in the full target catalog. With k > 1,
+            the draw among the neighbors of each target halo only depends
+            on seed and its row, so that chunks of the target catalog sharing
+            an integer seed draw the same neighbors as the full catalog.
+            Default is None for np.arange(n_target_halos).
+
+        Returns
+        -------
+        dd_match : ndarray of shape (n_target_halos, )
+            Distance to the matched source halo, or np.inf for unmatched target halos
+
+        source_halo_selection_indices : ndarray of shape (n_target_halos, )
+            Integer array storing values in the range [0, n_source_halos-1],
+            or -1 for unmatched target halos
+
+        """
+        assert len(target_halo_props) == self.n_props
+        X_target = _get_data_block(*target_halo_props)
+        if self.transform is not None:
+            self.transform.apply(X_target)
+        return _query_source_tree(
+            self.source_tree,
+            X_target,
+            n_threads,
+            match_mode=match_mode,
+            eps=eps,
+            distance_upper_bound=distance_upper_bound,
+            k=k,
+            weighting=weighting,
+            seed=seed,
+            target_rows=target_rows,
+        )
+
+    def target_halo_richness(self, source_halo_selection_indices):
+        """Number of galaxies of each target halo, zero for unmatched target halos"""
+        source_halo_selection_indices = np.asarray(source_halo_selection_indices)
+        richness = self.source_halos_richness[source_halo_selection_indices]
+        return np.where(source_halo_selection_indices >= 0, richness, 0)
+
+    def _empty_correspondence(self, num_target_gals, target_halo_id_dtype):
+        """Allocate the arrays of a GalsamplerCorrespondence with num_target_gals"""
+        target_halo_id_dtype = np.dtype(target_halo_id_dtype).newbyteorder("=")
+        return GalsamplerCorrespondence(
+            np.empty(num_target_gals, dtype=self.idx_sorted_source_galaxies.dtype),
+            np.empty(num_target_gals, dtype=target_halo_id_dtype),
+            np.empty(num_target_gals, dtype=self.source_halo_ids.dtype),
+        )
+
+    def _fill_correspondence(
+        self,
+        target_halo_ids,
+        source_halo_selection_indices,
+        correspondence,
+        first_target_gal=0,
+        n_threads=-1,
+    ):
+        """Write the galaxies of the input target halos into the arrays of
+        correspondence, starting at index first_target_gal
+        """
+        #  For each target halo, calculate the index of its first galaxy in the output
+        target_halo_richness = self.target_halo_richness(source_halo_selection_indices)
+        target_halo_gal_offsets = np.zeros(target_halo_ids.size, dtype="i8")
+        np.cumsum(target_halo_richness[:-1], out=target_halo_gal_offsets[1:])
+        target_halo_gal_offsets += first_target_gal
+
+        #  For every target halo, we know the index of the first and last galaxy to select
+        #  In a single pass, fill in the index of each selected galaxy
+        #  in the original catalog, as well as the ID of its source and target halo
+        args = (
+            source_halo_selection_indices,
+            np.asarray(self.source_halos_richness),
+            np.asarray(self.source_halo_first_gal_indices),
+            np.asarray(self.source_halo_ids),
+            np.asarray(self.idx_sorted_source_galaxies),
+            _native_byteorder(target_halo_ids),
+            target_halo_gal_offsets,
+            *correspondence,
+        )
+        #  The serial kernel never starts the Numba threading layer,
+        #  so that it is safe to call from forked worker processes
+        if n_threads == 1:
+            galsample_expansion_kernel(*args)
+        else:
+            with _numba_threads(n_threads):
+                galsample_expansion_kernel_parallel(*args)
+
+    def _thinned_richness(
+        self,
+        source_halo_selection_indices,
+        keep_probability,
+        target_halo_counters,
+        seed,
+        n_threads=-1,
+    ):
+        """Number of galaxies of each target halo kept by keep_probability"""
+        target_halo_richness = np.empty(
+            source_halo_selection_indices.size, dtype=self.source_halos_richness.dtype
+        )
+        args = (
+            source_halo_selection_indices,
+            np.asarray(self.source_halos_richness),
+            np.asarray(self.source_halo_first_gal_indices),
+            np.asarray(self.idx_sorted_source_galaxies),
+            keep_probability,
+            target_halo_counters,
+            seed,
+            target_halo_richness,
+        )
+        if n_threads == 1:
+            count_kept_galaxies_kernel(*args)
+        else:
+            with _numba_threads(n_threads):
+                count_kept_galaxies_kernel_parallel(*args)
+        return target_halo_richness
+
+    def _fill_thinned_correspondence(
+        self,
+        target_halo_ids,
+        source_halo_selection_indices,
+        target_halo_richness,
+        thinning,
+        correspondence,
+        n_threads=-1,
+    ):
+        """Write the galaxies kept by _thinned_richness into correspondence,
+        where thinning stores the keep_probability, counters and seed
+        """
+        target_halo_gal_offsets = np.zeros(target_halo_ids.size, dtype="i8")
+        np.cumsum(target_halo_richness[:-1], out=target_halo_gal_offsets[1:])
+        args = (
+            source_halo_selection_indices,
+            np.asarray(self.source_halos_richness),
+            np.asarray(self.source_halo_first_gal_indices),
+            np.asarray(self.source_halo_ids),
+            np.asarray(self.idx_sorted_source_galaxies),
+            target_halo_ids,
+            target_halo_gal_offsets,
+            *thinning,
+            *correspondence,
+        )
+        if n_threads == 1:
+            thinned_expansion_kernel(*args)
+        else:
+            with _numba_threads(n_threads):
+                thinned_expansion_kernel_parallel(*args)
+
+    def galsample_chunks(self, target_halo_chunks, n_threads=-1, **match_kwargs):
+        """Generator calling :meth:`galsample` on each chunk of target halos
+
+        Parameters
+        ----------
+        target_halo_chunks : iterable
+            Each element is a two-element tuple (target_halo_ids, target_halo_props)
+
+        n_threads : int, optional
+            Number of workers used in the KD-tree query. Default is -1 for all cores.
+
+        **match_kwargs : optional
+            Keyword arguments passed to :meth:`galsample`. A target_halo_mask
+            covers the concatenated chunks, and is sliced for each chunk.
+
+        Yields
+        ------
+        correspondence : GalsamplerCorrespondence
+            See :func:`galsample_chunks`
+
+        """
+        #  All chunks share integer seeds and a global row counter, so that
+        #  the subsampling and the draws among k neighbors use the same random numbers
+        #  as a single call on the full catalog
+        for key in ("subsample_seed", "seed"):
+            seed = match_kwargs.get(key)
+            if not isinstance(seed, (int, np.integer)):
+                match_kwargs[key] = np.random.default_rng(seed).integers(2**63)
+        target_halo_mask = match_kwargs.pop("target_halo_mask", None)
+        if target_halo_mask is not None:
+            target_halo_mask = np.asarray(target_halo_mask, dtype=bool)
+
+        first_target_row = 0
+        for target_halo_ids, target_halo_props in target_halo_chunks:
+            n_target_halos = np.size(target_halo_ids)
+            chunk_mask = None
+            if target_halo_mask is not None:
+                chunk_mask = target_halo_mask[first_target_row:][:n_target_halos]
+            yield self.galsample(
+                target_halo_ids,
+                target_halo_props,
+                n_threads,
+                target_halo_mask=chunk_mask,
+                first_target_row=first_target_row,
+                **match_kwargs,
+            )
+            first_target_row += n_target_halos
+
+
+class CorrespondenceBuffer:
+    """Growable GalsamplerCorrespondence for target halos that arrive in batches,
+    e.g., the snapshots of a lightcone processed shell by shell
+
+    Parameters
+    ----------
+    source_index : SourceHaloIndex
+        Source-side structures reused by every call to :meth:`append`
+
+    correspondence : GalsamplerCorrespondence, optional
+        Existing correspondence of previously processed target halos,
+        copied into the buffer. Default is None for an empty buffer.
+
+    capacity : int, optional
+        Initial number of target galaxies that fit in the buffer. Without an
+        existing correspondence, the arrays are only allocated by the first call
+        to :meth:`append` that adds galaxies, once the dtype of the target halo IDs
+        is known. Default is 0.
+
+    Examples
+    --------
+    >>> n_source_halos, n_target_halos = 20, 100
+    >>> source_halo_ids = np.arange(n_source_halos)
+    >>> source_galaxies_host_halo_id = np.repeat(source_halo_ids, 3)
+    >>> source_halo_props = (np.random.uniform(0, 1, n_source_halos), )
+    >>> args = (source_galaxies_host_halo_id, source_halo_ids, source_halo_props)
+    >>> source_index = SourceHaloIndex(*args)
+    >>> buffer = CorrespondenceBuffer(source_index)
+    >>> for __ in range(3):
+    ...     target_halo_ids = np.arange(n_target_halos)
+    ...     target_halo_props = (np.random.uniform(0, 1, n_target_halos), )
+    ...     batch = buffer.append(target_halo_ids, target_halo_props)
+    >>> len(buffer)
+    900
+    >>> res = buffer.correspondence
+
+    Notes
+    -----
+    The arrays of the buffer are over-allocated, and their capacity is doubled
+    whenever a batch does not fit, so that appending a batch costs amortized time
+    proportional to the size of the batch rather than to the size of the buffer.
+
+    The dtype of the target halo IDs of the buffer is that of the existing
+    correspondence, or else that of the first batch with galaxies. The IDs of
+    later batches must be safely castable to this dtype.
+
+    """
+
+    def __init__(self, source_index, correspondence=None, capacity=0):
+        self.source_index = source_index
+        self.size = 0
+        self._arrays = None
+        self._initial_capacity = capacity
+        if correspondence is not None:
+            correspondence = GalsamplerCorrespondence(*correspondence)
+            target_halo_id_dtype = correspondence.target_gals_target_halo_ids.dtype
+            n = correspondence.target_gals_selection_indx.size
+            self._reserve(max(capacity, n), target_halo_id_dtype)
+            for arr, arr_buffer in zip(correspondence, self._arrays):
+                arr_buffer[:n] = arr
+            self.size = n
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        if self._arrays is None:
+            return 0
+        return self._arrays.target_gals_selection_indx.size
+
+    @property
+    def correspondence(self):
+        """GalsamplerCorrespondence storing views of the filled part of the buffer"""
+        if self._arrays is None:
+            return self.source_index._empty_correspondence(0, np.int64)
+        return GalsamplerCorrespondence(*(arr[: self.size] for arr in self._arrays))
+
+    def _reserve(self, capacity, target_halo_id_dtype):
+        """Grow the buffer to hold at least capacity target galaxies"""
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2 * self.capacity, self._initial_capacity)
+        if self._arrays is not None:
+            target_halo_id_dtype = self._arrays.target_gals_target_halo_ids.dtype
+        arrays = self.source_index._empty_correspondence(capacity, target_halo_id_dtype)
+        if self._arrays is not None:
+            for arr, arr_old in zip(arrays, self._arrays):
+                arr[: self.size] = arr_old[: self.size]
+        self._arrays = arrays
+
+    def append(self, target_halo_ids, target_halo_props, n_threads=-1, **match_kwargs):
+        """Append the galaxies of a batch of new target halos to the buffer
+
+        Parameters
+        ----------
+        target_halo_ids : ndarray of shape (n_target_halos, )
+
+        target_halo_props : sequence of n_props ndarrays
+            Sequence of n_props of ndarrays, each with shape (n_target_halos, )
+
+        n_threads : int, optional
+            Number of threads. Default is -1 for all cores.
+
+        **match_kwargs : optional
+            Keyword arguments passed to :meth:`SourceHaloIndex.match_target_halos`
+
+        Returns
+        -------
+        batch : slice
+            Location of the galaxies of the batch in the arrays of the buffer
+
+        """
+        target_halo_ids = _native_byteorder(np.atleast_1d(target_halo_ids))
+        if self._arrays is not None:
+            buffer_dtype = self._arrays.target_gals_target_halo_ids.dtype
+            if not np.can_cast(target_halo_ids.dtype, buffer_dtype, "safe"):
+                msg = (
+                    "Target halo IDs of dtype {0} cannot be safely cast "
+                    "to the dtype {1} of the target halo IDs of the buffer"
+                )
+                raise ValueError(msg.format(target_halo_ids.dtype, buffer_dtype))
+        __, source_halo_selection_indices = self.source_index.match_target_halos(
+            target_halo_props, n_threads, **match_kwargs
+        )
+        target_halo_richness = self.source_index.target_halo_richness(
+            source_halo_selection_indices
+        )
+        num_target_gals = int(np.sum(target_halo_richness))
+
+        first_target_gal = self.size
+        if num_target_gals == 0:
+            #  Nothing to write, and an empty buffer may not be allocated yet
+            return slice(first_target_gal, first_target_gal)
+        self._reserve(first_target_gal + num_target_gals, target_halo_ids.dtype)
+        target_halo_ids = target_halo_ids.astype(
+            self._arrays.target_gals_target_halo_ids.dtype, copy=False
+        )
+        self.source_index._fill_correspondence(
+            target_halo_ids,
+            source_halo_selection_indices,
+            self._arrays,
+            first_target_gal,
+            n_threads,
+        )
+        self.size = first_target_gal + num_target_gals
+        return slice(first_target_gal, self.size)
+
+
+class CompactCorrespondence:
+    """Run-length encoded GalsamplerCorrespondence storing one entry per target halo
+
+    The galaxies of each target halo are a contiguous run of the source galaxies
+    sorted by host halo, so the per-galaxy arrays of GalsamplerCorrespondence
+    are fully determined by the first sorted index, richness, source halo ID
+    and target halo ID of each target halo. The per-galaxy arrays are only
+    expanded on demand, by slice or in chunks.
+
+    Parameters
+    ----------
+    idx_sorted_source_galaxies : ndarray of shape (n_source_gals, )
+        Permutation that sorts the source galaxies by host halo ID.
+        Stored by reference.
+
+    first_sorted_indices : ndarray of shape (n_target_halos, )
+        Index of the first galaxy of each target halo
+        in the sorted source galaxy catalog
+
+    richness : ndarray of shape (n_target_halos, )
+        Number of galaxies of each target halo
+
+    source_halo_ids : ndarray of shape (n_target_halos, )
+        ID of the source halo matched to each target halo
+
+    target_halo_ids : ndarray of shape (n_target_halos, )
+
+    Notes
+    -----
+    Use :meth:`SourceHaloIndex.galsample_compact` to build instances.
+    Memory use is smaller than that of GalsamplerCorrespondence
+    by roughly the mean number of galaxies per target halo.
+
+    """
+
+    def __init__(
+        self,
+        idx_sorted_source_galaxies,
+        first_sorted_indices,
+        richness,
+        source_halo_ids,
+        target_halo_ids,
+    ):
+        self.idx_sorted_source_galaxies = idx_sorted_source_galaxies
+        self.first_sorted_indices = first_sorted_indices
+        self.richness = richness
+        self.source_halo_ids = _native_byteorder(np.asarray(source_halo_ids))
+        self.target_halo_ids = _native_byteorder(np.asarray(target_halo_ids))
+
+        #  Galaxies of target halo i are stored in range(offsets[i], offsets[i + 1])
+        self.offsets = np.zeros(richness.size + 1, dtype="i8")
+        np.cumsum(richness, out=self.offsets[1:])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def n_target_halos(self):
+        return self.richness.size
+
+    @property
+    def nbytes(self):
+        """Memory of the per-halo arrays, excluding the shared permutation"""
+        arrays = (
+            self.first_sorted_indices,
+            self.richness,
+            self.source_halo_ids,
+            self.target_halo_ids,
+            self.offsets,
+        )
+        return sum(arr.nbytes for arr in arrays)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("CompactCorrespondence only supports contiguous slices")
+        start, stop, __ = key.indices(len(self))
+        return self.expand(start, stop)
+
+    def expand(self, start=0, stop=None, n_threads=-1):
+        """Expand the galaxies in range(start, stop) into a GalsamplerCorrespondence
+
+        Parameters
+        ----------
+        start, stop : int, optional
+            Range of target galaxies to expand. Default is all target galaxies.
+
+        n_threads : int, optional
+            Number of threads. Default is -1 for all cores.
+
+        Returns
+        -------
+        correspondence : GalsamplerCorrespondence
+            Equal to the slice [start:stop] of the arrays returned by galsample
+
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        start = min(start, stop)
+
+        #  Target halos with at least one galaxy in range(start, stop)
+        ifirst = np.searchsorted(self.offsets, start, "right") - 1
+        ilast = np.searchsorted(self.offsets, stop, "left")
+        ifirst, ilast = max(ifirst, 0), min(max(ilast, ifirst), self.n_target_halos)
+        halos = slice(ifirst, ilast)
+
+        #  Trim the runs of the first and last target halos to range(start, stop)
+        first_sorted_indices = self.first_sorted_indices[halos].astype("i8")
+        richness = self.richness[halos].astype("i8")
+        if richness.size > 0:
+            n_skip = start - self.offsets[ifirst]
+            first_sorted_indices[0] += n_skip
+            richness[0] -= n_skip
+            richness[-1] -= self.offsets[ilast] - stop
+        gal_offsets = np.zeros(richness.size, dtype="i8")
+        np.cumsum(richness[:-1], out=gal_offsets[1:])
+
+        num_target_gals = stop - start
+        correspondence = GalsamplerCorrespondence(
+            np.empty(num_target_gals, dtype=self.idx_sorted_source_galaxies.dtype),
+            np.empty(num_target_gals, dtype=self.target_halo_ids.dtype),
+            np.empty(num_target_gals, dtype=self.source_halo_ids.dtype),
+        )
+        #  Each target halo plays the role of its own source halo in the kernel
+        args = (
+            np.arange(richness.size),
+            richness,
+            first_sorted_indices,
+            self.source_halo_ids[halos],
+            np.asarray(self.idx_sorted_source_galaxies),
+            self.target_halo_ids[halos],
+            gal_offsets,
+            *correspondence,
+        )
+        if n_threads == 1:
+            galsample_expansion_kernel(*args)
+        else:
+            with _numba_threads(n_threads):
+                galsample_expansion_kernel_parallel(*args)
+        return correspondence
+
+    def iter_chunks(self, chunk_size, n_threads=-1):
+        """Iterate over the target galaxies in chunks of chunk_size galaxies
+
+        Parameters
+        ----------
+        chunk_size : int
+            Number of target galaxies per chunk
+
+        n_threads : int, optional
+            Number of threads. Default is -1 for all cores.
+
+        Yields
+        ------
+        correspondence : GalsamplerCorrespondence
+            Correspondence of the next chunk_size target galaxies
+
+        """
+        for istart in range(0, len(self), chunk_size):
+            yield self.expand(istart, istart + chunk_size, n_threads)
+
+    def to_correspondence(self, n_threads=-1):
+        """Expand all target galaxies into a GalsamplerCorrespondence"""
+        return self.expand(0, len(self), n_threads)
+
+
+def _ids_checksum(source_galaxies_host_halo_id, source_halo_ids):
+    """Hash of the ID arrays that determine the source-side bookkeeping of galsample"""
+    h = hashlib.blake2b(digest_size=16)
+    for arr in (source_galaxies_host_halo_id, source_halo_ids):
+        arr = np.ascontiguousarray(_native_byteorder(np.asarray(arr)))
+        h.update(str((arr.dtype.str, arr.shape)).encode())
+        h.update(memoryview(arr).cast("B"))
+    return h.hexdigest()
+
+
+def _get_index_dtype(index_dtype, n_source_gals):
+    """Validate index_dtype, resolving "auto" to the smallest sufficient dtype"""
+    if isinstance(index_dtype, str) and index_dtype == INDEX_DTYPE_AUTO:
+        return np.dtype("i4") if n_source_gals < 2**31 else np.dtype("i8")
+    index_dtype = np.dtype(index_dtype)
+    if index_dtype.kind != "i":
+        msg = "Input index_dtype = `{0}` must be a signed integer dtype"
+        raise ValueError(msg.format(index_dtype))
+    if n_source_gals > np.iinfo(index_dtype).max:
+        msg = "index_dtype = `{0}` is too small to index {1} source galaxies"
+        raise ValueError(msg.format(index_dtype, n_source_gals))
+    return index_dtype
+
+
+def _galaxy_table_indices(
+    source_halo_id,
+    galaxy_host_halo_id,
+    assume_sorted=False,
+    group_boundaries=None,
+    index_dtype="i8",
+    n_threads=-1,
+):
     """For every halo in the source halo catalog, calculate the index
     in the source galaxy catalog of the first appearance of a galaxy that
     occupies the halo, reserving -1 for source halos with no resident galaxies.
@@ -206,21 +2267,82 @@ def _galaxy_table_indices(source_halo_id, galaxy_host_halo_id):
     galaxy_host_halo_id : ndarray
         Numpy integer array of shape (num_gals, )
 
+    assume_sorted : bool, optional
+        If True, galaxy_host_halo_id is assumed to be sorted in ascending order,
+        and the first appearances are found in a linear scan rather than a sort.
+
+    group_boundaries : GroupBoundaries, optional
+        Output of compute_group_boundaries(galaxy_host_halo_id),
+        for callers that have already computed it
+
+    index_dtype : string or numpy dtype, optional
+        Signed integer dtype of the returned indices. Default is "i8".
+
+    n_threads : int, optional
+        Number of threads of the underlying crossmatch. Default is -1 for all cores.
+
     Returns
     -------
     indices : ndarray
         Numpy integer array of shape (num_halos, ).
         All values will be in the interval [-1, num_gals)
     """
-    uval_gals, indx_uval_gals = np.unique(galaxy_host_halo_id, return_index=True)
-    idxA, idxB = crossmatch(source_halo_id, uval_gals)
-    num_source_halos = len(source_halo_id)
-    indices = np.zeros(num_source_halos) - 1
-    indices[idxA] = indx_uval_gals[idxB]
-    return indices.astype(int)
+    if group_boundaries is None and assume_sorted:
+        group_boundaries = compute_group_boundaries(galaxy_host_halo_id)
+
+    if group_boundaries is None:
+        #  The stable sort keeps the first appearance of each ID first in its group
+        idx_sorted = np.argsort(galaxy_host_halo_id, kind="stable")
+        unique_ids, sorted_first_indices, counts = compute_group_boundaries(
+            galaxy_host_halo_id[idx_sorted]
+        )
+        group_boundaries = GroupBoundaries(
+            unique_ids, idx_sorted[sorted_first_indices], counts
+        )
+    return _match_source_halo_groups(
+        source_halo_id, group_boundaries, index_dtype, n_threads
+    )[1]
+
+
+def _match_source_halo_groups(
+    source_halo_id, group_boundaries, index_dtype="i8", n_threads=-1
+):
+    """Richness and index of the first galaxy of each source halo,
+    derived from a single crossmatch of the source halos to the groups of galaxies
+    """
+    source_halo_id, unique_ids = _as_common_integer_arrays(
+        source_halo_id, group_boundaries.unique_ids
+    )
+    idxA, idxB = crossmatch(
+        source_halo_id,
+        unique_ids,
+        method="auto",
+        validate="none",
+        assume_y_sorted=True,
+        n_threads=n_threads,
+    )
+    richness = np.zeros(source_halo_id.size, dtype=index_dtype)
+    richness[idxA] = group_boundaries.counts[idxB]
+    first_indices = np.full(source_halo_id.size, -1, dtype=index_dtype)
+    first_indices[idxA] = group_boundaries.first_indices[idxB]
+    return richness, first_indices
 
 
-def calculate_indx_correspondence(source_props, target_props, n_threads=-1):
+def calculate_indx_correspondence(
+    source_props,
+    target_props,
+    n_threads=-1,
+    n_procs=None,
+    match_mode="exact",
+    eps=None,
+    distance_upper_bound=np.inf,
+    method="kdtree",
+    random_ties=False,
+    seed=None,
+    k=1,
+    weighting="uniform",
+    transform=None,
+):
     """For each target data object, find a closely matching source data object
 
     Parameters
@@ -231,22 +2353,45 @@ def calculate_indx_correspondence(source_props, target_props, n_threads=-1):
     target_props : list of n_props ndarrays
         Each ndarray should have shape (n_target, )
 
+    n_threads : int, optional
+        Number of workers used in the KD-tree query. Default is -1 for all cores.
+
+    n_procs : int, optional
+        If not None, the query is distributed across n_procs worker processes
+        sharing the property arrays through shared memory. Default is None.
+
+    match_mode, eps, distance_upper_bound : optional
+        See :func:`calculate_halo_correspondence`
+
+    method, random_ties, seed, k, weighting, transform : optional
+        See :func:`calculate_halo_correspondence`
+
     Returns
     -------
     dd_match : ndarray of shape (n_target, )
         Euclidean distance between each target and its matching source object
 
     indx_match : ndarray of shape (n_target, )
-        Index into the source object that is matched to each target
+        Index into the source object that is matched to each target,
+        or -1 for targets with no source object within distance_upper_bound
 
     Notes
     -----
     This function essentially provides wrapper behavior around scipy.spatial.cKDTree
 
     """
-    assert len(source_props) == len(target_props)
-    X_source = _get_data_block(*source_props)
-    X_target = _get_data_block(*target_props)
-    source_tree = cKDTree(X_source)
-    dd_match, indx_match = source_tree.query(X_target, workers=n_threads)
-    return dd_match, indx_match
+    return calculate_halo_correspondence(
+        source_props,
+        target_props,
+        n_threads,
+        n_procs,
+        match_mode=match_mode,
+        eps=eps,
+        distance_upper_bound=distance_upper_bound,
+        method=method,
+        random_ties=random_ties,
+        seed=seed,
+        k=k,
+        weighting=weighting,
+        transform=transform,
+    )
@@ -0,0 +1,170 @@
+"""Module implementing out-of-core access to source galaxy catalogs stored in HDF5.
+Only the columns needed by galsample are read into memory, and galaxy properties
+are transferred to the target catalog with block-wise reads of the HDF5 file.
+"""
+import numpy as np
+from .galmatch import SourceHaloIndex
+
+try:
+    import h5py
+
+    HAS_H5PY = True
+except ImportError:
+    HAS_H5PY = False
+
+__all__ = (
+    "load_hdf5_columns",
+    "source_halo_index_from_hdf5",
+    "materialize_hdf5_columns",
+)
+
+DEFAULT_BLOCK_SIZE = 2**22
+
+
+def _require_h5py():
+    if not HAS_H5PY:
+        msg = "Must have h5py installed to read galsampler catalogs from HDF5"
+        raise ImportError(msg)
+
+
+def load_hdf5_columns(fn, keys, block_size=DEFAULT_BLOCK_SIZE):
+    """Read a few datasets of an HDF5 file into memory, leaving all others on disk
+
+    Parameters
+    ----------
+    fn : string
+        Path to the HDF5 file
+
+    keys : sequence of strings
+        Path of each dataset within the file, e.g., "galaxies/host_halo_id"
+
+    block_size : int, optional
+        Number of rows read from the file at a time
+
+    Returns
+    -------
+    columns : dict
+        Keys are the input keys, values are ndarrays
+
+    """
+    _require_h5py()
+    columns = dict()
+    with h5py.File(fn, "r") as hdf:
+        for key in keys:
+            dset = hdf[key]
+            arr = np.empty(dset.shape, dtype=dset.dtype)
+            for istart in range(0, dset.shape[0], block_size):
+                iend = min(istart + block_size, dset.shape[0])
+                dset.read_direct(arr, np.s_[istart:iend], np.s_[istart:iend])
+            columns[key] = arr
+    return columns
+
+
+def source_halo_index_from_hdf5(
+    fn,
+    source_galaxies_host_halo_id_key,
+    source_halo_ids_key,
+    source_halo_prop_keys,
+    block_size=DEFAULT_BLOCK_SIZE,
+    index_dtype="i8",
+    transform=None,
+):
+    """Build a SourceHaloIndex reading only the required columns of an HDF5 file
+
+    Parameters
+    ----------
+    fn : string
+        Path to the HDF5 file storing the source galaxies and source halos
+
+    source_galaxies_host_halo_id_key : string
+        Path of the dataset storing the host halo ID of each source galaxy
+
+    source_halo_ids_key : string
+        Path of the dataset storing the ID of each source halo
+
+    source_halo_prop_keys : sequence of strings
+        Path of each dataset storing the halo properties
+        that determine the correspondence between source and target halos
+
+    block_size : int, optional
+        Number of rows read from the file at a time
+
+    index_dtype : string or numpy dtype, optional
+        Integer dtype of the index arrays. See :class:`~galsampler.SourceHaloIndex`.
+
+    transform : string or PropertyTransform, optional
+        Transform of the halo properties. See :class:`~galsampler.SourceHaloIndex`.
+
+    Returns
+    -------
+    source_index : SourceHaloIndex
+
+    """
+    keys = [source_galaxies_host_halo_id_key, source_halo_ids_key]
+    keys.extend(source_halo_prop_keys)
+    columns = load_hdf5_columns(fn, keys, block_size=block_size)
+    source_halo_props = [columns[key] for key in source_halo_prop_keys]
+    return SourceHaloIndex(
+        columns[source_galaxies_host_halo_id_key],
+        columns[source_halo_ids_key],
+        source_halo_props,
+        index_dtype=index_dtype,
+        transform=transform,
+    )
+
+
+def materialize_hdf5_columns(
+    fn, target_gals_selection_indx, keys, block_size=DEFAULT_BLOCK_SIZE
+):
+    """Apply target_gals_selection_indx to galaxy columns stored in an HDF5 file
+
+    Parameters
+    ----------
+    fn : string
+        Path to the HDF5 file storing the source galaxies
+
+    target_gals_selection_indx : ndarray of shape (n_target_gals, )
+        Index of the source galaxy of each target galaxy, as returned by galsample
+
+    keys : sequence of strings
+        Path of each galaxy dataset to transfer to the target catalog
+
+    block_size : int, optional
+        Number of rows of the source catalog read from the file at a time
+
+    Returns
+    -------
+    columns : dict
+        Keys are the input keys, values are ndarrays of shape (n_target_gals, )
+
+    Notes
+    -----
+    The selection indices are sorted once, and each dataset is then read
+    in contiguous blocks of rows, skipping blocks with no selected galaxy.
+    This avoids random-access reads of the HDF5 file.
+
+    """
+    _require_h5py()
+    selection_indx = np.asarray(target_gals_selection_indx)
+    idx_sorted = np.argsort(selection_indx, kind="stable")
+    sorted_selection_indx = selection_indx[idx_sorted]
+
+    columns = dict()
+    with h5py.File(fn, "r") as hdf:
+        for key in keys:
+            dset = hdf[key]
+            n_source_gals = dset.shape[0]
+            result = np.empty(
+                (selection_indx.size, *dset.shape[1:]), dtype=dset.dtype
+            )
+
+            for istart in range(0, n_source_gals, block_size):
+                iend = min(istart + block_size, n_source_gals)
+                ilo, ihi = np.searchsorted(sorted_selection_indx, (istart, iend))
+                if ihi > ilo:
+                    block = dset[istart:iend]
+                    block_indx = sorted_selection_indx[ilo:ihi] - istart
+                    result[idx_sorted[ilo:ihi]] = block[block_indx]
+
+            columns[key] = result
+    return columns
@@ -0,0 +1,204 @@
+"""Module implementing a driver of galsample for lightcones built from many snapshots,
+processing the snapshots concurrently within a memory budget.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
+import numpy as np
+from .crossmatch import _common_integer_dtype
+from .galmatch import GalsamplerCorrespondence, SourceHaloIndex
+
+__all__ = ("galsample_lightcone", "LightconeCorrespondence")
+
+LightconeCorrespondence = namedtuple(
+    "LightconeCorrespondence",
+    ["correspondence", "snapshots", "source_gal_offsets", "target_gal_offsets"],
+)
+
+
+def galsample_lightcone(snapshots, n_workers=None, memory_budget=None, **match_kwargs):
+    """Run galsample on every snapshot of a lightcone, processing the snapshots
+    concurrently, and combine the results into a single correspondence
+
+    Parameters
+    ----------
+    snapshots : mapping
+        Each key identifies a snapshot, e.g., its redshift or step number.
+        Each value is a two-element tuple (source, target):
+
+        - source is either a SourceHaloIndex, or a three-element tuple
+          (source_galaxies_host_halo_id, source_halo_ids, source_halo_props)
+          from which the SourceHaloIndex of the snapshot is built
+        - target is a two-element tuple (target_halo_ids, target_halo_props)
+          storing the target halos of the redshift slice of the snapshot
+
+    n_workers : int, optional
+        Number of snapshots processed concurrently in a thread pool.
+        Default is os.cpu_count().
+
+    memory_budget : int, optional
+        Approximate number of bytes that the snapshots being processed at the same
+        time may use. A snapshot is only started when its estimated memory fits
+        in the budget left by the running snapshots and by the results of the
+        finished snapshots, which are kept until all snapshots are combined.
+        At least one snapshot is always running, whatever its size.
+        Default is None for no limit.
+
+    **match_kwargs : optional
+        Keyword arguments passed to :meth:`SourceHaloIndex.match_target_halos`,
+        except n_threads, see Notes
+
+    Returns
+    -------
+    result : LightconeCorrespondence
+        namedtuple with the following fields:
+
+        - correspondence : GalsamplerCorrespondence of all target galaxies,
+          ordered by snapshot in the order of the mapping. The values of
+          target_gals_selection_indx index the concatenation of the source galaxy
+          catalogs of all snapshots in the order of the mapping.
+        - snapshots : tuple storing the keys of the mapping
+        - source_gal_offsets : ndarray of shape (n_snapshots + 1, ). The source
+          galaxies of snapshot i are stored in range(offsets[i], offsets[i + 1])
+          of the concatenated source galaxy catalog
+        - target_gal_offsets : ndarray of shape (n_snapshots + 1, ). The target
+          galaxies of snapshot i are stored in range(offsets[i], offsets[i + 1])
+          of the arrays of correspondence
+
+    Notes
+    -----
+    The sorts, the KD-tree build and query, and the galaxy selection kernel
+    release the GIL, so that a thread pool overlaps the snapshots
+    without copying any catalog to another process.
+
+    Each snapshot runs with n_threads=1, so that all the concurrency comes from
+    processing n_workers snapshots at once. The parallel Numba kernels are not
+    used from the worker threads: with the TBB threading layer, launching them
+    from a thread pool can hang the interpreter at exit.
+
+    """
+    if "n_threads" in match_kwargs:
+        msg = (
+            "galsample_lightcone processes each snapshot with n_threads=1, "
+            "use n_workers to set the number of concurrent snapshots"
+        )
+        raise ValueError(msg)
+    keys = tuple(snapshots.keys())
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    memory_budget = np.inf if memory_budget is None else memory_budget
+
+    source_gal_offsets = np.zeros(len(keys) + 1, dtype="i8")
+    for i, key in enumerate(keys):
+        source_gal_offsets[i + 1] = source_gal_offsets[i] + _n_source_gals(
+            snapshots[key][0]
+        )
+
+    results = dict()
+    finished_bytes = 0
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = list(keys)
+        running = dict()
+        while pending or running:
+            #  Start snapshots in order for as long as they fit in the budget,
+            #  which the results of the finished snapshots also count against
+            while pending and len(running) < n_workers:
+                nbytes = _estimate_snapshot_bytes(*snapshots[pending[0]])
+                in_use = finished_bytes + sum(n for __, n in running.values())
+                if running and in_use + nbytes > memory_budget:
+                    break
+                key = pending.pop(0)
+                future = executor.submit(
+                    _galsample_snapshot, *snapshots[key], match_kwargs
+                )
+                running[future] = (key, nbytes)
+
+            finished_bytes += _collect_finished(running, results)
+
+    return _combine_snapshots(keys, results, source_gal_offsets)
+
+
+def _collect_finished(running, results):
+    """Wait for at least one running snapshot to finish and move its result
+    from running to results. Returns the number of bytes of the new results.
+    Only results keeps a reference to the arrays, so that _combine_snapshots
+    can release them one at a time.
+    """
+    nbytes = 0
+    done, __ = wait(running, return_when=FIRST_COMPLETED)
+    for future in done:
+        key, __ = running.pop(future)
+        results[key] = list(future.result())
+        nbytes += sum(arr.nbytes for arr in results[key])
+    return nbytes
+
+
+def _galsample_snapshot(source, target, match_kwargs):
+    if not isinstance(source, SourceHaloIndex):
+        source = SourceHaloIndex(*source, n_threads=1)
+    target_halo_ids, target_halo_props = target
+    return source.galsample(target_halo_ids, target_halo_props, 1, **match_kwargs)
+
+
+def _n_source_gals(source):
+    if isinstance(source, SourceHaloIndex):
+        return source.idx_sorted_source_galaxies.size
+    return len(source[0])
+
+
+def _estimate_snapshot_bytes(source, target):
+    """Rough estimate of the peak memory used by galsample on one snapshot"""
+    target_halo_ids, target_halo_props = target
+    n_target_halos, n_props = len(target_halo_ids), len(target_halo_props)
+    if isinstance(source, SourceHaloIndex):
+        n_source_gals = source.idx_sorted_source_galaxies.size
+        n_source_halos = source.source_halo_ids.size
+        source_bytes = 0
+    else:
+        n_source_gals, n_source_halos = len(source[0]), len(source[1])
+        #  Sort permutation, sorted IDs and group boundaries of the galaxies,
+        #  and the data block, tree and bookkeeping arrays of the halos
+        source_bytes = 24 * n_source_gals + (16 * n_props + 32) * n_source_halos
+
+    mean_occupation = n_source_gals / max(n_source_halos, 1)
+    n_target_gals = mean_occupation * n_target_halos
+    target_bytes = (8 * n_props + 32) * n_target_halos + 24 * n_target_gals
+    return int(source_bytes + target_bytes)
+
+
+def _combine_snapshots(keys, results, source_gal_offsets):
+    """Concatenate the correspondence of each snapshot, offsetting the selection
+    indices into the concatenated source galaxy catalog
+    """
+    target_gal_offsets = np.zeros(len(keys) + 1, dtype="i8")
+    for i, key in enumerate(keys):
+        n_gals = results[key][0].size
+        target_gal_offsets[i + 1] = target_gal_offsets[i] + n_gals
+
+    n_target_gals = int(target_gal_offsets[-1])
+    dtypes = [np.dtype("i8")] * len(GalsamplerCorrespondence._fields)
+    if keys:
+        #  Mixed signed and unsigned IDs across snapshots must not become float64
+        dtypes = [
+            _common_integer_dtype(*(arr.dtype for arr in arrs))
+            for arrs in zip(*results.values())
+        ]
+    #  Offset selection indices can exceed the range of the index_dtype of a snapshot
+    dtypes[0] = np.dtype("i8")
+
+    #  Combine one field at a time, releasing each array of a snapshot once copied,
+    #  so that the peak memory only exceeds that of the output by a single field
+    arrays = []
+    for ifield, dtype in enumerate(dtypes):
+        arr = np.empty(n_target_gals, dtype=dtype)
+        for i, key in enumerate(keys):
+            istart, iend = target_gal_offsets[i], target_gal_offsets[i + 1]
+            arr[istart:iend] = results[key][ifield]
+            results[key][ifield] = None
+            if ifield == 0:
+                arr[istart:iend] += source_gal_offsets[i]
+        arrays.append(arr)
+    correspondence = GalsamplerCorrespondence(*arrays)
+
+    return LightconeCorrespondence(
+        correspondence, keys, source_gal_offsets, target_gal_offsets
+    )
@@ -0,0 +1,134 @@
+"""Module implementing opt-in instrumentation of the stages of galsample,
+recording the wall time, peak memory and array size of each stage.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+import json
+import time
+import tracemalloc
+
+__all__ = ("StageProfiler", "StageRecord")
+
+StageRecord = namedtuple("StageRecord", ["stage", "wall_time", "peak_bytes", "n_items"])
+
+
+class StageProfiler:
+    """Collect the wall time, peak allocated memory and array size of each stage
+    of a galsampler calculation
+
+    Pass an instance as the ``profile`` argument of :func:`~galsampler.galsample`,
+    :class:`~galsampler.SourceHaloIndex` or :func:`~galsampler.crossmatch`,
+    and read the results from :meth:`report` once the calculation is done.
+
+    Parameters
+    ----------
+    trace_memory : bool, optional
+        If True, record the peak memory allocated during each stage with tracemalloc.
+        Default is True.
+
+    jsonl : string or file-like object, optional
+        If not None, each record is also written as a line of JSON
+        to this path or open file as soon as its stage completes,
+        e.g., for job monitoring. Default is None.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from galsampler import galsample
+    >>> n_source_halos, n_target_halos = 100, 500
+    >>> source_halo_ids = np.arange(n_source_halos)
+    >>> source_galaxies_host_halo_id = np.repeat(source_halo_ids, 3)
+    >>> source_halo_props = (np.random.uniform(10, 15, n_source_halos), )
+    >>> target_halo_ids = np.arange(n_target_halos)
+    >>> target_halo_props = (np.random.uniform(10, 15, n_target_halos), )
+    >>> profiler = StageProfiler()
+    >>> res = galsample(source_galaxies_host_halo_id, source_halo_ids,
+    ...     target_halo_ids, source_halo_props, target_halo_props, profile=profiler)
+    >>> report = profiler.report()
+
+    Notes
+    -----
+    Memory allocated by numpy is visible to tracemalloc, but memory allocated
+    internally by scipy.spatial.cKDTree and by Numba kernels is not.
+    Stages must not be nested when trace_memory is True.
+
+    """
+
+    def __init__(self, trace_memory=True, jsonl=None):
+        self.trace_memory = trace_memory
+        self.jsonl = jsonl
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, n_items=None):
+        """Context manager recording a single stage
+
+        Parameters
+        ----------
+        name : string
+            Name of the stage, e.g., "source_index.argsort"
+
+        n_items : int, optional
+            Size of the arrays processed by the stage
+
+        """
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            baseline = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start
+            peak_bytes = None
+            if self.trace_memory:
+                peak_bytes = max(tracemalloc.get_traced_memory()[1] - baseline, 0)
+                if started_tracing:
+                    tracemalloc.stop()
+            n_items = None if n_items is None else int(n_items)
+            self._add_record(StageRecord(name, wall_time, peak_bytes, n_items))
+
+    def _add_record(self, record):
+        self.records.append(record)
+        if self.jsonl is None:
+            return
+        line = json.dumps(record._asdict()) + "\n"
+        if isinstance(self.jsonl, str):
+            with open(self.jsonl, "a") as fout:
+                fout.write(line)
+        else:
+            self.jsonl.write(line)
+
+    def report(self):
+        """List of dictionaries storing the fields of each StageRecord, in order"""
+        return [record._asdict() for record in self.records]
+
+    @property
+    def total_time(self):
+        return sum(record.wall_time for record in self.records)
+
+
+class _NullProfiler:
+    """Profiler recording nothing, used when profile is None"""
+
+    @contextmanager
+    def stage(self, name, n_items=None):
+        yield
+
+
+_NULL_PROFILER = _NullProfiler()
+
+
+def _get_profiler(profile):
+    """Return profile, or a profiler recording nothing if profile is None"""
+    if profile is None:
+        return _NULL_PROFILER
+    if not isinstance(profile, StageProfiler):
+        raise ValueError("Input profile must be None or a StageProfiler instance")
+    return profile
@@ -0,0 +1,46 @@
+"""Synthetic source and target halo catalogs shared by the unit tests."""
+import numpy as np
+
+
+def mock_source_catalog(
+    rng, n_source_halos=100, max_richness=4, n_props=1, first_id=0, id_stride=1
+):
+    """Source halos with shuffled IDs first_id + id_stride * i, each hosting
+    between 0 and max_richness - 1 galaxies stored in random order,
+    and n_props properties drawn uniformly in [0, 1)
+
+    Returns
+    -------
+    source_galaxies_host_halo_id : ndarray of shape (n_source_gals, )
+
+    source_halo_ids : ndarray of shape (n_source_halos, )
+
+    source_halo_props : tuple of n_props ndarrays of shape (n_source_halos, )
+
+    """
+    source_halo_ids = first_id + id_stride * rng.permutation(n_source_halos)
+    source_galaxies_host_halo_id = rng.permutation(
+        np.repeat(source_halo_ids, rng.randint(0, max_richness, n_source_halos))
+    )
+    source_halo_props = tuple(
+        rng.uniform(0, 1, n_source_halos) for __ in range(n_props)
+    )
+    return source_galaxies_host_halo_id, source_halo_ids, source_halo_props
+
+
+def mock_target_catalog(rng, n_target_halos=1000, n_props=1, first_id=0):
+    """Target halos with IDs first_id + i in random order,
+    and n_props properties drawn uniformly in [0, 1)
+
+    Returns
+    -------
+    target_halo_ids : ndarray of shape (n_target_halos, )
+
+    target_halo_props : tuple of n_props ndarrays of shape (n_target_halos, )
+
+    """
+    target_halo_ids = first_id + rng.permutation(n_target_halos)
+    target_halo_props = tuple(
+        rng.uniform(0, 1, n_target_halos) for __ in range(n_props)
+    )
+    return target_halo_ids, target_halo_props
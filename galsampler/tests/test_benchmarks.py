@@ -0,0 +1,56 @@
+"""Unit testing for the benchmarks module."""
+import numpy as np
+import pytest
+from ..benchmarks import make_synthetic_catalogs, run_benchmarks, scaling_exponents
+from ..benchmarks import BenchmarkResult, main
+from ..crossmatch import compute_richness
+
+
+def test_synthetic_catalogs_are_consistent():
+    catalogs = make_synthetic_catalogs(2000, n_target_halos=3000, seed=43)
+    source_halo_ids = catalogs["source_halo_ids"]
+    host_id = catalogs["source_galaxies_host_halo_id"]
+    assert np.unique(source_halo_ids).size == source_halo_ids.size
+    assert np.all(np.isin(host_id, source_halo_ids))
+    assert catalogs["target_halo_ids"].size == 3000
+    assert len(catalogs["source_halo_props"]) == len(catalogs["target_halo_props"])
+
+    #  Dense and sparse IDs describe the same occupation
+    richness = compute_richness(source_halo_ids, host_id)
+    richness_dense = compute_richness(
+        catalogs["source_halo_ranks"], catalogs["source_galaxies_host_halo_rank"]
+    )
+    assert np.all(richness == richness_dense)
+
+    #  Massive halos host more galaxies
+    logm = catalogs["source_halo_props"][0]
+    assert np.mean(richness[logm > 13.5]) > np.mean(richness[logm < 12])
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(sizes=(500, 1000), names=("crossmatch_sort", "galsample"))
+    assert len(results) == 4
+    for result in results:
+        assert result.wall_time > 0
+        assert result.throughput > 0
+    exponents = scaling_exponents(results)
+    assert set(exponents) == {"crossmatch_sort", "galsample"}
+
+    with pytest.raises(ValueError):
+        run_benchmarks(sizes=(500,), names=("crossmatch_quicksort",))
+
+
+def test_scaling_exponents():
+    n_items = np.array([1e4, 1e5, 1e6])
+    results = [
+        BenchmarkResult("linear", n, n, 1e-6 * n, None, 1e6) for n in n_items
+    ] + [BenchmarkResult("quadratic", n, n, 1e-9 * n**2, None, 1e6) for n in n_items]
+    exponents = scaling_exponents(results)
+    assert np.isclose(exponents["linear"], 1)
+    assert np.isclose(exponents["quadratic"], 2)
+
+
+def test_benchmarks_command_line(capsys):
+    main(["--sizes", "300", "--benchmarks", "crossmatch_hash", "--json"])
+    out = capsys.readouterr().out
+    assert "crossmatch_hash" in out
@@ -3,7 +3,7 @@
 import numpy as np
 import pytest
 
-from ..crossmatch import crossmatch
+from ..crossmatch import crossmatch, compute_richness, compute_group_boundaries
 
 fixed_seed = 43
 
@@ -134,3 +134,180 @@ def test_crossmatch_skip_bounds_checking():
 
     assert np.allclose(x_idx, x_idx2)
     assert np.allclose(y_idx, y_idx2)
+
+
+@pytest.mark.parametrize("method", ("hash", "auto"))
+def test_crossmatch_methods_agree(method):
+    """All methods should return the same set of matching pairs"""
+    rng = np.random.RandomState(fixed_seed)
+    x = rng.randint(-(2**40), 2**40, 5000)
+    x = np.concatenate((x, x[:1000], rng.randint(0, 100, 1000)))
+    y = np.unique(np.concatenate((x[::3], rng.randint(-(2**40), 2**40, 5000))))
+    rng.shuffle(y)
+
+    x_idx, y_idx = crossmatch(x, y)
+    x_idx2, y_idx2 = crossmatch(x, y, method=method)
+    assert np.all(x[x_idx2] == y[y_idx2])
+
+    idx_sorted, idx_sorted2 = np.argsort(x_idx), np.argsort(x_idx2)
+    assert np.all(x_idx[idx_sorted] == x_idx2[idx_sorted2])
+    assert np.all(y_idx[idx_sorted] == y_idx2[idx_sorted2])
+
+
+def test_crossmatch_hash_no_overlap():
+    x = np.array([-1, -5, -10])
+    y = np.array([1, 2, 3, 4])
+    x_idx, y_idx = crossmatch(x, y, method="hash")
+    assert len(x_idx) == 0
+    assert len(y_idx) == 0
+
+
+def test_crossmatch_unrecognized_method():
+    with pytest.raises(ValueError) as err:
+        crossmatch(np.arange(5), np.arange(5), method="bogus")
+    assert "must be one of" in err.value.args[0]
+
+
+@pytest.mark.parametrize("method", ("dense", "auto"))
+def test_crossmatch_dense_ids(method):
+    """y spans a compact range of IDs with a few gaps, x extends beyond the range"""
+    rng = np.random.RandomState(fixed_seed)
+    y = rng.permutation(np.arange(1000, 3000))[:1800]
+    x = rng.randint(500, 3500, 10000)
+    x_idx, y_idx = crossmatch(x, y)
+    x_idx2, y_idx2 = crossmatch(x, y, method=method)
+    assert np.all(x[x_idx2] == y[y_idx2])
+    assert np.all(np.sort(x_idx) == x_idx2)
+
+
+@pytest.mark.parametrize("method", ("sort", "dense", "auto"))
+def test_compute_richness_methods_agree(method):
+    rng = np.random.RandomState(fixed_seed)
+    halo_id_maxs = (2000,) if method == "dense" else (2000, 2**40)
+    for halo_id_max in halo_id_maxs:
+        unique_halo_ids = rng.permutation(
+            np.unique(rng.randint(0, halo_id_max, 1000))
+        )
+        halo_id_of_galaxies = np.concatenate(
+            (rng.choice(unique_halo_ids, 5000), rng.randint(-100, 100, 100))
+        )
+        richness = np.array(
+            [np.count_nonzero(halo_id_of_galaxies == i) for i in unique_halo_ids]
+        )
+        richness2 = compute_richness(
+            unique_halo_ids, halo_id_of_galaxies, method=method
+        )
+        assert np.all(richness == richness2)
+
+
+@pytest.mark.parametrize("validate", ("full", "fast"))
+@pytest.mark.parametrize("method", ("sort", "hash", "dense"))
+def test_validation_modes_raise(validate, method):
+    """Every validation mode should detect repeated entries of y with every method"""
+    x = np.arange(5)
+    y = np.array([3, 1, 4, 5, 1])
+    with pytest.raises(ValueError) as err:
+        crossmatch(x, y, method=method, validate=validate)
+    substr = "Input array y must be a 1d sequence of unique integers"
+    assert substr in err.value.args[0]
+
+    x_idx, y_idx = crossmatch(x, y[:-1], method=method, validate=validate)
+    assert np.all(x[x_idx] == y[y_idx])
+
+
+def test_validate_none_agrees_with_full():
+    rng = np.random.RandomState(fixed_seed)
+    x = rng.randint(0, 100, 1000)
+    y = rng.permutation(np.arange(-50, 50))
+    for validate in ("fast", "none"):
+        x_idx, y_idx = crossmatch(x, y, validate=validate)
+        x_idx2, y_idx2 = crossmatch(x, y, validate="full")
+        assert np.all(x_idx == x_idx2)
+        assert np.all(y_idx == y_idx2)
+
+
+def test_compute_group_boundaries():
+    rng = np.random.RandomState(fixed_seed)
+    sorted_ids = np.sort(rng.randint(0, 50, 500))
+    group_boundaries = compute_group_boundaries(sorted_ids)
+    uvals, indices, counts = np.unique(
+        sorted_ids, return_index=True, return_counts=True
+    )
+    assert np.all(group_boundaries.unique_ids == uvals)
+    assert np.all(group_boundaries.first_indices == indices)
+    assert np.all(group_boundaries.counts == counts)
+
+    group_boundaries = compute_group_boundaries(np.zeros(0, dtype=int))
+    assert group_boundaries.counts.size == 0
+
+    group_boundaries = compute_group_boundaries(np.array([7], dtype="u4"))
+    assert group_boundaries.unique_ids.dtype == np.dtype("u4")
+    assert np.all(group_boundaries.unique_ids == 7)
+    assert np.all(group_boundaries.first_indices == 0)
+    assert np.all(group_boundaries.counts == 1)
+
+
+def test_presorted_flags():
+    """Presorted flags should not change the results when the inputs are sorted"""
+    rng = np.random.RandomState(fixed_seed)
+    x = np.sort(rng.randint(0, 2**40, 1000))
+    y = np.unique(np.concatenate((x[::2], rng.randint(0, 2**40, 100))))
+    x_idx, y_idx = crossmatch(x, y)
+    x_idx2, y_idx2 = crossmatch(x, y, assume_x_sorted=True, assume_y_sorted=True)
+    assert np.all(x_idx == x_idx2)
+    assert np.all(y_idx == y_idx2)
+
+    richness = compute_richness(y, x)
+    richness2 = compute_richness(y, x, assume_sorted=True)
+    assert np.all(richness == richness2)
+
+
+def test_crossmatch_big_endian():
+    """Big-endian IDs, as stored in FITS files, give the same result"""
+    rng = np.random.RandomState(fixed_seed)
+    x = rng.randint(0, 100, 500)
+    y = rng.permutation(80)
+    x_idx, y_idx = crossmatch(x, y)
+    x_idx2, y_idx2 = crossmatch(x.astype(">i8"), y.astype(">i8"))
+    assert np.all(x_idx == x_idx2)
+    assert np.all(y_idx == y_idx2)
+
+    group_boundaries = compute_group_boundaries(np.sort(x).astype(">i8"))
+    assert np.all(group_boundaries.unique_ids == np.unique(x))
+
+
+@pytest.mark.parametrize("method", ("sort", "dense", "auto"))
+def test_compute_richness_mixed_signedness(method):
+    """Unsigned halo IDs with signed host IDs, which numpy promotes to float64"""
+    rng = np.random.RandomState(fixed_seed)
+    unique_halo_ids = np.arange(100)
+    halo_id_of_galaxies = rng.randint(0, 120, 1000)
+    richness = compute_richness(unique_halo_ids, halo_id_of_galaxies, method=method)
+    richness2 = compute_richness(
+        unique_halo_ids.astype("u8"), halo_id_of_galaxies.astype("i8"), method=method
+    )
+    assert np.all(richness == richness2)
+
+
+@pytest.mark.parametrize("n_threads", (1, 2, -1))
+def test_crossmatch_hash_n_threads(n_threads):
+    rng = np.random.RandomState(fixed_seed)
+    x = rng.randint(0, 2**40, 1000)
+    y = np.unique(np.concatenate((x[::3], rng.randint(0, 2**40, 100))))
+    x_idx, y_idx = crossmatch(x, y, method="sort")
+    x_idx2, y_idx2 = crossmatch(x, y, method="hash", n_threads=n_threads)
+    assert np.all(np.sort(x_idx) == x_idx2)
+    assert np.all(y_idx[np.argsort(x_idx)] == y_idx2)
+
+
+@pytest.mark.parametrize("method", ("sort", "dense", "auto"))
+def test_compute_richness_duplicate_halo_ids(method):
+    unique_halo_ids = np.array([5, 6, 6, 7])
+    halo_id_of_galaxies = np.array([5, 6, 6, 7, 7, 7])
+    with pytest.raises(ValueError):
+        compute_richness(unique_halo_ids, halo_id_of_galaxies, method=method)
+    group_boundaries = compute_group_boundaries(halo_id_of_galaxies)
+    with pytest.raises(ValueError):
+        compute_richness(
+            unique_halo_ids, halo_id_of_galaxies, group_boundaries=group_boundaries
+        )
@@ -0,0 +1,73 @@
+"""Unit testing for the distributed module."""
+import numpy as np
+import pytest
+
+from ..galmatch import SourceHaloIndex, calculate_halo_correspondence
+from ..distributed import galsample_multiprocessing, galsample_mpi
+from .mock_catalogs import mock_source_catalog, mock_target_catalog
+
+fixed_seed = 43
+
+
+def test_galsample_multiprocessing_agrees_with_galsample():
+    rng = np.random.RandomState(fixed_seed)
+    source_index = SourceHaloIndex(*mock_source_catalog(rng, max_richness=5, n_props=2))
+    target_halo_ids, target_halo_props = mock_target_catalog(rng, 1001, n_props=2)
+    res = source_index.galsample(target_halo_ids, target_halo_props)
+    res2 = galsample_multiprocessing(
+        source_index, target_halo_ids, target_halo_props, n_procs=2
+    )
+    for arr, arr2 in zip(res, res2):
+        assert arr.dtype == arr2.dtype
+        assert np.all(arr == arr2)
+
+
+def test_galsample_mpi():
+    MPI = pytest.importorskip("mpi4py.MPI")
+    comm = MPI.COMM_WORLD
+    rng = np.random.RandomState(fixed_seed)
+    source_index = SourceHaloIndex(*mock_source_catalog(rng, max_richness=5, n_props=2))
+
+    n_target_halos = 100
+    target_halo_ids, target_halo_props = mock_target_catalog(
+        rng, n_target_halos, n_props=2, first_id=comm.rank * n_target_halos
+    )
+    res, first_target_gal, num_target_gals_total = galsample_mpi(
+        comm, source_index, target_halo_ids, target_halo_props
+    )
+    num_target_gals = res.target_gals_selection_indx.size
+    assert 0 <= first_target_gal <= num_target_gals_total - num_target_gals
+    if comm.size == 1:
+        assert first_target_gal == 0
+        assert num_target_gals_total == num_target_gals
+
+
+def test_shared_memory_halo_correspondence():
+    rng = np.random.RandomState(fixed_seed)
+    n_source_halos, n_target_halos = 200, 1001
+    source_halo_props = (
+        rng.uniform(0, 1, n_source_halos),
+        rng.uniform(0, 1, n_source_halos).astype("f4"),
+    )
+    target_halo_props = (
+        rng.uniform(0, 1, n_target_halos),
+        rng.uniform(0, 1, n_target_halos).astype("f4"),
+    )
+    dd_match, indx_match = calculate_halo_correspondence(
+        source_halo_props, target_halo_props
+    )
+    dd_match2, indx_match2 = calculate_halo_correspondence(
+        source_halo_props, target_halo_props, n_procs=2
+    )
+    assert np.allclose(dd_match, dd_match2)
+    assert np.all(indx_match == indx_match2)
+
+    #  Random draws among k neighbors are reproducible for a fixed seed
+    results = [
+        calculate_halo_correspondence(
+            source_halo_props, target_halo_props, n_procs=2, k=3, seed=fixed_seed
+        )
+        for __ in range(2)
+    ]
+    assert np.all(results[0][1] == results[1][1])
+    assert not np.all(results[0][1] == indx_match)
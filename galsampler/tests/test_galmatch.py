@@ -1,7 +1,16 @@
 """Unit testing for the galmatch module."""
+import importlib
 import numpy as np
+import pytest
+from scipy.spatial import cKDTree
 from ..galmatch import galsample
 from ..galmatch import calculate_indx_correspondence
+from ..galmatch import SourceHaloIndex, galaxy_selection_kernel
+from ..galmatch import CorrespondenceBuffer, CompactCorrespondence, PropertyTransform
+from ..galmatch import galsample_chunks, iter_target_halo_chunks
+from ..galmatch import calculate_halo_correspondence, match_distance_stats
+from ..galmatch import _galaxy_table_indices
+from .mock_catalogs import mock_source_catalog, mock_target_catalog
 
 
 def test_source_galaxy_selection_indices():
@@ -101,3 +110,767 @@ def test_calculate_indx_correspondence():
 
     x_match = x_source[indx_match]
     assert np.allclose(x_target, x_match, atol=delta)
+
+
+def test_source_halo_index_agrees_with_galsample():
+    """Reusing a SourceHaloIndex across several target catalogs should give
+    the same result as calling galsample from scratch for each catalog.
+    """
+    rng = np.random.RandomState(43)
+    source = mock_source_catalog(rng, 200, max_richness=5, first_id=1000)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    source_halo_richness = np.bincount(
+        source_galaxies_host_halo_id - 1000, minlength=200
+    )[source_halo_ids - 1000]
+
+    source_index = SourceHaloIndex(*source)
+    assert source_index.n_source_gals == source_halo_richness.sum()
+    assert np.all(source_index.source_halos_richness == source_halo_richness)
+
+    for n_target_halos in (1, 50, 500):
+        target_halo_ids, target_halo_props = mock_target_catalog(rng, n_target_halos)
+        res = source_index.galsample(target_halo_ids, target_halo_props)
+        res2 = galsample(
+            source_galaxies_host_halo_id,
+            source_halo_ids,
+            target_halo_ids,
+            source_halo_props,
+            target_halo_props,
+        )
+        for arr, arr2 in zip(res, res2):
+            assert np.all(arr == arr2)
+        assert np.all(
+            source_galaxies_host_halo_id[res.target_gals_selection_indx]
+            == res.target_gals_source_halo_ids
+        )
+
+
+def test_source_halo_index_save_load(tmp_path):
+    """A SourceHaloIndex reloaded from disk should reproduce the original results
+    and should refuse to load when the input ID arrays have changed.
+    """
+    rng = np.random.RandomState(43)
+    source = mock_source_catalog(rng)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    #  The manifest describes the IDs the index was built from,
+    #  even if the caller then reuses the buffer of the IDs
+    host_id_buffer = source_galaxies_host_halo_id.copy()
+    source_index = SourceHaloIndex(host_id_buffer, source_halo_ids, source_halo_props)
+    host_id_buffer[:] = 0
+    dirname = str(tmp_path / "source_index")
+    source_index.save(dirname)
+    with pytest.raises(ValueError):
+        SourceHaloIndex.load(dirname, host_id_buffer, source_halo_ids)
+
+    loaded_index = SourceHaloIndex.load(
+        dirname, source_galaxies_host_halo_id, source_halo_ids
+    )
+    assert isinstance(loaded_index.idx_sorted_source_galaxies, np.memmap)
+    assert loaded_index.checksum == source_index.checksum
+
+    target_halo_ids, target_halo_props = mock_target_catalog(rng, 300)
+    res = source_index.galsample(target_halo_ids, target_halo_props)
+    res2 = loaded_index.galsample(target_halo_ids, target_halo_props)
+    for arr, arr2 in zip(res, res2):
+        assert np.all(arr == arr2)
+
+    with pytest.raises(ValueError) as err:
+        SourceHaloIndex.load(dirname, source_galaxies_host_halo_id[1:], source_halo_ids)
+    assert "stale" in err.value.args[0]
+
+
+def test_galsample_chunks_agrees_with_galsample():
+    """Concatenating the chunks of galsample_chunks should reproduce galsample"""
+    rng = np.random.RandomState(43)
+    source = mock_source_catalog(rng)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    target_halo_ids, target_halo_props = mock_target_catalog(rng)
+
+    res = galsample(
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        target_halo_ids,
+        source_halo_props,
+        target_halo_props,
+    )
+    chunks = iter_target_halo_chunks(target_halo_ids, target_halo_props, 77)
+    gen = galsample_chunks(
+        source_galaxies_host_halo_id, source_halo_ids, source_halo_props, chunks
+    )
+    chunk_results = list(gen)
+    assert len(chunk_results) == 13
+    for i, arr in enumerate(res):
+        arr2 = np.concatenate([chunk[i] for chunk in chunk_results])
+        assert np.all(arr == arr2)
+
+    #  Random draws among k neighbors depend on the global row of each target halo
+    args = (source_galaxies_host_halo_id, source_halo_ids)
+    props = (source_halo_props, target_halo_props)
+    res = galsample(*args, target_halo_ids, *props, k=5, seed=7)
+    chunks = iter_target_halo_chunks(target_halo_ids, target_halo_props, 77)
+    gen = galsample_chunks(*args, source_halo_props, chunks, k=5, seed=7)
+    chunk_results = list(gen)
+    for i, arr in enumerate(res):
+        arr2 = np.concatenate([chunk[i] for chunk in chunk_results])
+        assert np.all(arr == arr2)
+
+
+def test_fused_expansion_kernel_agrees_with_repeat():
+    """The fused serial and parallel kernels should agree with the unfused
+    galaxy_selection_kernel + np.repeat implementation of the expansion phase.
+    """
+    rng = np.random.RandomState(43)
+    source = mock_source_catalog(rng, max_richness=6, first_id=10)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    target_halo_ids, target_halo_props = mock_target_catalog(rng)
+    source_index = SourceHaloIndex(
+        source_galaxies_host_halo_id, source_halo_ids, source_halo_props
+    )
+
+    __, indx_match = calculate_indx_correspondence(
+        source_halo_props, target_halo_props
+    )
+    target_halo_richness = source_index.source_halos_richness[indx_match]
+    sorted_selection_indx = np.zeros(target_halo_richness.sum()).astype(int)
+    galaxy_selection_kernel(
+        source_index.source_halo_first_gal_indices[indx_match],
+        target_halo_richness,
+        target_halo_ids.size,
+        sorted_selection_indx,
+    )
+    correct_selection_indx = source_index.idx_sorted_source_galaxies[
+        sorted_selection_indx
+    ]
+    correct_target_halo_ids = np.repeat(target_halo_ids, target_halo_richness)
+    correct_source_halo_ids = np.repeat(
+        source_halo_ids[indx_match], target_halo_richness
+    )
+
+    for n_threads in (1, -1):
+        res = source_index.galsample(target_halo_ids, target_halo_props, n_threads)
+        assert np.all(res.target_gals_selection_indx == correct_selection_indx)
+        assert np.all(res.target_gals_target_halo_ids == correct_target_halo_ids)
+        assert np.all(res.target_gals_source_halo_ids == correct_source_halo_ids)
+
+
+def test_galsample_n_threads():
+    """Results of galsample should not depend on n_threads"""
+    rng = np.random.RandomState(43)
+    source = mock_source_catalog(rng)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    target_halo_ids, target_halo_props = mock_target_catalog(rng)
+    args = (
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        target_halo_ids,
+        source_halo_props,
+        target_halo_props,
+    )
+    res = galsample(*args)
+    for n_threads in (1, 2):
+        res2 = galsample(*args, n_threads=n_threads)
+        for arr, arr2 in zip(res, res2):
+            assert np.all(arr == arr2)
+
+
+def test_galsample_presorted():
+    """presorted=True should give the same result as sorting internally,
+    and should raise when the source galaxies are not sorted by host.
+    """
+    rng = np.random.RandomState(43)
+    source = mock_source_catalog(rng, id_stride=3)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    source_galaxies_host_halo_id = np.sort(source_galaxies_host_halo_id)
+    target_halo_ids, target_halo_props = mock_target_catalog(rng, 500)
+    args = (
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        target_halo_ids,
+        source_halo_props,
+        target_halo_props,
+    )
+    res = galsample(*args)
+    res2 = galsample(*args, presorted=True)
+    for arr, arr2 in zip(res, res2):
+        assert np.all(arr == arr2)
+
+    with pytest.raises(ValueError):
+        SourceHaloIndex(
+            source_galaxies_host_halo_id[::-1],
+            source_halo_ids,
+            source_halo_props,
+            presorted=True,
+        )
+
+
+def test_approximate_halo_correspondence():
+    """match_mode="approximate" should find a source halo within a factor of (1 + eps)
+    of the nearest one, and distance_upper_bound should leave distant halos unmatched.
+    """
+    rng = np.random.RandomState(43)
+    n_source_halos, n_target_halos = 2000, 5000
+    source_halo_props = tuple(rng.uniform(0, 1, (2, n_source_halos)))
+    target_halo_props = tuple(rng.uniform(0, 1, (2, n_target_halos)))
+
+    dd, indx = calculate_halo_correspondence(source_halo_props, target_halo_props)
+    eps = 0.5
+    dd2, indx2 = calculate_halo_correspondence(
+        source_halo_props, target_halo_props, match_mode="approximate", eps=eps
+    )
+    assert np.all(dd2 <= (1 + eps) * dd + 1e-12)
+    X_source = np.vstack(source_halo_props).T
+    X_target = np.vstack(target_halo_props).T
+    assert np.allclose(np.linalg.norm(X_source[indx2] - X_target, axis=1), dd2)
+
+    stats = match_distance_stats(dd2)
+    assert stats.n_matched == n_target_halos
+    assert stats.n_unmatched == 0
+    assert stats.max == dd2.max()
+
+    upper_bound = np.median(dd)
+    dd3, indx3 = calculate_halo_correspondence(
+        source_halo_props, target_halo_props, distance_upper_bound=upper_bound
+    )
+    unmatched = dd >= upper_bound
+    assert np.all(indx3[unmatched] == -1)
+    assert np.all(indx3[~unmatched] == indx[~unmatched])
+    stats = match_distance_stats(dd3)
+    assert stats.n_unmatched == np.count_nonzero(unmatched)
+
+    with pytest.raises(ValueError):
+        calculate_halo_correspondence(
+            source_halo_props, target_halo_props, match_mode="nearest"
+        )
+
+
+def test_galsample_unmatched_target_halos():
+    """Target halos left unmatched by distance_upper_bound should receive no galaxies,
+    and the galaxies of all other target halos should be unchanged.
+    """
+    rng = np.random.RandomState(43)
+    source = mock_source_catalog(rng)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    target_halo_ids, (target_halo_prop,) = mock_target_catalog(rng, 500)
+    target_halo_props = (1.2 * target_halo_prop,)
+    args = (
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        target_halo_ids,
+        source_halo_props,
+        target_halo_props,
+    )
+    res = galsample(*args)
+    res2, stats = galsample(*args, return_match_stats=True, distance_upper_bound=0.05)
+    unmatched = target_halo_props[0] > source_halo_props[0].max() + 0.05
+    unmatched_ids = target_halo_ids[unmatched]
+    assert stats.n_unmatched == unmatched_ids.size
+    assert not np.any(np.isin(res2.target_gals_target_halo_ids, unmatched_ids))
+    keep = ~np.isin(res.target_gals_target_halo_ids, unmatched_ids)
+    for arr, arr2 in zip(res, res2):
+        assert np.all(arr[keep] == arr2)
+
+
+def test_grid_correspondence_tied_properties():
+    """Tied or discrete properties, e.g., a redshift bin, collapse the quantile
+    edges of the grid, which must neither change the result nor stall the search
+    """
+    rng = np.random.RandomState(43)
+    n_source_halos, n_target_halos = 3000, 5000
+    source_logm = rng.uniform(11, 15, n_source_halos)
+    target_logm = rng.uniform(11, 15, n_target_halos)
+    source_redshift = rng.randint(0, 4, n_source_halos).astype(float)
+    target_redshift = rng.randint(0, 4, n_target_halos).astype(float)
+
+    for source_props, target_props in (
+        ((source_logm, source_redshift), (target_logm, target_redshift)),
+        ((source_redshift, source_logm), (target_redshift, target_logm)),
+        ((source_redshift, source_redshift), (target_redshift, target_redshift)),
+    ):
+        dd, indx = calculate_halo_correspondence(source_props, target_props)
+        dd2, indx2 = calculate_halo_correspondence(
+            source_props, target_props, method="grid"
+        )
+        assert np.allclose(dd, dd2)
+
+
+def test_halo_correspondence_methods_agree():
+    """The searchsorted and grid engines should find the same nearest distances
+    as the KD-tree, including for target halos outside the range of the source halos.
+    """
+    rng = np.random.RandomState(43)
+    n_source_halos, n_target_halos = 3000, 5000
+    source_halo_props = tuple(rng.normal(0, 1, (2, n_source_halos)))
+    target_halo_props = tuple(rng.normal(0, 1.5, (2, n_target_halos)))
+
+    for n_props, method in ((1, "searchsorted"), (2, "grid")):
+        source_props = source_halo_props[:n_props]
+        target_props = target_halo_props[:n_props]
+        dd, indx = calculate_halo_correspondence(source_props, target_props)
+        for n_threads in (1, -1):
+            dd2, indx2 = calculate_halo_correspondence(
+                source_props, target_props, n_threads=n_threads, method=method
+            )
+            assert np.allclose(dd, dd2)
+        dd3, indx3 = calculate_halo_correspondence(
+            source_props, target_props, method="auto"
+        )
+        assert np.all(indx3 == indx2)
+
+        upper_bound = np.median(dd)
+        dd4, indx4 = calculate_halo_correspondence(
+            source_props,
+            target_props,
+            method=method,
+            distance_upper_bound=upper_bound,
+        )
+        assert np.all((indx4 == -1) == (dd >= upper_bound))
+
+    eps = 0.5
+    dd5, indx5 = calculate_halo_correspondence(
+        source_halo_props,
+        target_halo_props,
+        method="grid",
+        match_mode="approximate",
+        eps=eps,
+    )
+    assert np.all(dd5 <= (1 + eps) * dd + 1e-12)
+
+    with pytest.raises(ValueError):
+        calculate_halo_correspondence(
+            source_halo_props, target_halo_props, method="searchsorted"
+        )
+    with pytest.raises(ValueError):
+        calculate_halo_correspondence(
+            source_halo_props, target_halo_props, method="octree"
+        )
+
+
+def test_searchsorted_random_ties():
+    """Ties among equally close source halos should be broken uniformly at random"""
+    source_halo_props = (np.repeat([0.0, 1.0, 2.0], [3, 4, 5]),)
+    target_halo_props = (np.array([-1.0, 0.5, 2.0, 3.0]),)
+    dd, indx = calculate_halo_correspondence(
+        source_halo_props, target_halo_props, method="searchsorted"
+    )
+    assert np.all(indx == (0, 0, 7, 7))
+    assert np.allclose(dd, (1, 0.5, 0, 1))
+
+    target_halo_props = (np.zeros(7000) + 0.5,)
+    dd, indx = calculate_halo_correspondence(
+        source_halo_props,
+        target_halo_props,
+        method="searchsorted",
+        random_ties=True,
+        seed=43,
+    )
+    counts = np.bincount(indx, minlength=12)
+    assert np.all(counts[7:] == 0)
+    assert np.all(np.abs(counts[:7] - 1000) < 150)
+
+
+def test_stochastic_k_nearest_neighbors():
+    """For k > 1, target halos should be matched to one of their k nearest neighbors,
+    spreading the target halos over more source halos than the nearest neighbor.
+    """
+    rng = np.random.RandomState(43)
+    n_source_halos, n_target_halos = 50, 3000
+    source_halo_props = tuple(rng.uniform(0, 1, (2, n_source_halos)))
+    target_halo_props = tuple(rng.uniform(0.4, 0.6, (2, n_target_halos)))
+
+    dd, indx = calculate_halo_correspondence(source_halo_props, target_halo_props)
+    k = 5
+    for weighting in ("uniform", "distance"):
+        dd2, indx2 = calculate_halo_correspondence(
+            source_halo_props, target_halo_props, k=k, weighting=weighting, seed=43
+        )
+        X_source = np.vstack(source_halo_props).T
+        X_target = np.vstack(target_halo_props).T
+        assert np.allclose(np.linalg.norm(X_source[indx2] - X_target, axis=1), dd2)
+        dd_k, indx_k = cKDTree(X_source).query(X_target, k=k)
+        assert np.all(np.any(indx_k == indx2[:, np.newaxis], axis=1))
+        assert np.unique(indx2).size > np.unique(indx).size
+
+        dd3, indx3 = calculate_halo_correspondence(
+            source_halo_props, target_halo_props, k=k, weighting=weighting, seed=43
+        )
+        assert np.all(indx3 == indx2)
+
+    with pytest.raises(ValueError):
+        calculate_halo_correspondence(
+            source_halo_props, target_halo_props, k=k, method="grid"
+        )
+    with pytest.raises(ValueError):
+        calculate_halo_correspondence(
+            source_halo_props, target_halo_props, k=k, weighting="gaussian"
+        )
+
+
+def test_correspondence_buffer():
+    """Appending batches of target halos to a CorrespondenceBuffer should give the
+    same result as calling galsample on the concatenated target halos.
+    """
+    rng = np.random.RandomState(43)
+    n_target_halos = 1000
+    source = mock_source_catalog(rng, id_stride=3)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    target_halo_ids, target_halo_props = mock_target_catalog(rng, n_target_halos)
+    res = galsample(
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        target_halo_ids,
+        source_halo_props,
+        target_halo_props,
+    )
+    source_index = SourceHaloIndex(
+        source_galaxies_host_halo_id, source_halo_ids, source_halo_props
+    )
+
+    buffer = CorrespondenceBuffer(source_index)
+    assert len(buffer.correspondence.target_gals_selection_indx) == 0
+    n_batch = 100
+    for istart in range(0, n_target_halos, n_batch):
+        ibatch = slice(istart, istart + n_batch)
+        batch = buffer.append(target_halo_ids[ibatch], (target_halo_props[0][ibatch],))
+        assert batch.stop == len(buffer)
+    assert buffer.capacity < 2 * len(buffer)
+    for arr, arr2 in zip(res, buffer.correspondence):
+        assert np.all(arr == arr2)
+
+    #  Start from an existing correspondence of the first half of the target halos
+    n_half = n_target_halos // 2
+    res_half = source_index.galsample(
+        target_halo_ids[:n_half], (target_halo_props[0][:n_half],)
+    )
+    buffer = CorrespondenceBuffer(source_index, res_half)
+    buffer.append(target_halo_ids[n_half:], (target_halo_props[0][n_half:],))
+    for arr, arr2 in zip(res, buffer.correspondence):
+        assert np.all(arr == arr2)
+
+    #  A first batch without galaxies, e.g., all target halos unmatched
+    buffer = CorrespondenceBuffer(source_index)
+    batch = buffer.append(
+        target_halo_ids[:10], (target_halo_props[0][:10] + 10,), distance_upper_bound=1
+    )
+    assert batch == slice(0, 0)
+    buffer.append(target_halo_ids, target_halo_props)
+    for arr, arr2 in zip(res, buffer.correspondence):
+        assert np.all(arr == arr2)
+
+    #  The first batch with galaxies sets the dtype of the target halo IDs,
+    #  also when the arrays are preallocated
+    large_ids = target_halo_ids.astype("u8") + 2**63
+    buffer = CorrespondenceBuffer(source_index, capacity=10)
+    buffer.append(large_ids[:n_half], (target_halo_props[0][:n_half],))
+    buffer.append(large_ids[n_half:], (target_halo_props[0][n_half:],))
+    assert buffer.correspondence.target_gals_target_halo_ids.dtype == np.uint64
+    assert np.all(
+        buffer.correspondence.target_gals_target_halo_ids
+        == res.target_gals_target_halo_ids.astype("u8") + 2**63
+    )
+    with pytest.raises(ValueError):
+        buffer.append(target_halo_ids.astype("f8"), target_halo_props)
+    with pytest.raises(ValueError):
+        buffer.append(target_halo_ids.astype("i8"), target_halo_props)
+
+
+def test_compact_correspondence():
+    """Expanding a CompactCorrespondence by slice, in chunks, or all at once
+    should give the same arrays as galsample, including for unmatched target halos.
+    """
+    rng = np.random.RandomState(43)
+    n_target_halos = 1000
+    source = mock_source_catalog(rng, max_richness=6, id_stride=3)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    target_halo_ids, (target_halo_prop,) = mock_target_catalog(rng, n_target_halos)
+    target_halo_props = (1.2 * target_halo_prop,)
+    source_index = SourceHaloIndex(
+        source_galaxies_host_halo_id, source_halo_ids, source_halo_props
+    )
+    args = (target_halo_ids, target_halo_props)
+    res = source_index.galsample(*args, distance_upper_bound=0.02)
+    compact = source_index.galsample_compact(*args, distance_upper_bound=0.02)
+    assert isinstance(compact, CompactCorrespondence)
+    assert len(compact) == res.target_gals_selection_indx.size
+    assert compact.n_target_halos == n_target_halos
+
+    for arr, arr2 in zip(res, compact.to_correspondence()):
+        assert np.all(arr == arr2)
+
+    n_gals = len(compact)
+    for start, stop in ((0, 0), (3, 17), (5, 6), (100, n_gals), (n_gals - 1, None)):
+        for arr, arr2 in zip(res, compact[start:stop]):
+            assert np.all(arr[start:stop] == arr2)
+
+    chunks = list(compact.iter_chunks(37, n_threads=1))
+    for arr, arr_chunks in zip(res, zip(*chunks)):
+        assert np.all(arr == np.concatenate(arr_chunks))
+
+
+def test_galsample_index_dtype():
+    """index_dtype should set the dtype of the index arrays
+    without changing their values
+    """
+    rng = np.random.RandomState(43)
+    source = mock_source_catalog(rng, id_stride=3)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    target_halo_ids, target_halo_props = mock_target_catalog(rng, 500)
+    args = (
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        target_halo_ids,
+        source_halo_props,
+        target_halo_props,
+    )
+    res = galsample(*args)
+    assert res.target_gals_selection_indx.dtype == np.dtype("i8")
+    for index_dtype in ("i4", "auto", np.int32):
+        res2 = galsample(*args, index_dtype=index_dtype)
+        assert res2.target_gals_selection_indx.dtype == np.dtype("i4")
+        for arr, arr2 in zip(res, res2):
+            assert np.all(arr == arr2)
+
+    source_index = SourceHaloIndex(*args[:2], source_halo_props, index_dtype="i4")
+    assert source_index.source_halos_richness.dtype == np.dtype("i4")
+    assert source_index.source_halo_first_gal_indices.dtype == np.dtype("i4")
+
+    for index_dtype in ("f8", "i1"):
+        with pytest.raises(ValueError):
+            galsample(*args, index_dtype=index_dtype)
+
+
+def test_property_transform(tmp_path):
+    """Matching with transform="standardize" should be equivalent to matching
+    properties standardized by hand, and the fitted transform should be
+    cached by the index and survive save and load.
+    """
+    rng = np.random.RandomState(43)
+    n_source_halos, n_target_halos = 200, 1000
+    source_halo_ids = np.arange(n_source_halos)
+    source_galaxies_host_halo_id = np.repeat(
+        source_halo_ids, rng.randint(0, 4, n_source_halos)
+    )
+    source_halo_props = (
+        rng.uniform(10, 15, n_source_halos),
+        rng.uniform(0, 0.01, n_source_halos),
+    )
+    target_halo_props = (
+        rng.uniform(10, 15, n_target_halos),
+        rng.uniform(0, 0.01, n_target_halos),
+    )
+    target_halo_ids = np.arange(n_target_halos)
+
+    mean = [np.mean(prop) for prop in source_halo_props]
+    std = [np.std(prop) for prop in source_halo_props]
+    scaled_source_props = [(p - m) / s for p, m, s in zip(source_halo_props, mean, std)]
+    scaled_target_props = [(p - m) / s for p, m, s in zip(target_halo_props, mean, std)]
+    dd, indx = calculate_halo_correspondence(scaled_source_props, scaled_target_props)
+    dd2, indx2 = calculate_halo_correspondence(
+        source_halo_props, target_halo_props, transform="standardize"
+    )
+    assert np.all(indx == indx2)
+    assert np.allclose(dd, dd2)
+
+    source_index = SourceHaloIndex(
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        source_halo_props,
+        transform="standardize",
+    )
+    res = source_index.galsample(target_halo_ids, target_halo_props)
+    res2 = galsample(
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        target_halo_ids,
+        scaled_source_props,
+        scaled_target_props,
+    )
+    for arr, arr2 in zip(res, res2):
+        assert np.all(arr == arr2)
+
+    source_index.save(str(tmp_path))
+    source_index2 = SourceHaloIndex.load(str(tmp_path))
+    assert source_index2.transform.kind == "standardize"
+    res3 = source_index2.galsample(target_halo_ids, target_halo_props)
+    for arr, arr3 in zip(res, res3):
+        assert np.all(arr == arr3)
+
+    #  Whitened source properties have unit covariance
+    X = np.vstack(source_halo_props).T * (1, 1e3) + rng.normal(0, 1, (200, 2))
+    X[:, 1] += X[:, 0]
+    transform = PropertyTransform("whiten").fit(X)
+    X_whitened = transform.apply(np.copy(X), block_size=7)
+    assert np.allclose(np.cov(X_whitened, rowvar=False), np.eye(2))
+
+    #  Constant and collinear properties have a singular covariance matrix
+    x = rng.uniform(0, 1, 200)
+    for X in (np.vstack((np.ones(200), x)).T, np.vstack((x, 2 * x, x**2)).T):
+        transform = PropertyTransform("whiten").fit(X)
+        X_whitened = transform.apply(np.copy(X))
+        assert np.all(np.isfinite(X_whitened))
+        cov = np.cov(X_whitened, rowvar=False)
+        expected = [0] + [1] * (X.shape[1] - 1)
+        assert np.allclose(np.sort(np.linalg.eigvalsh(cov)), expected)
+
+    with pytest.raises(ValueError):
+        PropertyTransform("normalize")
+
+
+def test_galsample_subsampling():
+    rng = np.random.RandomState(43)
+    n_target_halos = 1000
+    source = mock_source_catalog(rng, 200, max_richness=6)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    n_source_gals = source_galaxies_host_halo_id.size
+    target_halo_ids, target_halo_props = mock_target_catalog(
+        rng, n_target_halos, first_id=10**6
+    )
+    source_index = SourceHaloIndex(
+        source_galaxies_host_halo_id, source_halo_ids, source_halo_props
+    )
+    res = source_index.galsample(target_halo_ids, target_halo_props)
+
+    #  Masked target halos receive no galaxies, the others are unchanged
+    mask = target_halo_props[0] > 0.5
+    res2 = source_index.galsample(
+        target_halo_ids, target_halo_props, target_halo_mask=mask
+    )
+    kept = np.isin(res.target_gals_target_halo_ids, target_halo_ids[mask])
+    for arr, arr2 in zip(res, res2):
+        assert np.all(arr[kept] == arr2)
+
+    res3 = source_index.galsample(
+        target_halo_ids, target_halo_props, target_fraction=0.25, subsample_seed=1
+    )
+    n_kept_halos = np.unique(res3.target_gals_target_halo_ids).size
+    assert 0 < n_kept_halos < 0.5 * np.unique(res.target_gals_target_halo_ids).size
+
+    #  Thinned galaxies are a reproducible subset of the full result
+    keep_probability = rng.uniform(0, 1, n_source_gals)
+    keep_probability[source_galaxies_host_halo_id == source_halo_ids[0]] = 0
+    thinned = [
+        source_index.galsample(
+            target_halo_ids,
+            target_halo_props,
+            n_threads=n_threads,
+            keep_probability=keep_probability,
+            subsample_seed=2,
+        )
+        for n_threads in (1, -1)
+    ]
+    for arr, arr2 in zip(*thinned):
+        assert np.all(arr == arr2)
+    res4 = thinned[0]
+    n_target_gals = res.target_gals_selection_indx.size
+    assert 0 < res4.target_gals_selection_indx.size < n_target_gals
+    assert np.all(res4.target_gals_source_halo_ids != source_halo_ids[0])
+    assert np.all(
+        source_galaxies_host_halo_id[res4.target_gals_selection_indx]
+        == res4.target_gals_source_halo_ids
+    )
+    assert np.all(np.isin(res4.target_gals_target_halo_ids, target_halo_ids))
+
+    #  Chunks draw the same random numbers as a single call on the full catalog
+    subsample_kwargs = dict(
+        target_halo_mask=mask,
+        target_fraction=0.5,
+        keep_probability=keep_probability,
+        subsample_seed=3,
+    )
+    res_full = source_index.galsample(
+        target_halo_ids, target_halo_props, **subsample_kwargs
+    )
+    chunks = iter_target_halo_chunks(target_halo_ids, target_halo_props, 300)
+    res_chunks = list(source_index.galsample_chunks(chunks, **subsample_kwargs))
+    for arr, arr_chunks in zip(res_full, zip(*res_chunks)):
+        assert np.all(arr == np.concatenate(arr_chunks))
+    assert len(set(chunk.target_gals_selection_indx.size for chunk in res_chunks)) > 1
+
+    res5 = source_index.galsample(
+        target_halo_ids, target_halo_props, keep_probability=1
+    )
+    for arr, arr5 in zip(res, res5):
+        assert np.all(arr == arr5)
+
+    with pytest.raises(ValueError):
+        source_index.galsample(
+            target_halo_ids, target_halo_props, target_halo_mask=mask[1:]
+        )
+    with pytest.raises(ValueError):
+        source_index.galsample(target_halo_ids, target_halo_props, target_fraction=0)
+    with pytest.raises(ValueError):
+        source_index.galsample(
+            target_halo_ids, target_halo_props, keep_probability=keep_probability[1:]
+        )
+
+
+def test_galaxy_table_indices_unsorted():
+    rng = np.random.RandomState(43)
+    source_halo_ids = rng.permutation(100)
+    galaxy_host_halo_id = rng.randint(0, 120, 1000)
+    indices = _galaxy_table_indices(source_halo_ids, galaxy_host_halo_id)
+    uvals, first_indices = np.unique(galaxy_host_halo_id, return_index=True)
+    for halo_id, index in zip(source_halo_ids, indices):
+        if halo_id in uvals:
+            assert index == first_indices[np.searchsorted(uvals, halo_id)]
+        else:
+            assert index == -1
+
+
+def test_galsample_big_endian_ids():
+    """Big-endian IDs, as stored in FITS files, give the same result"""
+    rng = np.random.RandomState(43)
+    source = mock_source_catalog(rng, max_richness=5)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    target_halo_ids, target_halo_props = mock_target_catalog(rng, 300)
+    args = (source_halo_props, target_halo_props)
+    res = galsample(
+        source_galaxies_host_halo_id, source_halo_ids, target_halo_ids, *args
+    )
+    res2 = galsample(
+        source_galaxies_host_halo_id.astype(">i8"),
+        source_halo_ids.astype(">i8"),
+        target_halo_ids.astype(">i8"),
+        *args,
+    )
+    for arr, arr2 in zip(res, res2):
+        assert np.all(arr == arr2)
+
+
+def test_source_halo_index_n_threads(monkeypatch):
+    """The serial hash-table crossmatch gives the same source index"""
+    crossmatch_module = importlib.import_module("galsampler.crossmatch")
+    monkeypatch.setattr(crossmatch_module, "AUTO_HASH_MIN_SIZE", 0)
+    rng = np.random.RandomState(43)
+    #  IDs spread over a wide range, so that crossmatch does not use a lookup table
+    args = mock_source_catalog(rng, 200, max_richness=5, id_stride=2**30)
+    source_galaxies_host_halo_id, source_halo_ids, __ = args
+    source_index = SourceHaloIndex(*args, n_threads=-1)
+    source_index2 = SourceHaloIndex(*args, n_threads=1)
+    for name in ("source_halos_richness", "source_halo_first_gal_indices"):
+        assert np.all(getattr(source_index, name) == getattr(source_index2, name))
+
+    first_indices = _galaxy_table_indices(
+        source_halo_ids, source_galaxies_host_halo_id, n_threads=1
+    )
+    has_galaxies = first_indices >= 0
+    assert np.all(
+        source_galaxies_host_halo_id[first_indices[has_galaxies]]
+        == source_halo_ids[has_galaxies]
+    )
+
+
+def test_galsample_duplicate_source_halo_ids():
+    """Repeated source halo IDs are rejected rather than duplicating galaxies"""
+    source_halo_ids = np.array([0, 1, 2, 2, 3])
+    source_galaxies_host_halo_id = np.array([0, 1, 2, 2, 3, 3])
+    source_halo_props = (np.arange(5.0),)
+    target_halo_ids = np.arange(4)
+    target_halo_props = (np.arange(4.0),)
+    with pytest.raises(ValueError):
+        galsample(
+            source_galaxies_host_halo_id,
+            source_halo_ids,
+            target_halo_ids,
+            source_halo_props,
+            target_halo_props,
+        )
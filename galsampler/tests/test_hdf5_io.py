@@ -0,0 +1,58 @@
+"""Unit testing for the hdf5_io module."""
+import numpy as np
+import pytest
+
+from ..galmatch import SourceHaloIndex
+from ..hdf5_io import source_halo_index_from_hdf5, materialize_hdf5_columns
+from .mock_catalogs import mock_source_catalog
+
+h5py = pytest.importorskip("h5py")
+
+fixed_seed = 43
+
+
+def _write_mock_source_catalog(fn, rng):
+    source = mock_source_catalog(rng)
+    source_galaxies_host_halo_id, source_halo_ids, (logmhalo,) = source
+    n_source_gals = source_galaxies_host_halo_id.size
+    with h5py.File(fn, "w") as hdf:
+        hdf["halos/halo_id"] = source_halo_ids
+        hdf["halos/logmhalo"] = 10 + 5 * logmhalo
+        hdf["galaxies/host_halo_id"] = source_galaxies_host_halo_id
+        hdf["galaxies/mstar"] = rng.uniform(8, 12, n_source_gals)
+        hdf["galaxies/pos"] = rng.uniform(0, 250, (n_source_gals, 3))
+
+
+def test_source_halo_index_from_hdf5(tmp_path):
+    fn = str(tmp_path / "source.h5")
+    _write_mock_source_catalog(fn, np.random.RandomState(fixed_seed))
+
+    source_index = source_halo_index_from_hdf5(
+        fn, "galaxies/host_halo_id", "halos/halo_id", ("halos/logmhalo",), 17
+    )
+    with h5py.File(fn, "r") as hdf:
+        source_index2 = SourceHaloIndex(
+            hdf["galaxies/host_halo_id"][...],
+            hdf["halos/halo_id"][...],
+            (hdf["halos/logmhalo"][...],),
+        )
+    assert source_index.checksum == source_index2.checksum
+    assert np.all(
+        source_index.source_halos_richness == source_index2.source_halos_richness
+    )
+
+
+def test_materialize_hdf5_columns(tmp_path):
+    fn = str(tmp_path / "source.h5")
+    rng = np.random.RandomState(fixed_seed)
+    _write_mock_source_catalog(fn, rng)
+
+    with h5py.File(fn, "r") as hdf:
+        mstar = hdf["galaxies/mstar"][...]
+        pos = hdf["galaxies/pos"][...]
+    selection_indx = rng.randint(0, mstar.size, 500)
+
+    keys = ("galaxies/mstar", "galaxies/pos")
+    columns = materialize_hdf5_columns(fn, selection_indx, keys, block_size=13)
+    assert np.all(columns["galaxies/mstar"] == mstar[selection_indx])
+    assert np.all(columns["galaxies/pos"] == pos[selection_indx])
@@ -0,0 +1,113 @@
+"""Unit testing for the lightcone module."""
+import numpy as np
+import pytest
+
+from ..galmatch import SourceHaloIndex, galsample
+from ..lightcone import galsample_lightcone, _combine_snapshots
+from .mock_catalogs import mock_source_catalog, mock_target_catalog
+
+fixed_seed = 43
+
+
+def _mock_snapshot(rng, n_source_halos, n_target_halos):
+    source = mock_source_catalog(rng, n_source_halos, max_richness=5, n_props=2)
+    target = mock_target_catalog(rng, n_target_halos, n_props=2, first_id=10**6)
+    return source, target
+
+
+def _mock_lightcone(rng, n_snapshots=4):
+    return {
+        0.1 * i: _mock_snapshot(rng, 50 + 20 * i, 200 + 50 * i)
+        for i in range(n_snapshots)
+    }
+
+
+def test_galsample_lightcone_agrees_with_galsample():
+    rng = np.random.RandomState(fixed_seed)
+    snapshots = _mock_lightcone(rng)
+    result = galsample_lightcone(snapshots, n_workers=3)
+    assert result.snapshots == tuple(snapshots.keys())
+
+    source_gal_offset = 0
+    for i, (source, target) in enumerate(snapshots.values()):
+        res = galsample(source[0], source[1], target[0], source[2], target[1])
+        assert result.source_gal_offsets[i] == source_gal_offset
+        istart, iend = result.target_gal_offsets[i:][:2]
+        assert iend - istart == res.target_gals_selection_indx.size
+        for arr, arr2 in zip(result.correspondence[1:], res[1:]):
+            assert np.all(arr[istart:iend] == arr2)
+        selection_indx = result.correspondence.target_gals_selection_indx
+        assert np.all(
+            selection_indx[istart:iend]
+            == res.target_gals_selection_indx + source_gal_offset
+        )
+        source_gal_offset += source[0].size
+    assert result.source_gal_offsets[-1] == source_gal_offset
+
+
+def test_galsample_lightcone_memory_budget_and_source_index():
+    rng = np.random.RandomState(fixed_seed)
+    snapshots = _mock_lightcone(rng)
+    result = galsample_lightcone(snapshots)
+
+    #  Prebuilt indices, and a budget so small that snapshots run one at a time
+    snapshots2 = {
+        key: (SourceHaloIndex(*source), target)
+        for key, (source, target) in snapshots.items()
+    }
+    result2 = galsample_lightcone(snapshots2, n_workers=4, memory_budget=1)
+    for arr, arr2 in zip(result.correspondence, result2.correspondence):
+        assert np.all(arr == arr2)
+    assert np.all(result.source_gal_offsets == result2.source_gal_offsets)
+    assert np.all(result.target_gal_offsets == result2.target_gal_offsets)
+
+
+def test_galsample_lightcone_global_indices():
+    rng = np.random.RandomState(fixed_seed)
+    snapshots = _mock_lightcone(rng)
+    result = galsample_lightcone(snapshots, n_workers=2)
+
+    all_host_ids = np.concatenate([source[0] for source, __ in snapshots.values()])
+    source_halo_ids = all_host_ids[result.correspondence.target_gals_selection_indx]
+    assert np.all(source_halo_ids == result.correspondence.target_gals_source_halo_ids)
+
+
+def test_galsample_lightcone_rejects_n_threads():
+    rng = np.random.RandomState(fixed_seed)
+    snapshots = {0: _mock_snapshot(rng, 50, 100)}
+    with pytest.raises(ValueError):
+        galsample_lightcone(snapshots, n_threads=4)
+
+
+def test_galsample_lightcone_mixed_signedness_ids():
+    """Mixed int64 and uint64 target halo IDs keep their exact integer values"""
+    rng = np.random.RandomState(fixed_seed)
+    source, (target_halo_ids, target_halo_props) = _mock_snapshot(rng, 50, 100)
+    target_halo_ids = target_halo_ids + 2**60
+    snapshots = {
+        0: (source, (target_halo_ids.astype("i8"), target_halo_props)),
+        1: (source, (target_halo_ids.astype("u8"), target_halo_props)),
+    }
+    result = galsample_lightcone(snapshots, n_workers=2)
+    target_gals_target_halo_ids = result.correspondence.target_gals_target_halo_ids
+    assert target_gals_target_halo_ids.dtype.kind in "iu"
+    res = galsample(source[0], source[1], target_halo_ids, source[2], target_halo_props)
+    n_gals = res.target_gals_target_halo_ids.size
+    for i in range(2):
+        ids = target_gals_target_halo_ids[i * n_gals:][:n_gals]
+        assert np.all(ids == res.target_gals_target_halo_ids)
+
+
+def test_combine_snapshots_releases_results():
+    rng = np.random.RandomState(fixed_seed)
+    snapshots = _mock_lightcone(rng, n_snapshots=2)
+    results = {
+        key: list(galsample(source[0], source[1], target[0], source[2], target[1]))
+        for key, (source, target) in snapshots.items()
+    }
+    expected = [np.concatenate(arrs) for arrs in zip(*results.values())]
+    source_gal_offsets = np.array([0, 0, 0])
+    result = _combine_snapshots(tuple(results.keys()), results, source_gal_offsets)
+    for arr, arr2 in zip(result.correspondence, expected):
+        assert np.all(arr == arr2)
+    assert all(arr is None for arrs in results.values() for arr in arrs)
@@ -0,0 +1,65 @@
+"""Unit testing for the profiling module."""
+import json
+import numpy as np
+import pytest
+from ..crossmatch import crossmatch
+from ..galmatch import galsample
+from ..profiling import StageProfiler
+
+
+def test_galsample_profile_records_each_stage(tmp_path):
+    rng = np.random.RandomState(43)
+    n_source_halos, n_target_halos = 100, 500
+    source_halo_ids = np.arange(n_source_halos)
+    source_galaxies_host_halo_id = np.repeat(source_halo_ids, 3)
+    source_halo_props = (rng.uniform(0, 1, n_source_halos),)
+    target_halo_ids = np.arange(n_target_halos)
+    target_halo_props = (rng.uniform(0, 1, n_target_halos),)
+    args = (
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        target_halo_ids,
+        source_halo_props,
+        target_halo_props,
+    )
+
+    fn = str(tmp_path / "profile.jsonl")
+    profiler = StageProfiler(jsonl=fn)
+    res = galsample(*args, profile=profiler)
+    for arr, arr2 in zip(galsample(*args), res):
+        assert np.all(arr == arr2)
+
+    stages = [record["stage"] for record in profiler.report()]
+    expected_stages = (
+        "source_index.argsort",
+        "source_index.compute_richness",
+        "source_index.tree_build",
+        "galsample.tree_query",
+        "galsample.selection_kernel",
+    )
+    for stage in expected_stages:
+        assert stage in stages
+    for record in profiler.records:
+        assert record.wall_time >= 0
+        assert record.peak_bytes >= 0
+    selection = profiler.records[stages.index("galsample.selection_kernel")]
+    assert selection.n_items == res.target_gals_selection_indx.size
+    assert profiler.total_time > 0
+
+    with open(fn) as fin:
+        lines = [json.loads(line) for line in fin]
+    assert lines == profiler.report()
+
+    with pytest.raises(ValueError):
+        galsample(*args, profile=True)
+
+
+def test_crossmatch_profile():
+    x = np.array([1, 3, 5, 3, 1, 1, 3, 5])
+    y = np.array([5, 1])
+    profiler = StageProfiler(trace_memory=False)
+    idx_x, idx_y = crossmatch(x, y, profile=profiler)
+    assert np.all(x[idx_x] == y[idx_y])
+    stages = [record.stage for record in profiler.records]
+    assert stages == ["crossmatch.validate", "crossmatch.sort"]
+    assert profiler.records[0].peak_bytes is None
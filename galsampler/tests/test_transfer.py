@@ -0,0 +1,92 @@
+"""Unit testing for the transfer module."""
+import numpy as np
+import pytest
+
+from ..crossmatch import crossmatch
+from ..galmatch import galsample
+from ..transfer import transfer_galaxy_properties
+from .mock_catalogs import mock_source_catalog, mock_target_catalog
+
+fixed_seed = 43
+
+
+def _mock_catalogs(rng):
+    source = mock_source_catalog(rng, max_richness=5)
+    source_galaxies_host_halo_id, source_halo_ids, source_halo_props = source
+    target_halo_ids, target_halo_props = mock_target_catalog(rng, 400, first_id=10**6)
+    res = galsample(
+        source_galaxies_host_halo_id,
+        source_halo_ids,
+        target_halo_ids,
+        source_halo_props,
+        target_halo_props,
+    )
+    return source_galaxies_host_halo_id, source_halo_ids, target_halo_ids, res
+
+
+def test_transfer_galaxy_properties_agrees_with_fancy_indexing():
+    rng = np.random.RandomState(fixed_seed)
+    source_galaxies_host_halo_id, __, __, res = _mock_catalogs(rng)
+    n_source_gals = source_galaxies_host_halo_id.size
+    n_target_gals = res.target_gals_selection_indx.size
+    columns = dict(
+        mstar=rng.uniform(9, 12, n_source_gals).astype("f4"),
+        is_central=rng.randint(0, 2, n_source_gals).astype(bool),
+        pos=rng.uniform(0, 250, (n_source_gals, 3)),
+    )
+    out = dict(mstar=np.zeros(n_target_gals, dtype="f4"))
+    for n_threads in (1, -1):
+        for selection in (res, res.target_gals_selection_indx):
+            result = transfer_galaxy_properties(
+                selection, columns, out=out, n_threads=n_threads
+            )
+            assert result["mstar"] is out["mstar"]
+            for key, column in columns.items():
+                assert result[key].dtype == column.dtype
+                assert np.all(result[key] == column[res.target_gals_selection_indx])
+
+    with pytest.raises(ValueError):
+        transfer_galaxy_properties(res, columns, out=dict(pos=np.zeros(3)))
+
+    #  Output arrays need not be C-contiguous
+    out = dict(pos=np.zeros((3, n_target_gals)).T)
+    transfer_galaxy_properties(res, columns, out=out)
+    assert np.all(out["pos"] == columns["pos"][res.target_gals_selection_indx])
+
+
+def test_transfer_galaxy_properties_recenter(tmp_path):
+    rng = np.random.RandomState(fixed_seed)
+    catalogs = _mock_catalogs(rng)
+    source_galaxies_host_halo_id, source_halo_ids, target_halo_ids, res = catalogs
+    n_source_gals = source_galaxies_host_halo_id.size
+    n_target_gals = res.target_gals_selection_indx.size
+
+    source_halo_pos = rng.uniform(0, 250, source_halo_ids.size)
+    target_halo_pos = rng.uniform(0, 250, target_halo_ids.size)
+    idx_gals, idx_halos = crossmatch(source_galaxies_host_halo_id, source_halo_ids)
+    source_galaxies_host_pos = np.zeros(n_source_gals)
+    source_galaxies_host_pos[idx_gals] = source_halo_pos[idx_halos]
+    x = source_galaxies_host_pos + rng.uniform(-1, 1, n_source_gals)
+
+    fn = str(tmp_path / "x.npy")
+    out = dict(x=np.lib.format.open_memmap(fn, "w+", "f8", (n_target_gals,)))
+    result = transfer_galaxy_properties(
+        res,
+        dict(x=x),
+        out=out,
+        recenter=dict(x=(source_galaxies_host_pos, target_halo_pos)),
+        target_halo_ids=target_halo_ids,
+    )
+
+    idx_gals, idx_halos = crossmatch(res.target_gals_target_halo_ids, target_halo_ids)
+    target_gals_host_pos = np.zeros(n_target_gals)
+    target_gals_host_pos[idx_gals] = target_halo_pos[idx_halos]
+    selection_indx = res.target_gals_selection_indx
+    offset = x[selection_indx] - source_galaxies_host_pos[selection_indx]
+    assert np.allclose(result["x"], target_gals_host_pos + offset)
+    assert np.allclose(np.load(fn), result["x"])
+
+    with pytest.raises(ValueError):
+        transfer_galaxy_properties(
+            res, dict(x=x), recenter=dict(x=(source_galaxies_host_pos, target_halo_pos))
+        )
@@ -0,0 +1,241 @@
+"""Module implementing the transfer of galaxy properties from the source catalog
+to the target catalog according to the result of galsample.
+"""
+import numpy as np
+from numba import njit, prange
+from .crossmatch import crossmatch, _numba_threads
+
+__all__ = ("transfer_galaxy_properties",)
+
+
+def _gather_rows(source_rows, sorted_selection_indx, idx_sorted, out_rows):
+    """Copy the selected rows of the source column into the output column
+
+    Parameters
+    ----------
+    source_rows : ndarray of shape (n_source_gals, n_cols)
+
+    sorted_selection_indx : ndarray of shape (n_target_gals, )
+        Selection indices of galsample, sorted in ascending order
+
+    idx_sorted : ndarray of shape (n_target_gals, )
+        Permutation that sorts the selection indices
+
+    out_rows : ndarray of shape (n_target_gals, n_cols)
+        Output array
+
+    """
+    n_target_gals = sorted_selection_indx.shape[0]
+    n_cols = source_rows.shape[1]
+    #  Each thread reads a contiguous range of the sorted indices,
+    #  so that the source column is streamed through in ascending order
+    for k in prange(n_target_gals):
+        igal = sorted_selection_indx[k]
+        itarget = idx_sorted[k]
+        for c in range(n_cols):
+            out_rows[itarget, c] = source_rows[igal, c]
+
+
+def _gather_recentered_rows(
+    source_rows,
+    source_host_rows,
+    target_halo_rows,
+    target_gals_target_halo_indx,
+    sorted_selection_indx,
+    idx_sorted,
+    out_rows,
+):
+    """Copy the selected rows of a source position column into the output column,
+    moving each galaxy from its source halo to its target halo
+
+    Parameters
+    ----------
+    source_host_rows : ndarray of shape (n_source_gals, n_cols)
+        Position of the host halo of each source galaxy
+
+    target_halo_rows : ndarray of shape (n_target_halos, n_cols)
+        Position of each target halo
+
+    target_gals_target_halo_indx : ndarray of shape (n_target_gals, )
+        Index of the target halo of each target galaxy
+
+    See _gather_rows for the other arguments.
+
+    """
+    n_target_gals = sorted_selection_indx.shape[0]
+    n_cols = source_rows.shape[1]
+    for k in prange(n_target_gals):
+        igal = sorted_selection_indx[k]
+        itarget = idx_sorted[k]
+        ihalo = target_gals_target_halo_indx[itarget]
+        for c in range(n_cols):
+            offset = source_rows[igal, c] - source_host_rows[igal, c]
+            out_rows[itarget, c] = target_halo_rows[ihalo, c] + offset
+
+
+gather_kernel = njit(nogil=True)(_gather_rows)
+gather_kernel_parallel = njit(parallel=True)(_gather_rows)
+recentered_gather_kernel = njit(nogil=True)(_gather_recentered_rows)
+recentered_gather_kernel_parallel = njit(parallel=True)(_gather_recentered_rows)
+
+
+def transfer_galaxy_properties(
+    correspondence,
+    columns,
+    out=None,
+    recenter=None,
+    target_halo_ids=None,
+    n_threads=-1,
+):
+    """Apply the selection indices of galsample to many galaxy property columns
+
+    Parameters
+    ----------
+    correspondence : GalsamplerCorrespondence or ndarray of shape (n_target_gals, )
+        Result of :func:`~galsampler.galsample`, or only its
+        target_gals_selection_indx when recenter is None
+
+    columns : dict
+        Keys are column names, values are ndarrays of shape (n_source_gals, ...)
+        storing a property of each source galaxy
+
+    out : dict, optional
+        Keys are column names, values are preallocated arrays of shape
+        (n_target_gals, ...) into which the result is written,
+        e.g., numpy.memmap arrays for catalogs larger than memory.
+        Columns missing from out are allocated. Default is None.
+
+    recenter : dict, optional
+        Keys are names of position columns, e.g., "x", to be moved
+        from the source halo to the target halo of each galaxy.
+        Values are two-element tuples (source_galaxies_host_pos, target_halo_pos):
+
+        - source_galaxies_host_pos : ndarray of shape (n_source_gals, ...) storing
+          the position of the host halo of each source galaxy
+        - target_halo_pos : ndarray of shape (n_target_halos, ...) storing
+          the position of each target halo, in the order of target_halo_ids
+
+        Each target galaxy is placed at target_halo_pos plus the position of its
+        source galaxy relative to the source halo. Default is None.
+
+    target_halo_ids : ndarray of shape (n_target_halos, ), optional
+        Required when recenter is not None
+
+    n_threads : int, optional
+        Number of threads used by the gather. Default is -1 for all cores.
+
+    Returns
+    -------
+    result : dict
+        Keys are the keys of columns, values are ndarrays of shape (n_target_gals, ...)
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from galsampler import galsample
+    >>> n_source_halos, n_target_halos = 100, 500
+    >>> source_halo_ids = np.arange(n_source_halos)
+    >>> source_galaxies_host_halo_id = np.repeat(source_halo_ids, 3)
+    >>> source_halo_props = (np.random.uniform(10, 15, n_source_halos), )
+    >>> target_halo_ids = np.arange(n_target_halos)
+    >>> target_halo_props = (np.random.uniform(10, 15, n_target_halos), )
+    >>> res = galsample(source_galaxies_host_halo_id, source_halo_ids,
+    ...     target_halo_ids, source_halo_props, target_halo_props)
+    >>> n_source_gals = source_galaxies_host_halo_id.size
+    >>> columns = dict(mstar=np.random.uniform(9, 12, n_source_gals))
+    >>> target_gals = transfer_galaxy_properties(res, columns)
+
+    Notes
+    -----
+    The selection indices are sorted once, and all columns are then gathered
+    in ascending order of source galaxy, which streams through each column
+    instead of reading it at random as ``col[target_gals_selection_indx]`` does.
+
+    """
+    selection_indx = getattr(
+        correspondence, "target_gals_selection_indx", correspondence
+    )
+    selection_indx = np.asarray(selection_indx)
+    n_target_gals = selection_indx.size
+    out = dict() if out is None else out
+    recenter = dict() if recenter is None else recenter
+
+    for key in recenter:
+        if key not in columns:
+            msg = "Recentered column `{0}` must be one of the keys of columns"
+            raise ValueError(msg.format(key))
+    if recenter:
+        target_gals_target_halo_indx = _target_gals_target_halo_indx(
+            correspondence, target_halo_ids
+        )
+
+    idx_sorted = np.argsort(selection_indx, kind="stable")
+    sorted_selection_indx = selection_indx[idx_sorted]
+
+    result = dict()
+    for key, column in columns.items():
+        column = np.asarray(column)
+        shape = (n_target_gals, *column.shape[1:])
+        if key in out:
+            result[key] = out[key]
+            if result[key].shape != shape:
+                msg = "Output array `{0}` has shape {1} but must have shape {2}"
+                raise ValueError(msg.format(key, result[key].shape, shape))
+        else:
+            result[key] = np.empty(shape, dtype=column.dtype)
+        out_rows = _as_rows(np.asarray(result[key]))
+        if out_rows.size and not np.shares_memory(out_rows, result[key]):
+            msg = "Output array `{0}` must be reshaped to 2 dimensions without a copy"
+            raise ValueError(msg.format(key))
+
+        if key in recenter:
+            source_galaxies_host_pos, target_halo_pos = recenter[key]
+            args = (
+                _as_rows(column),
+                _as_rows(np.asarray(source_galaxies_host_pos)),
+                _as_rows(np.asarray(target_halo_pos)),
+                target_gals_target_halo_indx,
+                sorted_selection_indx,
+                idx_sorted,
+                out_rows,
+            )
+            kernels = recentered_gather_kernel, recentered_gather_kernel_parallel
+        else:
+            args = (_as_rows(column), sorted_selection_indx, idx_sorted, out_rows)
+            kernels = gather_kernel, gather_kernel_parallel
+
+        if n_threads == 1:
+            kernels[0](*args)
+        else:
+            with _numba_threads(n_threads):
+                kernels[1](*args)
+    return result
+
+
+def _as_rows(arr):
+    """View of arr with shape (len(arr), n_cols), flattening all trailing axes"""
+    if arr.ndim == 1:
+        return arr[:, np.newaxis]
+    return arr.reshape(arr.shape[0], -1)
+
+
+def _target_gals_target_halo_indx(correspondence, target_halo_ids):
+    """Index of the target halo of each target galaxy in target_halo_ids"""
+    if target_halo_ids is None or not hasattr(
+        correspondence, "target_gals_target_halo_ids"
+    ):
+        msg = (
+            "Recentering positions requires the full GalsamplerCorrespondence "
+            "and the target_halo_ids argument"
+        )
+        raise ValueError(msg)
+    target_gals_target_halo_ids = correspondence.target_gals_target_halo_ids
+    idx_gals, idx_halos = crossmatch(
+        target_gals_target_halo_ids, np.asarray(target_halo_ids), method="auto"
+    )
+    if idx_gals.size < target_gals_target_halo_ids.size:
+        msg = "Every target galaxy must have its target halo ID in target_halo_ids"
+        raise ValueError(msg)
+    target_gals_target_halo_indx = np.empty_like(idx_halos)
+    target_gals_target_halo_indx[idx_gals] = idx_halos
+    return target_gals_target_halo_indx